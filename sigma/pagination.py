@@ -0,0 +1,27 @@
+from rest_framework.pagination import CursorPagination
+
+
+class SigmaCursorPagination(CursorPagination):
+    """
+    Default pagination for every list route: keyset (cursor) pagination on an indexed, unique and unchanging key.
+    Each page costs one indexed range scan whatever the position in the list, and page size is bounded.
+    The key defaults to the primary key and can be overridden with a `pagination_ordering` attribute on the view
+    (e.g. '-pk' for newest first).
+    """
+    ordering = 'pk'
+    page_size = 50
+    page_size_query_param = 'page_size'
+    max_page_size = 200
+
+    def get_ordering(self, request, queryset, view):
+        self.ordering = getattr(view, 'pagination_ordering', self.ordering)
+        return super().get_ordering(request, queryset, view)
+
+    def get_page_size(self, request):
+        try:
+            page_size = int(request.query_params[self.page_size_query_param])
+        except (KeyError, ValueError):
+            return self.page_size
+        if page_size <= 0:
+            return self.page_size
+        return min(page_size, self.max_page_size)
@@ -0,0 +1 @@
+from .settings_default import *
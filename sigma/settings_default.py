@@ -60,6 +60,7 @@ MIDDLEWARE_CLASSES = (
     'django.contrib.auth.middleware.AuthenticationMiddleware',
     'django.contrib.auth.middleware.SessionAuthenticationMiddleware',
     'oauth2_provider.middleware.OAuth2TokenMiddleware',
+    'sigma_core.permission_context.PermissionContextMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
     'django.middleware.security.SecurityMiddleware',
@@ -113,6 +114,7 @@ REST_FRAMEWORK = {
         'rest_framework.filters.DjangoFilterBackend',
         'rest_framework.filters.SearchFilter'
     ),
+    'DEFAULT_PAGINATION_CLASS': 'sigma.pagination.SigmaCursorPagination',
     'TEST_REQUEST_DEFAULT_FORMAT': 'json'
 }
 
@@ -154,6 +156,28 @@ STATIC_ROOT = os.path.join(ENV_PATH, 'static')
 
 MEDIA_ROOT = os.path.join(ENV_PATH, '../media/')
 MEDIA_URL = '/media/'
+# Resumable uploads (see sigma_files.models.UploadSession): partial files are kept out of MEDIA_ROOT
+UPLOAD_SESSIONS = {
+    'DIR': os.path.join(ENV_PATH, '../uploads-partial/'),
+    'MAX_SIZE': 100 * 1024 * 1024,  # bytes
+    'EXPIRY': 24 * 3600,            # seconds after the last chunk, see manage.py purge_upload_sessions
+}
+# Who sends the bytes of /media/ files once Django checked permissions (see sigma_files.views.MediaView): 'django',
+# 'x-accel-redirect' (nginx: location INTERNAL_URL { internal; alias MEDIA_ROOT; }) or 'x-sendfile' (Apache, lighttpd)
+MEDIA_SERVE = {
+    'MODE': 'django',
+    'INTERNAL_URL': '/protected-media/',
+}
+# Uploads are stored once per content, under fan-out directories named after their hash
+DEFAULT_FILE_STORAGE = 'sigma_files.storage.ContentAddressedStorage'
+
+# Resized variants of the uploaded images, generated by a pool of background threads (see sigma_files.renditions)
+IMAGE_RENDITIONS = {
+    'SIZES': [64, 256, 1024],   # pixels, the rendition fits in a SIZE x SIZE square
+    'FORMATS': ['jpeg', 'webp'],
+    'QUALITY': 85,
+    'WORKERS': 2,
+}
 
 # CORS headers
 CORS_ORIGIN_ALLOW_ALL = True
@@ -167,15 +191,37 @@ AUTH_USER_MODEL = 'sigma_core.User'
 import tornado_websockets
 from tornado import websocket
 from tornado.web import StaticFileHandler
-from tornado_chat import MainHandler, ClientWSConnection, ChatHandler
+from tornado_chat import ClientWSConnection, PresenceHandler, MetricsHandler, ChatHandler
 
 ch = ChatHandler()
 
+# Django publishes chat events to the Tornado chat server through this bus (see sigma_chat.bus).
+# The in-process bus only works when Django is served by manage.py runtornado (publishing fails otherwise, e.g. under
+# runserver or a WSGI server); when the chat server runs on its own
+# (python tornado_chat.py --bus_socket=PATH), use:
+#   CHAT_BUS = {'BACKEND': 'sigma_chat.bus.UnixSocketBus', 'OPTIONS': {'path': PATH}}
+# and with N chat worker processes (python tornado_chat.py --bus_socket=PATH --processes=N):
+#   CHAT_BUS = {'BACKEND': 'sigma_chat.bus.ShardedBus', 'OPTIONS': {'path': PATH, 'shards': N}}
+CHAT_BUS = {
+    'BACKEND': 'sigma_chat.bus.InProcessBus',
+    'OPTIONS': {'subscribers': [ch.handle_event], 'ioloop': True},
+}
+
+# Messages are published on the chat bus by a background dispatcher once committed (see sigma_chat.outbox)
+CHAT_OUTBOX = {
+    'BATCH_SIZE': 100,
+    'SWEEP_INTERVAL': 5,    # seconds between two sweeps for events left behind by crashed processes
+    'RETRY_AFTER': 30,      # seconds after which an event claimed by a dispatcher can be claimed again
+    'RETENTION': 3600,      # seconds dispatched events are kept for the stats (manage.py chat_outbox)
+    'SEND_TIMEOUT': 5,      # seconds to wait for the chat server to receive an event before sending it again later
+}
+
 TORNADO = {
     'port': 8000,    # 8000 by default
     'handlers': [
-        (r'/tornado/chat/', MainHandler, {'chat_handler': ch}),
         (r"/tornado/ws/(.*)", ClientWSConnection, {'chat_handler': ch}),
+        (r"/tornado/presence/(.*)", PresenceHandler, {'chat_handler': ch}),
+        (r"/tornado/metrics/", MetricsHandler, {'chat_handler': ch}),
         (r'%s(.*)' % STATIC_URL, StaticFileHandler, {'path': STATIC_ROOT}),
         tornado_websockets.django_app
     ],  # [] by default
@@ -17,7 +17,6 @@ from django.conf.urls import include, url
 from django.contrib import admin
 from rest_framework import routers
 from django.conf import settings
-from django.views import static
 
 router = routers.DefaultRouter()
 
@@ -43,9 +42,10 @@ router.register(r'chatmember', ChatMemberViewSet)
 router.register(r'chat', ChatViewSet)
 router.register(r'message', MessageViewSet)
 
-from sigma_files.views import ImageViewSet
+from sigma_files.views import ImageViewSet, UploadSessionViewSet
 
 router.register(r'image', ImageViewSet)
+router.register(r'upload', UploadSessionViewSet, base_name='upload')
 
 urlpatterns = [
     url(r'^admin/', include(admin.site.urls)),
@@ -55,9 +55,7 @@ urlpatterns = [
     url(r'^', include(router.urls)),
 ]
 
-if settings.DEBUG:
-    urlpatterns.append(
-        url(r'^media/(?P<path>.*)$',
-            static.serve,
-            {'document_root': settings.MEDIA_ROOT, }),
-    )
+from sigma_files.views import MediaView
+
+# Media go through Django for permission checks, the front server can send the bytes (see settings.MEDIA_SERVE)
+urlpatterns.append(url(r'^media/(?P<path>.*)$', MediaView.as_view(), name='media'))
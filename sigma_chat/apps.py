@@ -3,3 +3,6 @@ from django.apps import AppConfig
 
 class SigmaChatConfig(AppConfig):
     name = 'sigma_chat'
+
+    def ready(self):
+        import sigma_chat.signals
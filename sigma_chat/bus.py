@@ -0,0 +1,238 @@
+# -*- coding: utf-8 -*-
+"""
+Publish path from Django to the Tornado chat server.
+
+Events are plain dicts with a 'type' key, handled on the Tornado side by ChatHandler.handle_event:
+    - {'type': 'message', 'message': {...}}
+    - {'type': 'token', 'token': token, 'user_id': user_id, 'chats': [chat_id1, chat_id2]}
+    - {'type': 'revoke_token', 'token': token, 'user_id': user_id}
+    - {'type': 'membership', 'user_id': user_id, 'chat_id': chat_id, 'member': bool}, when an User joins a chat, or
+      leaves it or is banned from it
+    - {'type': 'presence', 'shard': shard, 'changes': [[user_id, online, chats], ...], 'snapshot': bool} and
+      {'type': 'presence_sync', 'shard': shard}, only between the workers of a sharded chat server
+
+The backend is chosen by settings.CHAT_BUS = {'BACKEND': dotted path, 'OPTIONS': {kwargs}}.
+"""
+import json
+import logging
+import os
+import queue
+import socket
+import threading
+import time
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+from django.utils.module_loading import import_string
+from tornado.ioloop import IOLoop
+
+from tornado_chat import HashRing, shard_socket_path
+
+
+logger = logging.getLogger(__name__)
+
+
+class BaseBus(object):
+    def publish(self, event):
+        raise NotImplementedError
+
+    def send(self, event, timeout=None):
+        """
+        Deliver event before returning, or raise: used by the chat outbox, which only marks an event dispatched once
+        it is sent. publish() may return before the event is delivered, and lose it.
+        """
+        self.publish(event)
+
+    @staticmethod
+    def encode(event):
+        """One newline-delimited JSON frame."""
+        return json.dumps(event, separators=(',', ':')).encode('utf-8') + b'\n'
+
+
+class InProcessBus(BaseBus):
+    """
+    Deliver events to callbacks of the current process: synchronously, or with ioloop on the Tornado IOLoop, which is
+    safe from any thread (e.g. the chat outbox dispatcher).
+    Used when Django runs inside the Tornado chat server (manage.py runtornado), and in tests. With ioloop, publishing
+    raises ImproperlyConfigured when no IOLoop runs (runserver, WSGI servers): the events would never be delivered.
+    """
+    def __init__(self, subscribers=(), ioloop=False):
+        self.subscribers = list(subscribers)
+        self.ioloop = ioloop
+
+    def subscribe(self, callback):
+        self.subscribers.append(callback)
+
+    def unsubscribe(self, callback):
+        self.subscribers.remove(callback)
+
+    def publish(self, event):
+        if self.ioloop:
+            # PollIOLoop sets _running while started (there is no public accessor in Tornado 4)
+            if not IOLoop.initialized() or not getattr(IOLoop.instance(), '_running', True):
+                raise ImproperlyConfigured("InProcessBus(ioloop=True) needs Django to run inside the Tornado chat server "
+                                           "(manage.py runtornado): configure settings.CHAT_BUS with UnixSocketBus otherwise.")
+        for callback in list(self.subscribers):
+            if self.ioloop:
+                IOLoop.instance().add_callback(callback, event)
+            else:
+                callback(event)
+
+
+class UnixSocketBus(BaseBus):
+    """
+    Stream events to the ChatBusServer of the Tornado chat server over a persistent Unix socket.
+    publish() only enqueues the event: a background thread owns the socket, writes queued events in batches and
+    reconnects when the chat server restarts. Events are dropped (and logged) when the queue is full, so a slow or
+    stopped chat server never blocks a request.
+    send() writes the event on a socket of its own and raises OSError when the chat server is down or does not read
+    it within timeout seconds.
+    """
+    def __init__(self, path, max_queue=10000, retry_delay=0.5):
+        self.path = path
+        self.retry_delay = retry_delay
+        self._queue = queue.Queue(maxsize=max_queue)
+        self._lock = threading.Lock()
+        self._thread = None
+        self._pid = None
+        self._send_lock = threading.Lock()
+        self._send_sock = None
+        self._send_pid = None
+
+    def publish(self, event):
+        self._ensure_thread()
+        try:
+            self._queue.put_nowait(self.encode(event))
+        except queue.Full:
+            logger.warning("Chat bus queue is full, dropping %s event", event.get('type'))
+
+    def send(self, event, timeout=None):
+        data = self.encode(event)
+        with self._send_lock:
+            if self._send_pid != os.getpid():
+                # The socket of the parent process is not ours
+                self._send_sock, self._send_pid = None, os.getpid()
+            # A socket left open by a former send may have been closed by a restarted chat server: try a new one once
+            for attempt in range(2):
+                fresh = self._send_sock is None
+                try:
+                    if fresh:
+                        self._send_sock = self._connect(timeout)
+                    self._send_sock.settimeout(timeout)
+                    self._send_sock.sendall(data)
+                    return
+                except OSError:
+                    if self._send_sock is not None:
+                        self._send_sock.close()
+                        self._send_sock = None
+                    if fresh:
+                        raise
+
+    def _ensure_thread(self):
+        # Threads do not survive fork() (e.g. preloaded WSGI workers): start one per process
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid != os.getpid():
+                self._queue = queue.Queue(maxsize=self._queue.maxsize)
+                self._thread = threading.Thread(target=self._run, name='chat-bus', daemon=True)
+                self._thread.start()
+                self._pid = os.getpid()
+
+    def _connect(self, timeout=None):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.settimeout(timeout)
+        try:
+            sock.connect(self.path)
+        except OSError:
+            sock.close()
+            raise
+        return sock
+
+    def _drain(self):
+        """Block for one frame, then take every frame already queued."""
+        frames = [self._queue.get()]
+        while True:
+            try:
+                frames.append(self._queue.get_nowait())
+            except queue.Empty:
+                return b''.join(frames)
+
+    def _run(self):
+        sock = None
+        while True:
+            data = self._drain()
+            while True:
+                try:
+                    if sock is None:
+                        sock = self._connect()
+                    sock.sendall(data)
+                    break
+                except OSError as e:
+                    logger.warning("Chat bus unavailable at %s: %s", self.path, e)
+                    if sock is not None:
+                        sock.close()
+                        sock = None
+                    time.sleep(self.retry_delay)
+
+
+class ShardedBus(BaseBus):
+    """
+    Publish to the N worker processes of a sharded chat server (python tornado_chat.py --processes=N), each one
+    listening on path.i. Users are spread over workers with the same HashRing as the chat server: token and membership
+    events go to the worker of their user only, message and revocation events go to every worker.
+    """
+    def __init__(self, path, shards, **kwargs):
+        self.ring = HashRing(shards)
+        self.shards = [UnixSocketBus(shard_socket_path(path, i), **kwargs) for i in range(shards)]
+
+    def shard_for(self, user_id):
+        return self.ring.shard_for(user_id)
+
+    def recipients(self, event):
+        if event.get('type') in ('token', 'membership'):
+            return [self.shards[self.shard_for(event['user_id'])]]
+        return self.shards
+
+    def publish(self, event):
+        for shard in self.recipients(event):
+            shard.publish(event)
+
+    def send(self, event, timeout=None):
+        # Every worker has to receive it: a failure on one of them fails the event, which is sent again to all
+        for shard in self.recipients(event):
+            shard.send(event, timeout=timeout)
+
+
+_bus = None
+
+
+def get_bus():
+    """Return the bus configured by settings.CHAT_BUS, created once per process."""
+    global _bus
+    if _bus is None:
+        conf = getattr(settings, 'CHAT_BUS', {})
+        backend = import_string(conf.get('BACKEND', 'sigma_chat.bus.InProcessBus'))
+        _bus = backend(**conf.get('OPTIONS', {}))
+    return _bus
+
+
+@receiver(setting_changed)
+def reset_bus(setting, **kwargs):
+    global _bus
+    if setting == 'CHAT_BUS':
+        _bus = None
+
+
+def publish_token(token, user_id, chats):
+    """Authorize token and return the chat worker the User has to connect to (0 unless the chat server is sharded)."""
+    bus = get_bus()
+    bus.publish({'type': 'token', 'token': token, 'user_id': user_id, 'chats': list(chats)})
+    return bus.shard_for(user_id) if hasattr(bus, 'shard_for') else 0
+
+
+def revoke_token(token, user_id):
+    """Revoke token, if it was given to user_id, and close the websocket connections of the User."""
+    get_bus().publish({'type': 'revoke_token', 'token': token, 'user_id': user_id})
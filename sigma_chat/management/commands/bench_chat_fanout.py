@@ -0,0 +1,68 @@
+import time
+
+from django.core.management.base import BaseCommand
+from tornado.websocket import WebSocketProtocol13
+
+from tornado_chat import ChatHandler, ClientWSConnection, OutboundQueue
+
+
+class NullStream(object):
+    """Stand-in for the IOStream of a websocket: only counts the bytes written."""
+    def __init__(self):
+        self.bytes_written = 0
+
+    def write(self, data):
+        self.bytes_written += len(data)
+
+
+def bench_connection():
+    """A ClientWSConnection whose websocket protocol writes to a NullStream (no HTTP request, no socket)."""
+    protocol = WebSocketProtocol13.__new__(WebSocketProtocol13)
+    protocol.stream = NullStream()
+    protocol.mask_outgoing = False
+    protocol._compressor = None
+    protocol._message_bytes_out = 0
+    protocol._wire_bytes_out = 0
+    conn = ClientWSConnection.__new__(ClientWSConnection)
+    conn.ws_connection = protocol
+    conn.outbound = OutboundQueue(conn)
+    return conn
+
+
+class Command(BaseCommand):
+    help = "Benchmark ChatHandler message fan-out for chats of growing numbers of connected members."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--sizes', default='10,1000,10000', help="Comma-separated numbers of connected members")
+        parser.add_argument('--repeat', type=int, default=20)
+        parser.add_argument('--text-size', type=int, default=200, help="Length of the message text")
+        parser.add_argument('--legacy', action='store_true', help="Also benchmark encoding the message per connection")
+
+    def handle(self, *args, **options):
+        message = {
+            'id': 1,
+            'chat': {'id': 1},
+            'chatmember': {'id': 1},
+            'text': 'é' * options['text_size'],
+            'attachment': None,
+            'date': '2016-01-01T00:00:00Z',
+        }
+        for size in [int(s) for s in options['sizes'].split(',')]:
+            ch = ChatHandler()
+            for user_id in range(size):
+                ch.connections.add(user_id, bench_connection(), [1])
+
+            implementations = [('encode once', lambda: ch.add_message(message))]
+            if options['legacy']:
+                implementations.append(('legacy', lambda: [conn.write_message(message) for conn in ch.chatmate_cwsconns(1)]))
+
+            for (name, fanout) in implementations:
+                timings = []
+                for _ in range(options['repeat']):
+                    start = time.perf_counter()
+                    fanout()
+                    timings.append(time.perf_counter() - start)
+                timings.sort()
+                median = timings[len(timings) // 2]
+                self.stdout.write("%-12s members=%-6d median=%.3fms per member=%.2fus max=%.3fms" % (
+                    name, size, 1000 * median, 1e6 * median / size, 1000 * timings[-1]))
@@ -0,0 +1,230 @@
+import json
+import os
+import random
+import signal
+import subprocess
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import close_old_connections
+from django.test import override_settings
+from rest_framework.test import APIClient
+from tornado import gen, httpclient, ioloop, websocket
+
+import tornado_chat
+from sigma_core.models.user import User
+from sigma_chat.models.chat import Chat
+from sigma_chat.models.chat_member import ChatMember
+from sigma_chat.models.outbox import OutboxEvent
+
+
+def rss_kb(pid):
+    """Resident memory of process pid and of its children, in kB (Linux only, None elsewhere)."""
+    try:
+        with open('/proc/%d/status' % pid) as f:
+            rss = next(int(line.split()[1]) for line in f if line.startswith('VmRSS:'))
+        with open('/proc/%d/task/%d/children' % (pid, pid)) as f:
+            children = [int(c) for c in f.read().split()]
+    except (IOError, StopIteration):
+        return None
+    for child in children:
+        child_rss = rss_kb(child)
+        if child_rss is not None:
+            rss += child_rss
+    return rss
+
+
+def percentile(sorted_values, p):
+    if not sorted_values:
+        return float('nan')
+    return sorted_values[min(len(sorted_values) - 1, int(p * len(sorted_values)))]
+
+
+class Command(BaseCommand):
+    help = "Start a local chat server, connect simulated websocket clients, send messages through the API and report " \
+           "their delivery latency at the clients (API, commit, chat outbox, bus and chat server), throughput and " \
+           "memory per connection. The users, chats and messages of the test are created in the database and deleted " \
+           "afterwards. The simulated clients share a single process: past a few thousand deliveries per second, they " \
+           "become the bottleneck."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--clients', type=int, default=1000)
+        parser.add_argument('--chats', type=int, default=100)
+        parser.add_argument('--chats-per-client', type=int, default=3)
+        parser.add_argument('--messages', type=int, default=1000)
+        parser.add_argument('--rate', type=float, default=100, help="Messages sent per second, 0 for no limit")
+        parser.add_argument('--text-size', type=int, default=200)
+        parser.add_argument('--processes', type=int, default=1, help="Chat worker processes")
+        parser.add_argument('--port', type=int, default=9200)
+        parser.add_argument('--bus-socket', default='/tmp/sigma_chat_loadtest.sock')
+        parser.add_argument('--policy', default='coalesce', help="Slow consumer policy of the chat server")
+        parser.add_argument('--timeout', type=float, default=30, help="Seconds to wait for the last deliveries")
+        parser.add_argument('--seed', type=int, default=0)
+
+    def handle(self, *args, **options):
+        self.options = options
+        random.seed(options['seed'])
+        if options['processes'] > 1:
+            bus = {'BACKEND': 'sigma_chat.bus.ShardedBus', 'OPTIONS': {'path': options['bus_socket'], 'shards': options['processes']}}
+            self.sockets = [tornado_chat.shard_socket_path(options['bus_socket'], i) for i in range(options['processes'])]
+        else:
+            bus = {'BACKEND': 'sigma_chat.bus.UnixSocketBus', 'OPTIONS': {'path': options['bus_socket']}}
+            self.sockets = [options['bus_socket']]
+        # Sockets left by a previous run would make the server look started
+        for path in self.sockets:
+            if os.path.exists(path):
+                os.remove(path)
+
+        # In its own session, so that the workers forked by the server are stopped with it
+        self.server = subprocess.Popen([
+            sys.executable, tornado_chat.__file__,
+            '--port=%d' % options['port'],
+            '--bus_socket=%s' % options['bus_socket'],
+            '--processes=%d' % options['processes'],
+            '--slow_consumer_policy=%s' % options['policy'],
+            '--logging=warning',
+        ], start_new_session=True)
+        # Requests run in a thread of their own, so that the IOLoop of the clients keeps reading meanwhile
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.prefix = 'loadtest-%d' % time.time()
+        try:
+            with override_settings(CHAT_BUS=bus):
+                ioloop.IOLoop.current().run_sync(self.run)
+        finally:
+            os.killpg(self.server.pid, signal.SIGTERM)
+            self.server.wait()
+            self.executor.submit(self.delete_fixtures).result()
+            self.executor.shutdown()
+
+    @gen.coroutine
+    def wait_for_server(self):
+        deadline = time.time() + 10
+        while not all(os.path.exists(path) for path in self.sockets):
+            if time.time() > deadline or self.server.poll() is not None:
+                raise CommandError("The chat server did not start.")
+            yield gen.sleep(0.05)
+
+    def create_fixtures(self):
+        """Create the users and chats of the test: return the users, and the ChatMember sending the messages of each chat."""
+        o = self.options
+        User.objects.bulk_create([
+            User(email='%s-%d@sigma.loadtest' % (self.prefix, i), lastname='Loadtest', firstname='User') for i in range(o['clients'])
+        ])
+        users = list(User.objects.filter(email__startswith=self.prefix + '-').order_by('id'))
+        Chat.objects.bulk_create([Chat(name='%s-%d' % (self.prefix, i)) for i in range(o['chats'])])
+        chats = list(Chat.objects.filter(name__startswith=self.prefix + '-').order_by('id'))
+        ChatMember.objects.bulk_create([
+            ChatMember(user=user, chat=chat, is_creator=False, is_admin=False)
+            for user in users for chat in random.sample(chats, min(o['chats_per_client'], len(chats)))
+        ])
+        senders = {}
+        self.members = {}
+        for chatmember in ChatMember.objects.filter(chat__in=chats).select_related('user'):
+            senders.setdefault(chatmember.chat_id, chatmember)
+            self.members[chatmember.chat_id] = self.members.get(chatmember.chat_id, 0) + 1
+        return users, [senders[chat.id] for chat in chats if chat.id in senders]
+
+    def delete_fixtures(self):
+        # Chats first: their messages and members go with them
+        for chat in Chat.objects.filter(name__startswith=self.prefix + '-'):
+            chat.delete()
+        User.objects.filter(email__startswith=self.prefix + '-').delete()
+        close_old_connections()
+
+    def post(self, user, url, data=None):
+        client = APIClient(SERVER_NAME='localhost')
+        client.force_authenticate(user=user)
+        response = client.post(url, data or {})
+        if response.status_code != 201:
+            raise CommandError("POST %s answered %d: %s" % (url, response.status_code, response.data))
+        return response.data
+
+    def call(self, fn, *args):
+        return self.executor.submit(fn, *args)
+
+    @gen.coroutine
+    def run(self):
+        o = self.options
+        yield self.wait_for_server()
+        users, senders = yield self.call(self.create_fixtures)
+
+        # Tokens, as clients get them, then connections
+        tokens = []
+        for user in users:
+            data = yield self.call(self.post, user, '/chat/ws_token/')
+            tokens.append((data['token'], data['shard']))
+        yield gen.sleep(0.5)
+        rss_before = rss_kb(self.server.pid)
+
+        self.latencies = []
+        self.received = 0
+        self.sent = {}
+        conns = []
+        start = time.time()
+        for batch_start in range(0, len(tokens), 100):
+            batch = yield [self.connect(token, shard) for (token, shard) in tokens[batch_start:batch_start + 100]]
+            conns.extend(batch)
+        self.stdout.write("%d connections opened in %.2fs" % (len(conns), time.time() - start))
+        # Let presence settle before measuring
+        yield gen.sleep(1.5)
+        rss_after = rss_kb(self.server.pid)
+
+        # Message traffic, through the API: saved, then published by the chat outbox once committed
+        expected = 0
+        padding = 'x' * o['text_size']
+        start = time.time()
+        for i in range(o['messages']):
+            sender = senders[i % len(senders)]
+            expected += self.members[sender.chat_id]
+            self.sent[i] = time.time()
+            yield self.call(self.post, sender.user, '/chatmember/%d/send_message/' % sender.id,
+                            {'text': '%s %d %s' % (self.prefix, i, padding)})
+            if o['rate']:
+                delay = start + (i + 1) / o['rate'] - time.time()
+                if delay > 0:
+                    yield gen.sleep(delay)
+        sent = time.time() - start
+
+        deadline = time.time() + o['timeout']
+        while self.received < expected and time.time() < deadline:
+            yield gen.sleep(0.05)
+        elapsed = time.time() - start
+
+        metrics = []
+        for shard in range(max(o['processes'], 1)):
+            response = yield httpclient.AsyncHTTPClient().fetch('http://127.0.0.1:%d/tornado/metrics/' % (o['port'] + shard), raise_error=False)
+            if response.code == 200:
+                metrics.append(json.loads(response.body.decode('utf-8')))
+        outbox = yield self.call(OutboxEvent.objects.stats)
+        for conn in conns:
+            conn.close()
+
+        latencies = sorted(self.latencies)
+        self.stdout.write("messages sent: %d in %.2fs (%.0f/s)" % (o['messages'], sent, o['messages'] / sent))
+        self.stdout.write("deliveries: %d/%d in %.2fs (%.0f/s)" % (self.received, expected, elapsed, self.received / elapsed))
+        self.stdout.write("latency from the API call: p50=%.1fms p99=%.1fms max=%.1fms" % (
+            1000 * percentile(latencies, 0.5), 1000 * percentile(latencies, 0.99), 1000 * percentile(latencies, 1)))
+        if rss_before is not None and rss_after is not None:
+            self.stdout.write("server memory: %d kB idle, %d kB with %d connections (%.1f kB per connection)" % (
+                rss_before, rss_after, len(conns), (rss_after - rss_before) / max(len(conns), 1)))
+        self.stdout.write("chat outbox: %s" % json.dumps(outbox, sort_keys=True))
+        for m in metrics:
+            self.stdout.write("worker metrics: %s" % json.dumps(m, sort_keys=True))
+
+    @gen.coroutine
+    def connect(self, token, shard):
+        url = 'ws://127.0.0.1:%d/tornado/ws/%s' % (self.options['port'] + shard, token)
+        conn = yield websocket.websocket_connect(url, on_message_callback=self.on_message)
+        return conn
+
+    def on_message(self, message):
+        if message is None:
+            return
+        event = json.loads(message)
+        # Messages of the test: "<prefix> <index> <padding>"
+        text = event.get('text', '')
+        if text.startswith(self.prefix + ' '):
+            self.received += 1
+            self.latencies.append(time.time() - self.sent[int(text.split(' ', 2)[1])])
@@ -0,0 +1,30 @@
+import json
+import time
+
+from django.core.management.base import BaseCommand
+
+from sigma_chat.models.outbox import OutboxEvent
+from sigma_chat.outbox import get_dispatcher
+
+
+class Command(BaseCommand):
+    help = "Report the chat outbox lag, publish its pending events, or run a dispatcher in the foreground."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--dispatch', action='store_true', help="Publish the pending events and purge the old ones once")
+        parser.add_argument('--watch', type=float, default=0,
+                            help="Keep dispatching, and report the stats every WATCH seconds")
+
+    def handle(self, *args, **options):
+        dispatcher = get_dispatcher()
+        if options['dispatch']:
+            self.stdout.write("%d events published" % dispatcher.dispatch_pending())
+            self.stdout.write("%d events purged" % dispatcher.purge())
+        if not options['watch']:
+            self.stdout.write(json.dumps(OutboxEvent.objects.stats(), sort_keys=True))
+            return
+        dispatcher.wake()
+        while True:
+            time.sleep(options['watch'])
+            dispatcher.wake()
+            self.stdout.write(json.dumps(OutboxEvent.objects.stats(), sort_keys=True))
@@ -0,0 +1,36 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.9 on 2026-10-18 19:21
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def mark_existing_messages_read(apps, schema_editor):
+    # Start every member with the whole history read rather than with every past message unread
+    ChatMember = apps.get_model('sigma_chat', 'ChatMember')
+    Message = apps.get_model('sigma_chat', 'Message')
+    last_messages = Message.objects.values('chat_id').annotate(last_id=models.Max('id'))
+    for m in last_messages:
+        ChatMember.objects.filter(chat_id=m['chat_id']).update(last_read_message_id=m['last_id'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('sigma_chat', '0002_message_history_index'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='chatmember',
+            name='last_read_message',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to='sigma_chat.Message'),
+        ),
+        migrations.AddField(
+            model_name='chatmember',
+            name='unread_count',
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+        migrations.RunPython(mark_existing_messages_read, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,35 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.9 on 2026-10-18 19:23
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def fill_chat_summary(apps, schema_editor):
+    Chat = apps.get_model('sigma_chat', 'Chat')
+    for chat in Chat.objects.annotate(last_id=models.Max('message__id')):
+        chat.last_message_id = chat.last_id
+        chat.members_count = chat.chatmember.filter(is_member=True).count()
+        chat.save(update_fields=['last_message', 'members_count'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('sigma_chat', '0003_chatmember_read_state'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='chat',
+            name='last_message',
+            field=models.ForeignKey(blank=True, editable=False, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to='sigma_chat.Message'),
+        ),
+        migrations.AddField(
+            model_name='chat',
+            name='members_count',
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+        migrations.RunPython(fill_chat_summary, migrations.RunPython.noop),
+    ]
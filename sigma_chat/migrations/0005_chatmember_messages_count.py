@@ -0,0 +1,28 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.9 on 2026-10-18 19:23
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+def count_messages(apps, schema_editor):
+    ChatMember = apps.get_model('sigma_chat', 'ChatMember')
+    for chatmember in ChatMember.objects.annotate(count=models.Count('chatmember_message')):
+        chatmember.messages_count = chatmember.count
+        chatmember.save(update_fields=['messages_count'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('sigma_chat', '0004_chat_last_message_members_count'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='chatmember',
+            name='messages_count',
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+        migrations.RunPython(count_messages, migrations.RunPython.noop),
+    ]
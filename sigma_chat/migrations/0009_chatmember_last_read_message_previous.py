@@ -0,0 +1,21 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.9 on 2026-10-18 20:04
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import sigma_chat.models.chat_member
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('sigma_chat', '0008_message_date_auto_now_add'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='chatmember',
+            name='last_read_message',
+            field=models.ForeignKey(blank=True, null=True, on_delete=sigma_chat.models.chat_member.set_previous_message, related_name='+', to='sigma_chat.Message'),
+        ),
+    ]
@@ -0,0 +1,21 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.9 on 2026-10-18 20:17
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import sigma_chat.models.message
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('sigma_chat', '0009_chatmember_last_read_message_previous'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='message',
+            name='attachment',
+            field=models.FileField(blank=True, db_index=True, upload_to=sigma_chat.models.message.chat_directory_path),
+        ),
+    ]
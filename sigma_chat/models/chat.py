@@ -4,7 +4,10 @@ from django.db import models
 
 class Chat(models.Model):
     name = models.CharField(max_length=50)
-    
+    # Denormalized, kept up to date by sigma_chat.signals
+    last_message = models.ForeignKey('Message', null=True, blank=True, on_delete=models.SET_NULL, related_name='+', editable=False)
+    members_count = models.PositiveIntegerField(default=0, editable=False) # ChatMembers with is_member=True
+
     # Related fields : 
     #     - chatmember (model ChatMember.chat)
     #     - message (model Message.chat)
@@ -4,6 +4,17 @@ from django.db import models
 from sigma_chat.models.chat import Chat
 
 
+def set_previous_message(collector, field, sub_objs, using):
+    """on_delete of ChatMember.last_read_message: move the read pointer back to the previous message of the chat."""
+    from sigma_chat.models.message import Message
+    deleted = [m.pk for m in collector.data.get(Message, ())]
+    for chatmember in sub_objs:
+        previous = Message.objects.using(using) \
+            .filter(chat_id=chatmember.chat_id, id__lt=chatmember.last_read_message_id).exclude(pk__in=deleted) \
+            .order_by('-id').values_list('id', flat=True).first()
+        collector.add_field_update(field, previous, [chatmember])
+
+
 class ChatMember(models.Model):
     is_creator = models.BooleanField()
     is_admin = models.BooleanField()
@@ -12,9 +23,40 @@ class ChatMember(models.Model):
     user = models.ForeignKey('sigma_core.User', related_name='user_chatmember')
     chat = models.ForeignKey(Chat, related_name='chatmember')
 
+    # Read state, maintained by sigma_chat.signals when messages are sent or deleted, and members join.
+    # Members (re)joining a chat are set as having read its messages up to then.
+    last_read_message = models.ForeignKey('Message', null=True, blank=True, on_delete=set_previous_message, related_name='+')
+    unread_count = models.PositiveIntegerField(default=0, editable=False)
+    messages_count = models.PositiveIntegerField(default=0, editable=False) # messages sent by this member
+
     # Related fields :
     #     - member_message (model Message.member)
 
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        # Used by sigma_chat.signals to detect membership changes
+        instance._loaded_is_member = instance.__dict__.get('is_member')
+        return instance
+
+    def mark_read(self, message=None):
+        """
+        Move the read pointer forward to message (the newest message of the chat by default) and recount unread
+        messages. Return False if message is older than the current pointer.
+        """
+        from sigma_chat.models.message import Message
+        messages = Message.objects.filter(chat_id=self.chat_id)
+        if message is None:
+            message = messages.order_by('-id').first()
+            if message is None:
+                return True
+        if self.last_read_message_id is not None and message.id < self.last_read_message_id:
+            return False
+        self.last_read_message = message
+        self.unread_count = messages.filter(id__gt=message.id).exclude(chatmember_id=self).count()
+        self.save(update_fields=['last_read_message', 'unread_count'])
+        return True
+
     ################################################################
     # PERMISSIONS                                                  #
     ################################################################
@@ -3,6 +3,7 @@ from django.db import models
 
 from sigma_chat.models.chat_member import ChatMember
 from sigma_chat.models.chat import Chat
+from sigma_files.storage import StoredFilesModel
 
 
 def chat_directory_path(instance, filename):
@@ -10,12 +11,48 @@ def chat_directory_path(instance, filename):
     return 'uploads/chats/{0}/{1}'.format(instance.chat_id.id, filename)
 
 
-class Message(models.Model):
+class MessageManager(models.Manager):
+    def attachment_readable_by(self, name, user):
+        """Whether user is member of a chat where a message has the file stored as name as attachment."""
+        return self.filter(attachment=name, chat_id__chatmember__user=user, chat_id__chatmember__is_member=True).exists()
+
+    def history(self, chat, before=None, after=None, limit=50):
+        """
+        Return (messages, has_more): at most limit messages of chat in chronological order, either the newest ones,
+        the ones just before message `before` or the ones just after message `after`. Each page is a range scan of the
+        (chat_id, date, id) index, wherever it is in the history.
+        Raise Message.DoesNotExist if the anchor message is not in chat.
+        """
+        messages = self.filter(chat_id=chat)
+        anchor_id = before if before is not None else after
+        if anchor_id is not None:
+            date = messages.values_list('date', flat=True).get(pk=anchor_id)
+            if before is not None:
+                messages = messages.filter(date__lte=date).filter(models.Q(date__lt=date) | models.Q(id__lt=anchor_id))
+            else:
+                messages = messages.filter(date__gte=date).filter(models.Q(date__gt=date) | models.Q(id__gt=anchor_id))
+
+        if after is not None:
+            page = list(messages.order_by('date', 'id')[:limit + 1])
+            return page[:limit], len(page) > limit
+        page = list(messages.order_by('-date', '-id')[:limit + 1])
+        has_more = len(page) > limit
+        page = page[:limit]
+        page.reverse()
+        return page, has_more
+
+
+class Message(StoredFilesModel):
+    class Meta:
+        index_together = (("chat_id", "date", "id"),)
+
     text = models.TextField(blank=True)
     chatmember_id = models.ForeignKey(ChatMember, related_name='chatmember_message')
     chat_id = models.ForeignKey(Chat, related_name='message')
-    date = models.DateTimeField(auto_now=True)
-    attachment = models.FileField(upload_to=chat_directory_path, blank=True)
+    date = models.DateTimeField(auto_now_add=True)
+    attachment = models.FileField(upload_to=chat_directory_path, blank=True, db_index=True) # looked up by MediaView
+
+    objects = MessageManager()
 
     ################################################################
     # PERMISSIONS                                                  #
@@ -0,0 +1,62 @@
+# -*- coding: utf-8 -*-
+import json
+
+from django.db import models
+from django.db.models import Min, Sum
+from django.utils import timezone
+
+
+class OutboxEventManager(models.Manager):
+    def pending(self):
+        return self.filter(dispatched_at__isnull=True)
+
+    def lag(self):
+        """Return (pending, lag): the number of events waiting for dispatch and the age in seconds of the oldest one."""
+        stats = self.pending().aggregate(pending=models.Count('id'), oldest=Min('created'))
+        if stats['oldest'] is None:
+            return 0, 0.0
+        return stats['pending'], max(0.0, (timezone.now() - stats['oldest']).total_seconds())
+
+    def stats(self, samples=1000):
+        """
+        Counters of the outbox, shared by the dispatchers of all processes: the events pending, the events dispatched
+        (and not purged yet), the failed publication attempts, and the latencies from enqueue to publication of the
+        samples latest dispatched events.
+        """
+        latencies = sorted(
+            (dispatched_at - created).total_seconds() for (created, dispatched_at) in
+            self.filter(dispatched_at__isnull=False).order_by('-dispatched_at').values_list('created', 'dispatched_at')[:samples]
+        )
+
+        def percentile(p):
+            return latencies[min(len(latencies) - 1, int(p * len(latencies)))] if latencies else None
+
+        pending, lag = self.lag()
+        return {
+            'pending': pending,
+            'lag': lag,
+            'dispatched': self.filter(dispatched_at__isnull=False).count(),
+            'failed': self.aggregate(failed=Sum('failures'))['failed'] or 0,
+            'latency_p50': percentile(0.5),
+            'latency_p99': percentile(0.99),
+            'latency_max': latencies[-1] if latencies else None,
+        }
+
+
+class OutboxEvent(models.Model):
+    """
+    A chat bus event saved in the same transaction as the data it is about, and published once committed by
+    sigma_chat.outbox.OutboxDispatcher. Dispatched events are kept for a while for the stats, then purged.
+    """
+    event = models.TextField()
+    created = models.DateTimeField(auto_now_add=True, db_index=True)
+    # Dispatcher which claimed the event, and when: a claim older than RETRY_AFTER is given up
+    claimed_by = models.CharField(max_length=32, blank=True, db_index=True)
+    claimed_at = models.DateTimeField(null=True, blank=True)
+    dispatched_at = models.DateTimeField(null=True, blank=True, db_index=True)
+    failures = models.PositiveIntegerField(default=0)  # failed publication attempts
+
+    objects = OutboxEventManager()
+
+    def get_event(self):
+        return json.loads(self.event)
@@ -0,0 +1,157 @@
+# -*- coding: utf-8 -*-
+"""
+Transactional outbox between Django and the chat bus.
+
+Requests do not publish chat events themselves: enqueue() saves them as OutboxEvent rows, in the transaction of the
+data they are about, and wakes the OutboxDispatcher of the process once it is committed. The dispatcher sends the
+events on the chat bus from a background thread, so the request never waits for the chat server, and an event is
+never published for a rolled back message. An event is marked dispatched once the chat server received it, and sent
+again otherwise: events are delivered at least once. Events left behind by a crashed process are picked up by the periodic
+sweep of any dispatcher, or by manage.py chat_outbox --dispatch.
+
+Dispatched events are kept RETENTION seconds, so that OutboxEvent.objects.stats() reports the publication latencies
+of all the processes from the table.
+
+Options are read from settings.CHAT_OUTBOX = {'BATCH_SIZE': 100, 'SWEEP_INTERVAL': 5, 'RETRY_AFTER': 30,
+'RETENTION': 3600, 'SEND_TIMEOUT': 5}.
+"""
+import json
+import logging
+import os
+import threading
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.signals import setting_changed
+from django.db import DatabaseError, close_old_connections, transaction
+from django.db.models import F, Q
+from django.dispatch import receiver
+from django.utils import timezone
+from django.utils.crypto import get_random_string
+
+from sigma_chat.bus import get_bus
+from sigma_chat.models.outbox import OutboxEvent
+
+
+logger = logging.getLogger(__name__)
+
+
+class OutboxDispatcher(object):
+    """
+    Send OutboxEvents on the chat bus, in id order and by batches of batch_size. Events are claimed before being
+    sent so that the dispatchers of several processes do not send them twice, unless a claim is older than
+    retry_after seconds (its dispatcher died, or the chat server did not receive it within send_timeout seconds).
+    The background thread wakes up on wake() and every sweep_interval seconds.
+    Dispatched events are deleted retention seconds after their publication.
+    """
+    def __init__(self, batch_size=100, sweep_interval=5.0, retry_after=30.0, retention=3600.0, send_timeout=5.0):
+        self.batch_size = batch_size
+        self.send_timeout = send_timeout
+        self.sweep_interval = sweep_interval
+        self.retry_after = retry_after
+        self.retention = retention
+        self._wakeup = threading.Event()
+        self._lock = threading.Lock()
+        self._pid = None
+
+    def wake(self):
+        self._ensure_thread()
+        self._wakeup.set()
+
+    def _ensure_thread(self):
+        # Threads do not survive fork() (e.g. preloaded WSGI workers): start one per process
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid != os.getpid():
+                thread = threading.Thread(target=self._run, name='chat-outbox', daemon=True)
+                thread.start()
+                self._pid = os.getpid()
+
+    def _run(self):
+        while True:
+            self._wakeup.wait(self.sweep_interval)
+            self._wakeup.clear()
+            close_old_connections()
+            try:
+                self.dispatch_pending()
+                self.purge()
+            except DatabaseError as e:
+                logger.warning("Chat outbox unavailable: %s", e)
+
+    def claimable(self):
+        return OutboxEvent.objects.pending().filter(
+            Q(claimed_by='') | Q(claimed_at__lt=timezone.now() - timedelta(seconds=self.retry_after)))
+
+    def dispatch_batch(self):
+        """Claim and send the batch_size oldest unclaimed events, return how many were claimed."""
+        ids = list(self.claimable().order_by('id').values_list('id', flat=True)[:self.batch_size])
+        if not ids:
+            return 0
+        claim = get_random_string(32)
+        claimed = self.claimable().filter(pk__in=ids).update(claimed_by=claim, claimed_at=timezone.now())
+        if not claimed:
+            return 0
+        bus = get_bus()
+        sent = []
+        for outbox_event in OutboxEvent.objects.filter(claimed_by=claim).order_by('id'):
+            try:
+                bus.send(outbox_event.get_event(), timeout=self.send_timeout)
+            except Exception:
+                # Left claimed: retried after retry_after
+                OutboxEvent.objects.filter(pk=outbox_event.id).update(failures=F('failures') + 1)
+                logger.exception("Could not publish chat outbox event %d", outbox_event.id)
+                continue
+            sent.append(outbox_event.id)
+        # Once written to the chat server only: events sent before a crash are sent again
+        OutboxEvent.objects.filter(pk__in=sent).update(dispatched_at=timezone.now())
+        return claimed
+
+    def dispatch_pending(self):
+        """Send every claimable event, return how many were claimed."""
+        total = 0
+        while True:
+            claimed = self.dispatch_batch()
+            total += claimed
+            if claimed < self.batch_size:
+                return total
+
+    def purge(self):
+        """Delete the events dispatched more than retention seconds ago, return how many were deleted."""
+        deleted, _ = OutboxEvent.objects.filter(dispatched_at__lt=timezone.now() - timedelta(seconds=self.retention)).delete()
+        return deleted
+
+
+_dispatcher = None
+
+
+def get_dispatcher():
+    """Return the dispatcher configured by settings.CHAT_OUTBOX, created once per process."""
+    global _dispatcher
+    if _dispatcher is None:
+        conf = getattr(settings, 'CHAT_OUTBOX', {})
+        _dispatcher = OutboxDispatcher(
+            batch_size=conf.get('BATCH_SIZE', 100),
+            sweep_interval=conf.get('SWEEP_INTERVAL', 5.0),
+            retry_after=conf.get('RETRY_AFTER', 30.0),
+            retention=conf.get('RETENTION', 3600.0),
+            send_timeout=conf.get('SEND_TIMEOUT', 5.0),
+        )
+    return _dispatcher
+
+
+@receiver(setting_changed)
+def reset_dispatcher(setting, **kwargs):
+    global _dispatcher
+    if setting == 'CHAT_OUTBOX':
+        _dispatcher = None
+
+
+def enqueue(event):
+    """Save a chat bus event in the current transaction, to be published once it is committed."""
+    OutboxEvent.objects.create(event=json.dumps(event, separators=(',', ':')))
+    transaction.on_commit(get_dispatcher().wake)
+
+
+def enqueue_message(message):
+    enqueue({'type': 'message', 'message': message})
@@ -3,6 +3,7 @@ from rest_framework import serializers
 
 from sigma_chat.models.chat import Chat
 from sigma_chat.models.chat_member import ChatMember
+from sigma_chat.serializers.message import MessageSerializer
 from sigma_core.models.user import User
 
 class ChatSerializer(serializers.ModelSerializer):
@@ -12,6 +13,13 @@ class ChatSerializer(serializers.ModelSerializer):
     class Meta:
         model = Chat
 
+    last_message = MessageSerializer(read_only=True)
+    unread_count = serializers.SerializerMethodField()
+
+    def get_unread_count(self, obj):
+        # Annotated by ChatFilterBackend
+        return getattr(obj, 'unread_count', None)
+
     def create(self, data):
         chat = Chat(**data)
         if 'user' in self.initial_data:
@@ -20,8 +28,7 @@ class ChatSerializer(serializers.ModelSerializer):
                 chat.save()
                 creator = ChatMember(user=user, is_creator=True, is_admin=True, chat=chat)
                 creator.save()
-                chat.chatmember.add(creator)
-                chat.save()
+                chat.refresh_from_db(fields=['members_count'])
                 return chat
             except User.DoesNotExist:
                 return None
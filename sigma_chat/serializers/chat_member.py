@@ -10,7 +10,18 @@ class ChatMemberSerializer(serializers.ModelSerializer):
     class Meta:
         model = ChatMember
         exclude = ('user', 'chat')
+        read_only_fields = ('last_read_message', )
 
     user_id = serializers.PrimaryKeyRelatedField(read_only=True, source="user")
     chat_id = serializers.PrimaryKeyRelatedField(read_only=True, source="chat")
-    chatmember_message_id = serializers.PrimaryKeyRelatedField(read_only=True, many=True, source="chatmember_message")
+
+    # Read state, only shown to the member himself
+    private_fields = ('last_read_message', 'unread_count')
+
+    def to_representation(self, instance):
+        data = super(ChatMemberSerializer, self).to_representation(instance)
+        request = self.context.get('request', None)
+        if request is None or request.user.id != instance.user_id:
+            for field in self.private_fields:
+                data.pop(field, None)
+        return data
@@ -1,4 +1,5 @@
 # -*- coding: utf-8 -*-
+from django.db import transaction
 from rest_framework import serializers
 
 from sigma_chat.models.chat import Chat
@@ -6,8 +7,7 @@ from sigma_chat.models.message import Message
 from sigma_core.models.user import User
 from rest_framework.serializers import ValidationError
 
-import requests
-import json
+from sigma_chat.outbox import enqueue_message
 
 class MessageSerializer(serializers.ModelSerializer):
     """
@@ -33,18 +33,14 @@ class MessageSerializer(serializers.ModelSerializer):
     ################################################################
 
     def save(self, *args, **kwargs):
-        super(MessageSerializer, self).save(*args, **kwargs)
-        """
-        NO_PROXY = {
-            'no': 'pass',
-        }
-        message = {'message': json.dumps({
-                    'chat':{'id': self.data['chat_id']},
-                    'chatmember':{'id': self.data['chatmember_id']},
-                    'text': self.data['text'],
-                    'attachment': self.data['attachment'],
-                    'date': self.data['date']
-                })
-            }
-        requests.post('http://localhost:8000/tornado/chat/?secret_key=', data=message, proxies=NO_PROXY)
-        """
+        # The chat event is published by the outbox dispatcher once the message is committed
+        with transaction.atomic():
+            super(MessageSerializer, self).save(*args, **kwargs)
+            enqueue_message({
+                'id': self.data['id'],
+                'chat': {'id': self.data['chat_id']},
+                'chatmember': {'id': self.data['chatmember_id']},
+                'text': self.data['text'],
+                'attachment': self.data['attachment'],
+                'date': self.data['date']
+            })
@@ -0,0 +1,65 @@
+from django.db.models import F, Q, Max
+from django.db.models.signals import post_save, pre_delete, post_delete
+from django.dispatch import receiver
+
+from sigma_chat.models.chat import Chat
+from sigma_chat.models.chat_member import ChatMember
+from sigma_chat.models.message import Message
+from sigma_chat.outbox import enqueue
+
+
+@receiver(post_save, sender=Message)
+def message_saved(sender, instance, created, **kwargs):
+    if not created:
+        return
+    Chat.objects.filter(pk=instance.chat_id_id).update(last_message=instance)
+    # The sender has read the chat up to his own message
+    ChatMember.objects.filter(pk=instance.chatmember_id_id) \
+        .update(last_read_message=instance, unread_count=0, messages_count=F('messages_count') + 1)
+    ChatMember.objects.filter(chat_id=instance.chat_id_id, is_member=True).exclude(pk=instance.chatmember_id_id) \
+        .update(unread_count=F('unread_count') + 1)
+
+
+@receiver(pre_delete, sender=Message)
+def message_deleted(sender, instance, **kwargs):
+    # Before the read pointers on this message move back: members who had not read it have one less unread message.
+    # Members who joined after it never counted it: their pointer is past it.
+    ChatMember.objects.filter(chat_id=instance.chat_id_id, is_member=True, unread_count__gt=0) \
+        .filter(Q(last_read_message__isnull=True) | Q(last_read_message__lt=instance.id)) \
+        .exclude(pk=instance.chatmember_id_id) \
+        .update(unread_count=F('unread_count') - 1)
+
+
+@receiver(post_delete, sender=Message)
+def message_removed(sender, instance, **kwargs):
+    ChatMember.objects.filter(pk=instance.chatmember_id_id).update(messages_count=F('messages_count') - 1)
+    # If it was the last message of its chat, Chat.last_message has just been set to NULL: point it to the previous one
+    last_id = Message.objects.filter(chat_id=instance.chat_id_id).aggregate(last_id=Max('id'))['last_id']
+    Chat.objects.filter(pk=instance.chat_id_id, last_message__isnull=True).update(last_message=last_id)
+
+
+def enqueue_membership(chatmember, member):
+    # The chat server (un)subscribes the connections of the User to the chat, and updates his tokens
+    enqueue({'type': 'membership', 'user_id': chatmember.user_id, 'chat_id': chatmember.chat_id, 'member': member})
+
+
+@receiver(post_save, sender=ChatMember)
+def chat_member_saved(sender, instance, created, **kwargs):
+    was_member = False if created else getattr(instance, '_loaded_is_member', instance.is_member)
+    if was_member != instance.is_member:
+        delta = 1 if instance.is_member else -1
+        Chat.objects.filter(pk=instance.chat_id).update(members_count=F('members_count') + delta)
+        if instance.is_member:
+            # The messages sent before he (re)joined were not counted as unread for him
+            instance.last_read_message_id = Chat.objects.filter(pk=instance.chat_id).values_list('last_message_id', flat=True).first()
+            instance.unread_count = 0
+            ChatMember.objects.filter(pk=instance.pk).update(last_read_message=instance.last_read_message_id, unread_count=0)
+        enqueue_membership(instance, instance.is_member)
+    instance._loaded_is_member = instance.is_member
+
+
+@receiver(post_delete, sender=ChatMember)
+def chat_member_deleted(sender, instance, **kwargs):
+    if instance.is_member:
+        Chat.objects.filter(pk=instance.chat_id).update(members_count=F('members_count') - 1)
+        enqueue_membership(instance, False)
@@ -0,0 +1,155 @@
+import os
+import tempfile
+
+from django.core.exceptions import ImproperlyConfigured
+from django.test import SimpleTestCase, override_settings
+from rest_framework import status
+from rest_framework.test import APITestCase
+from tornado import gen
+from tornado.testing import AsyncTestCase, gen_test
+
+from sigma_core.tests.factories import UserFactory
+from sigma_chat.tests.factories import ChatFactory, ChatMemberFactory
+from sigma_chat.bus import InProcessBus, UnixSocketBus, ShardedBus, get_bus
+from sigma_chat.outbox import get_dispatcher
+from tornado_chat import ChatBusServer
+
+
+class EventRecorder(object):
+    def __init__(self):
+        self.events = []
+
+    def handle_event(self, event):
+        self.events.append(event)
+
+
+class InProcessBusTests(SimpleTestCase):
+    def test_publish(self):
+        recorder = EventRecorder()
+        bus = InProcessBus(subscribers=[recorder.handle_event])
+        bus.publish({'type': 'token', 'token': 'a'})
+        bus.unsubscribe(recorder.handle_event)
+        bus.publish({'type': 'token', 'token': 'b'})
+        self.assertEqual(recorder.events, [{'type': 'token', 'token': 'a'}])
+
+    def test_publish_without_ioloop(self):
+        # Under runserver or WSGI, no Tornado IOLoop would ever deliver the events
+        bus = InProcessBus(subscribers=[EventRecorder().handle_event], ioloop=True)
+        with self.assertRaises(ImproperlyConfigured):
+            bus.publish({'type': 'token', 'token': 'a'})
+
+    def test_get_bus_from_settings(self):
+        with override_settings(CHAT_BUS={'BACKEND': 'sigma_chat.bus.UnixSocketBus', 'OPTIONS': {'path': '/nonexistent'}}):
+            bus = get_bus()
+            self.assertIsInstance(bus, UnixSocketBus)
+            self.assertIs(get_bus(), bus)
+        self.assertIsInstance(get_bus(), InProcessBus)
+
+
+class ShardedBusTests(SimpleTestCase):
+    def setUp(self):
+        self.bus = ShardedBus('/nonexistent/chat.sock', 4)
+        self.recorders = [EventRecorder() for i in range(4)]
+        for (shard, recorder) in zip(self.bus.shards, self.recorders):
+            shard.publish = recorder.handle_event
+
+    def test_paths(self):
+        self.assertEqual([s.path for s in self.bus.shards], ['/nonexistent/chat.sock.%d' % i for i in range(4)])
+
+    def test_routing(self):
+        self.bus.publish({'type': 'token', 'token': 'a', 'user_id': 42, 'chats': []})
+        self.bus.publish({'type': 'membership', 'user_id': 42, 'chat_id': 1, 'member': False})
+        self.bus.publish({'type': 'message', 'message': {}})
+        shard = self.bus.shard_for(42)
+        for (i, recorder) in enumerate(self.recorders):
+            self.assertEqual([e['type'] for e in recorder.events], ['token', 'membership', 'message'] if i == shard else ['message'])
+
+
+class UnixSocketBusTests(AsyncTestCase):
+    def setUp(self):
+        super(UnixSocketBusTests, self).setUp()
+        self.path = os.path.join(tempfile.mkdtemp(), 'chat.sock')
+        self.recorder = EventRecorder()
+        self.server = ChatBusServer(self.recorder)
+        self.server.listen_unix(self.path)
+
+    def tearDown(self):
+        self.server.stop()
+        os.remove(self.path)
+        super(UnixSocketBusTests, self).tearDown()
+
+    @gen.coroutine
+    def wait_events(self, n):
+        while len(self.recorder.events) < n:
+            yield gen.sleep(0.01)
+
+    @gen_test
+    def test_publish_over_socket(self):
+        bus = UnixSocketBus(self.path)
+        for i in range(100):
+            bus.publish({'type': 'message', 'message': {'id': i, 'text': 'é\n'}})
+        yield self.wait_events(100)
+        self.assertEqual([e['message']['id'] for e in self.recorder.events], list(range(100)))
+        self.assertEqual(self.recorder.events[0]['message']['text'], 'é\n')
+
+    def test_publish_never_blocks(self):
+        bus = UnixSocketBus('/nonexistent/chat.sock', max_queue=1)
+        for i in range(10):
+            bus.publish({'type': 'message', 'message': {'id': i}})
+
+
+class ChatBusPublishTests(APITestCase):
+    def setUp(self):
+        super(ChatBusPublishTests, self).setUp()
+        self.user = UserFactory()
+        self.chats = ChatFactory.create_batch(2)
+        self.chatmember = ChatMemberFactory(is_creator=True, is_admin=True, chat=self.chats[0], user=self.user)
+        ChatMemberFactory(is_creator=False, is_admin=False, is_member=False, chat=self.chats[1], user=self.user)
+        self.recorder = EventRecorder()
+        self.settings = override_settings(CHAT_BUS={'OPTIONS': {'subscribers': [self.recorder.handle_event]}})
+        self.settings.enable()
+        # Membership events of the fixtures
+        get_dispatcher().dispatch_pending()
+        self.recorder.events = []
+
+    def tearDown(self):
+        self.settings.disable()
+        super(ChatBusPublishTests, self).tearDown()
+
+    def test_send_message_publishes(self):
+        self.client.force_authenticate(user=self.user)
+        response = self.client.post('/chatmember/%d/send_message/' % self.chatmember.id, {'text': 'hello'})
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        # Published by the outbox dispatcher, once committed
+        self.assertEqual(self.recorder.events, [])
+        self.assertEqual(get_dispatcher().dispatch_pending(), 1)
+        self.assertEqual(len(self.recorder.events), 1)
+        event = self.recorder.events[0]
+        self.assertEqual(event['type'], 'message')
+        self.assertEqual(event['message']['id'], response.data['id'])
+        self.assertEqual(event['message']['chat'], {'id': self.chats[0].id})
+        self.assertEqual(event['message']['text'], 'hello')
+
+    def test_membership_published(self):
+        other = ChatMemberFactory(is_creator=False, is_admin=False, chat=self.chats[0])
+        get_dispatcher().dispatch_pending()
+        self.assertEqual(self.recorder.events, [{'type': 'membership', 'user_id': other.user_id, 'chat_id': self.chats[0].id, 'member': True}])
+        self.client.force_authenticate(user=self.user)
+        response = self.client.put('/chat/%d/change_role/' % self.chats[0].id, {'chatmember_id': other.id, 'role': 'banned'})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        get_dispatcher().dispatch_pending()
+        self.assertEqual(self.recorder.events[-1], {'type': 'membership', 'user_id': other.user_id, 'chat_id': self.chats[0].id, 'member': False})
+
+    def test_ws_token(self):
+        self.client.force_authenticate(user=self.user)
+        response = self.client.post('/chat/ws_token/')
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(self.recorder.events, [{'type': 'token', 'token': response.data['token'], 'user_id': self.user.id, 'chats': [self.chats[0].id]}])
+        self.assertEqual(response.data['shard'], 0)
+
+    def test_revoke_ws_token(self):
+        self.client.force_authenticate(user=self.user)
+        response = self.client.post('/chat/revoke_ws_token/', {'token': 'abc'})
+        self.assertEqual(response.status_code, status.HTTP_204_NO_CONTENT)
+        self.assertEqual(self.recorder.events, [{'type': 'revoke_token', 'token': 'abc', 'user_id': self.user.id}])
+        self.assertEqual(self.client.post('/chat/revoke_ws_token/').status_code, status.HTTP_400_BAD_REQUEST)
@@ -3,7 +3,7 @@ from rest_framework.test import APITestCase, force_authenticate
 
 from sigma_core.tests.factories import UserFactory, AdminUserFactory
 
-from sigma_chat.tests.factories import ChatFactory, ChatMemberFactory
+from sigma_chat.tests.factories import ChatFactory, ChatMemberFactory, MessageFactory
 
 from sigma_chat.models.chat import Chat
 from sigma_chat.serializers.chat import ChatSerializer
@@ -51,21 +51,21 @@ class ChatTests(APITestCase):
         self.client.force_authenticate(user=self.users[1])
         response = self.client.get(self.chats_url)
         self.assertEqual(response.status_code, status.HTTP_200_OK)
-        self.assertEqual(len(response.data), 0)
+        self.assertEqual(len(response.data['results']), 0)
 
     def test_get_chats_list_creator(self):
         # Client authenticated and can see limited list of chats
         self.client.force_authenticate(user=self.chats[0].chatmember.get(pk=1).user)
         response = self.client.get(self.chats_url)
         self.assertEqual(response.status_code, status.HTTP_200_OK)
-        self.assertEqual(len(response.data), 1)
+        self.assertEqual(len(response.data['results']), 1)
 
     def test_get_chats_list_admin(self):
         # Client authenticated and can see limited list of chats
         self.client.force_authenticate(user=self.users[-1])
         response = self.client.get(self.chats_url)
         self.assertEqual(response.status_code, status.HTTP_200_OK)
-        self.assertEqual(len(response.data), 0)
+        self.assertEqual(len(response.data['results']), 0)
 
 #### Get requests
     def test_get_chat_unauthed(self):
@@ -78,7 +78,7 @@ class ChatTests(APITestCase):
         self.client.force_authenticate(user=self.users[0])
         response = self.client.get(self.chat_url % self.chats[0].id)
         self.assertEqual(response.status_code, status.HTTP_200_OK)
-        self.assertEqual(len(response.data), 2)
+        self.assertEqual(len(response.data), 5)
 
     def test_get_chat_not_member(self):
         # Client cannot see chat if he's not a member
@@ -125,3 +125,57 @@ class ChatTests(APITestCase):
         # Guarantee independance of tests
         self.chats[0].name = old_name
         self.chats[0].save()
+
+
+class ChatSummaryTests(APITestCase):
+    def setUp(self):
+        # Summary: 3 users, 3 chats
+        # User #1 is member of all chats, user #2 of chat #1, user #3 left chat #1
+        # Chat #i has i messages from user #1, and one from user #2 in chat #1
+        super(ChatSummaryTests, self).setUp()
+        self.users = UserFactory.create_batch(3)
+        self.chats = ChatFactory.create_batch(3)
+        self.chatmembers = [ChatMemberFactory(is_creator=True, is_admin=True, chat=c, user=self.users[0]) for c in self.chats]
+        self.chatmembers.append(ChatMemberFactory(chat=self.chats[0], user=self.users[1]))
+        self.chatmembers.append(ChatMemberFactory(chat=self.chats[0], user=self.users[2], is_member=False))
+        self.messages = [[MessageFactory(chat_id=c, chatmember_id=self.chatmembers[i]) for _ in range(i + 1)] for (i, c) in enumerate(self.chats)]
+        self.messages[0].append(MessageFactory(chat_id=self.chats[0], chatmember_id=self.chatmembers[3]))
+
+        self.chats_url = "/chat/"
+
+    def test_model_members_count(self):
+        self.assertEqual([reload(c).members_count for c in self.chats], [2, 1, 1])
+        self.chatmembers[4].is_member = True
+        self.chatmembers[4].save()
+        self.assertEqual(reload(self.chats[0]).members_count, 3)
+        cm = reload(self.chatmembers[3])
+        cm.is_member = False
+        cm.save()
+        cm.save()
+        self.assertEqual(reload(self.chats[0]).members_count, 2)
+        self.chatmembers[4].delete()
+        self.assertEqual(reload(self.chats[0]).members_count, 1)
+
+    def test_model_last_message(self):
+        self.assertEqual([reload(c).last_message_id for c in self.chats], [m[-1].id for m in self.messages])
+        self.messages[0][1].delete()
+        self.assertEqual(reload(self.chats[0]).last_message_id, self.messages[0][0].id)
+        self.messages[0][0].delete()
+        self.assertIsNone(reload(self.chats[0]).last_message_id)
+
+    def test_get_list_constant_queries(self):
+        self.client.force_authenticate(user=self.users[0])
+        with self.assertNumQueries(1):
+            response = self.client.get(self.chats_url)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        chats = {c['id']: c for c in response.data['results']}
+        self.assertEqual(len(chats), 3)
+        self.assertEqual(chats[self.chats[0].id]['last_message']['id'], self.messages[0][-1].id)
+        self.assertEqual(chats[self.chats[0].id]['members_count'], 2)
+        self.assertEqual(chats[self.chats[0].id]['unread_count'], 1)
+        self.assertEqual(chats[self.chats[2].id]['unread_count'], 0)
+
+    def test_get_list_unread_of_caller(self):
+        self.client.force_authenticate(user=self.users[1])
+        response = self.client.get(self.chats_url)
+        self.assertEqual([(c['id'], c['unread_count']) for c in response.data['results']], [(self.chats[0].id, 0)])
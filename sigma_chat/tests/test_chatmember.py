@@ -3,7 +3,7 @@ from rest_framework.test import APITestCase, force_authenticate
 
 from sigma_core.tests.factories import UserFactory, AdminUserFactory
 
-from sigma_chat.tests.factories import ChatFactory, ChatMemberFactory
+from sigma_chat.tests.factories import ChatFactory, ChatMemberFactory, MessageFactory
 
 from sigma_chat.models.chat_member import ChatMember
 
@@ -75,35 +75,35 @@ class ChatMemberTests(APITestCase):
         self.client.force_authenticate(user=self.users[0])
         response = self.client.get(self.chatmembers_url)
         self.assertEqual(response.status_code, status.HTTP_200_OK)
-        self.assertEqual(len(response.data), 5)
+        self.assertEqual(len(response.data['results']), 5)
 
     def test_get_chatmembers_list_limited2(self):
         # Client authenticated and can see limited list of chatmembers
         self.client.force_authenticate(user=self.users[1])
         response = self.client.get(self.chatmembers_url)
         self.assertEqual(response.status_code, status.HTTP_200_OK)
-        self.assertEqual(len(response.data), 1)
+        self.assertEqual(len(response.data['results']), 1)
 
     def test_get_chatmembers_list_limited3(self):
         # Client authenticated and can see limited list of chatmembers
         self.client.force_authenticate(user=self.users[2])
         response = self.client.get(self.chatmembers_url)
         self.assertEqual(response.status_code, status.HTTP_200_OK)
-        self.assertEqual(len(response.data), 5)
+        self.assertEqual(len(response.data['results']), 5)
 
     def test_get_chatmembers_list_limited4(self):
         # Client authenticated and can see limited list of chatmembers
         self.client.force_authenticate(user=self.users[6])
         response = self.client.get(self.chatmembers_url)
         self.assertEqual(response.status_code, status.HTTP_200_OK)
-        self.assertEqual(len(response.data), 0)
+        self.assertEqual(len(response.data['results']), 0)
 
     def test_get_chatmembers_list_admin(self):
         # Admin authenticated and can see limited list of chatmembers
         self.client.force_authenticate(user=self.users[-1])
         response = self.client.get(self.chatmembers_url)
         self.assertEqual(response.status_code, status.HTTP_200_OK)
-        self.assertEqual(len(response.data), 0)
+        self.assertEqual(len(response.data['results']), 0)
 
 #### Get requests
     def test_get_chatmember_unauthed(self):
@@ -116,7 +116,7 @@ class ChatMemberTests(APITestCase):
         self.client.force_authenticate(user=self.users[0])
         response = self.client.get(self.chatmember_url % self.chatmembers[0].id)
         self.assertEqual(response.status_code, status.HTTP_200_OK)
-        self.assertEqual(len(response.data), 8) # ChatMember has 8 fields
+        self.assertEqual(len(response.data), 10) # ChatMember has 10 fields
 
     def test_get_chatmember_not_self(self):
         # Client cannot see chatmember if he's not a member of the chat it belongs to
@@ -300,3 +300,49 @@ class ChatMemberTests(APITestCase):
         self.assertFalse(reload(self.chatmembers[4]).is_admin)
         self.assertTrue(reload(self.chatmembers[4]).is_member)
         self.assertFalse(reload(self.chatmembers[4]).is_banned)
+
+
+class ChatMemberMessagesTests(APITestCase):
+    def setUp(self):
+        # Summary: 3 users, 1 chat
+        # Users #1 and #2 are members of chat #1, user #1 sent 5 messages, user #2 sent 1 message
+        # User #3 is not member of chat #1
+        super(ChatMemberMessagesTests, self).setUp()
+        self.users = UserFactory.create_batch(3)
+        self.chat = ChatFactory()
+        self.chatmembers = [
+            ChatMemberFactory(is_creator=True, is_admin=True, chat=self.chat, user=self.users[0]),
+            ChatMemberFactory(chat=self.chat, user=self.users[1]),
+        ]
+        self.messages = [MessageFactory(chat_id=self.chat, chatmember_id=self.chatmembers[0]) for i in range(5)]
+        MessageFactory(chat_id=self.chat, chatmember_id=self.chatmembers[1])
+
+        self.chatmembers_url = "/chatmember/"
+        self.messages_url = "/chatmember/%d/messages/"
+
+    def test_model_messages_count(self):
+        self.assertEqual(reload(self.chatmembers[0]).messages_count, 5)
+        self.messages[0].delete()
+        self.assertEqual(reload(self.chatmembers[0]).messages_count, 4)
+        self.assertEqual(reload(self.chatmembers[1]).messages_count, 1)
+
+    def test_get_list_constant_queries(self):
+        self.client.force_authenticate(user=self.users[1])
+        with self.assertNumQueries(1):
+            response = self.client.get(self.chatmembers_url)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual({m['id']: m['messages_count'] for m in response.data['results']}, {self.chatmembers[0].id: 5, self.chatmembers[1].id: 1})
+
+    def test_get_messages_paged(self):
+        self.client.force_authenticate(user=self.users[1])
+        response = self.client.get(self.messages_url % self.chatmembers[0].id, {'page_size': 3})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual([m['id'] for m in response.data['results']], [m.id for m in reversed(self.messages[2:])])
+        response = self.client.get(response.data['next'])
+        self.assertEqual([m['id'] for m in response.data['results']], [m.id for m in reversed(self.messages[:2])])
+        self.assertIsNone(response.data['next'])
+
+    def test_get_messages_not_member(self):
+        self.client.force_authenticate(user=self.users[2])
+        response = self.client.get(self.messages_url % self.chatmembers[0].id)
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
@@ -75,35 +75,53 @@ class MessageTests(APITestCase):
         self.client.force_authenticate(user=self.users[0])
         response = self.client.get(self.messages_url)
         self.assertEqual(response.status_code, status.HTTP_200_OK)
-        self.assertEqual(len(response.data), 4)
+        self.assertEqual(len(response.data['results']), 4)
 
     def test_get_messages_list_limited2(self):
         # Client authenticated and can see limited list of messages
         self.client.force_authenticate(user=self.users[1])
         response = self.client.get(self.messages_url)
         self.assertEqual(response.status_code, status.HTTP_200_OK)
-        self.assertEqual(len(response.data), 2)
+        self.assertEqual(len(response.data['results']), 2)
 
     def test_get_messages_list_limited3(self):
         # Client authenticated and can see limited list of messages
         self.client.force_authenticate(user=self.users[2])
         response = self.client.get(self.messages_url)
         self.assertEqual(response.status_code, status.HTTP_200_OK)
-        self.assertEqual(len(response.data), 2)
+        self.assertEqual(len(response.data['results']), 2)
 
     def test_get_messages_list_limited4(self):
         # Client authenticated and can see limited list of messages
         self.client.force_authenticate(user=self.users[3])
         response = self.client.get(self.messages_url)
         self.assertEqual(response.status_code, status.HTTP_200_OK)
-        self.assertEqual(len(response.data), 0)
+        self.assertEqual(len(response.data['results']), 0)
 
     def test_get_messages_list_admin(self):
         # Admin authenticated and can see limited list of messages
         self.client.force_authenticate(user=self.users[-1])
         response = self.client.get(self.messages_url)
         self.assertEqual(response.status_code, status.HTTP_200_OK)
-        self.assertEqual(len(response.data), 0)
+        self.assertEqual(len(response.data['results']), 0)
+
+    def test_get_messages_list_paginated(self):
+        # Messages are paged with a cursor, newest first
+        self.client.force_authenticate(user=self.users[0])
+        response = self.client.get(self.messages_url + "?page_size=3")
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual([m['id'] for m in response.data['results']], [m.id for m in reversed(self.messages[1:])])
+        self.assertIsNone(response.data['previous'])
+        response = self.client.get(response.data['next'])
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual([m['id'] for m in response.data['results']], [self.messages[0].id])
+        self.assertIsNone(response.data['next'])
+
+    def test_get_messages_list_page_size_bounded(self):
+        self.client.force_authenticate(user=self.users[0])
+        response = self.client.get(self.messages_url + "?page_size=100000")
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(len(response.data['results']), 4)
 
 #### Get requests
     def test_get_message_unauthed(self):
@@ -176,3 +194,65 @@ class MessageTests(APITestCase):
         response = self.client.put(self.message_url % self.messages[0].id, {'text': "new_text"})
         self.assertEqual(response.status_code, status.HTTP_403_FORBIDDEN)
         self.assertEqual(reload(self.messages[0]), self.messages[0])
+
+
+class MessageHistoryTests(APITestCase):
+    def setUp(self):
+        # Summary: 2 users, 2 chats
+        # User #1 is member of chat #1 which has 10 messages, user #2 left chat #1
+        # Messages #5 to #7 have the same date
+        super(MessageHistoryTests, self).setUp()
+        self.users = UserFactory.create_batch(2)
+        self.chats = ChatFactory.create_batch(2)
+        self.chatmember = ChatMemberFactory(is_creator=True, is_admin=True, chat=self.chats[0], user=self.users[0])
+        ChatMemberFactory(is_creator=False, is_admin=False, is_member=False, chat=self.chats[0], user=self.users[1])
+        self.messages = [MessageFactory(chat_id=self.chats[0], chatmember_id=self.chatmember) for i in range(10)]
+        Message.objects.filter(pk__in=[m.pk for m in self.messages[4:7]]).update(date=self.messages[4].date)
+        MessageFactory(chat_id=self.chats[1], chatmember_id=ChatMemberFactory(is_creator=True, is_admin=True, chat=self.chats[1], user=self.users[1]))
+
+        self.history_url = '/chat/%d/history/' % self.chats[0].id
+
+    def ids(self, response):
+        return [m['id'] for m in response.data['results']]
+
+    def test_get_history_newest(self):
+        self.client.force_authenticate(user=self.users[0])
+        response = self.client.get(self.history_url, {'limit': 3})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(self.ids(response), [m.id for m in self.messages[7:]])
+        self.assertTrue(response.data['has_more'])
+
+    def test_get_history_before(self):
+        self.client.force_authenticate(user=self.users[0])
+        response = self.client.get(self.history_url, {'before': self.messages[6].id, 'limit': 4})
+        self.assertEqual(self.ids(response), [m.id for m in self.messages[2:6]])
+        self.assertTrue(response.data['has_more'])
+        response = self.client.get(self.history_url, {'before': self.messages[2].id, 'limit': 4})
+        self.assertEqual(self.ids(response), [m.id for m in self.messages[:2]])
+        self.assertFalse(response.data['has_more'])
+
+    def test_get_history_after(self):
+        self.client.force_authenticate(user=self.users[0])
+        response = self.client.get(self.history_url, {'after': self.messages[4].id, 'limit': 4})
+        self.assertEqual(self.ids(response), [m.id for m in self.messages[5:9]])
+        self.assertTrue(response.data['has_more'])
+
+    def test_get_history_after_edit(self):
+        # Editing a message keeps its date, hence its place in the history
+        self.messages[2].text = 'Edited'
+        self.messages[2].save()
+        self.client.force_authenticate(user=self.users[0])
+        response = self.client.get(self.history_url, {'before': self.messages[4].id, 'limit': 4})
+        self.assertEqual(self.ids(response), [m.id for m in self.messages[:4]])
+
+    def test_get_history_bad_requests(self):
+        self.client.force_authenticate(user=self.users[0])
+        self.assertEqual(self.client.get(self.history_url, {'before': 'x'}).status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(self.client.get(self.history_url, {'before': 1, 'after': 1}).status_code, status.HTTP_400_BAD_REQUEST)
+        other_chat_message = Message.objects.get(chat_id=self.chats[1])
+        self.assertEqual(self.client.get(self.history_url, {'before': other_chat_message.id}).status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_get_history_not_member(self):
+        self.client.force_authenticate(user=self.users[1])
+        response = self.client.get(self.history_url)
+        self.assertEqual(response.status_code, status.HTTP_403_FORBIDDEN)
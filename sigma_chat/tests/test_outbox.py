@@ -0,0 +1,110 @@
+import json
+import os
+import socket
+import tempfile
+from datetime import timedelta
+
+from django.test import TestCase, override_settings
+from django.utils import timezone
+
+from sigma_chat.models.outbox import OutboxEvent
+from sigma_chat.outbox import OutboxDispatcher, enqueue
+
+
+class EventRecorder(object):
+    def __init__(self, fail_on=None):
+        self.events = []
+        self.fail_on = fail_on
+
+    def handle_event(self, event):
+        if event.get('n') == self.fail_on:
+            raise ValueError("Chat server down")
+        self.events.append(event)
+
+
+class OutboxDispatcherTests(TestCase):
+    def setUp(self):
+        self.recorder = EventRecorder(fail_on=2)
+        self.settings = override_settings(CHAT_BUS={'OPTIONS': {'subscribers': [self.recorder.handle_event]}})
+        self.settings.enable()
+        self.dispatcher = OutboxDispatcher(batch_size=2, retry_after=30)
+        for n in range(5):
+            enqueue({'type': 'message', 'n': n})
+
+    def tearDown(self):
+        self.settings.disable()
+
+    def test_dispatch_in_order(self):
+        self.assertEqual(self.dispatcher.dispatch_pending(), 5)
+        self.assertEqual([e['n'] for e in self.recorder.events], [0, 1, 3, 4])
+        stats = OutboxEvent.objects.stats()
+        self.assertEqual((stats['dispatched'], stats['failed']), (4, 1))
+        # The failed event stays claimed until retry_after
+        self.assertEqual(OutboxEvent.objects.pending().count(), 1)
+        self.assertEqual(self.dispatcher.dispatch_pending(), 0)
+        OutboxEvent.objects.update(claimed_at=timezone.now() - timedelta(seconds=31))
+        self.recorder.fail_on = None
+        self.assertEqual(self.dispatcher.dispatch_pending(), 1)
+        self.assertEqual(self.recorder.events[-1]['n'], 2)
+        self.assertEqual(OutboxEvent.objects.pending().count(), 0)
+
+    def test_purge(self):
+        self.dispatcher.dispatch_pending()
+        self.assertEqual(self.dispatcher.purge(), 0)
+        OutboxEvent.objects.filter(dispatched_at__isnull=False).update(dispatched_at=timezone.now() - timedelta(seconds=3601))
+        self.assertEqual(self.dispatcher.purge(), 4)
+        self.assertEqual(OutboxEvent.objects.count(), 1)
+
+    def test_claimed_events_skipped(self):
+        OutboxEvent.objects.filter(pk__in=OutboxEvent.objects.order_by('id').values_list('id', flat=True)[:3]) \
+            .update(claimed_by='other', claimed_at=timezone.now())
+        self.assertEqual(self.dispatcher.dispatch_pending(), 2)
+        self.assertEqual([e['n'] for e in self.recorder.events], [3, 4])
+
+    def test_lag(self):
+        OutboxEvent.objects.filter(pk=OutboxEvent.objects.order_by('id')[0].pk).update(created=timezone.now() - timedelta(seconds=10))
+        pending, lag = OutboxEvent.objects.lag()
+        self.assertEqual(pending, 5)
+        self.assertGreaterEqual(lag, 10)
+        self.dispatcher.dispatch_pending()
+        # Computed from the table: the same for the dispatchers of every process
+        stats = OutboxEvent.objects.stats()
+        self.assertEqual((stats['pending'], stats['dispatched']), (1, 4))
+        self.assertGreaterEqual(stats['latency_max'], 10)
+
+
+class OutboxBusDownTests(TestCase):
+    def setUp(self):
+        self.path = os.path.join(tempfile.mkdtemp(), 'chat.sock')
+        self.settings = override_settings(CHAT_BUS={'BACKEND': 'sigma_chat.bus.UnixSocketBus', 'OPTIONS': {'path': self.path}})
+        self.settings.enable()
+        self.dispatcher = OutboxDispatcher(retry_after=30, send_timeout=1)
+        for n in range(3):
+            enqueue({'type': 'message', 'n': n})
+
+    def tearDown(self):
+        self.settings.disable()
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+    def test_bus_down(self):
+        # No chat server: nothing is marked dispatched, and the events are sent again later
+        self.dispatcher.dispatch_pending()
+        self.assertEqual(OutboxEvent.objects.pending().count(), 3)
+        self.assertEqual(OutboxEvent.objects.stats()['failed'], 3)
+
+        server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        server.bind(self.path)
+        server.listen(1)
+        try:
+            OutboxEvent.objects.update(claimed_at=timezone.now() - timedelta(seconds=31))
+            self.assertEqual(self.dispatcher.dispatch_pending(), 3)
+            self.assertEqual(OutboxEvent.objects.pending().count(), 0)
+            conn, _ = server.accept()
+            data = b''
+            while data.count(b'\n') < 3:
+                data += conn.recv(4096)
+            conn.close()
+        finally:
+            server.close()
+        self.assertEqual([json.loads(line.decode('utf-8'))['n'] for line in data.splitlines()], [0, 1, 2])
@@ -0,0 +1,123 @@
+from rest_framework import status
+from rest_framework.test import APITestCase
+
+from sigma_core.tests.factories import UserFactory
+
+from sigma_chat.tests.factories import ChatFactory, ChatMemberFactory, MessageFactory
+
+from sigma_chat.models.chat_member import ChatMember
+
+
+def reload(obj):
+    return obj.__class__.objects.get(pk=obj.pk)
+
+
+class ReadStateTests(APITestCase):
+    def setUp(self):
+        # Summary: 3 users, 2 chats
+        # Users #1, #2 and #3 are members of chat #1, user #3 left it
+        # User #1 is member of chat #2
+        # User #2 sent 3 messages to chat #1
+        super(ReadStateTests, self).setUp()
+        self.users = UserFactory.create_batch(3)
+        self.chats = ChatFactory.create_batch(2)
+        self.chatmembers = [
+            ChatMemberFactory(is_creator=True, is_admin=True, chat=self.chats[0], user=self.users[0]),
+            ChatMemberFactory(chat=self.chats[0], user=self.users[1]),
+            ChatMemberFactory(chat=self.chats[0], user=self.users[2], is_member=False),
+            ChatMemberFactory(is_creator=True, is_admin=True, chat=self.chats[1], user=self.users[0]),
+        ]
+        self.messages = [MessageFactory(chat_id=self.chats[0], chatmember_id=self.chatmembers[1]) for i in range(3)]
+
+        self.unread_url = '/chat/unread/'
+        self.mark_read_url = '/chat/%d/mark_read/'
+
+#### Counter maintenance
+    def test_unread_after_send(self):
+        self.assertEqual(reload(self.chatmembers[0]).unread_count, 3)
+        self.assertEqual(reload(self.chatmembers[1]).unread_count, 0)
+        self.assertEqual(reload(self.chatmembers[1]).last_read_message_id, self.messages[2].id)
+        self.assertEqual(reload(self.chatmembers[2]).unread_count, 0)
+
+    def test_unread_after_delete(self):
+        reload(self.chatmembers[0]).mark_read(self.messages[0])
+        self.messages[0].delete()
+        self.messages[2].delete()
+        self.assertEqual(reload(self.chatmembers[0]).unread_count, 1)
+        self.assertEqual(reload(self.chatmembers[1]).unread_count, 0)
+
+    def test_delete_last_read_message(self):
+        reload(self.chatmembers[0]).mark_read(self.messages[1])
+        self.messages[1].delete()
+        # The read pointer moves back to the previous message, and message #3 is still unread
+        self.assertEqual(reload(self.chatmembers[0]).last_read_message_id, self.messages[0].id)
+        self.assertEqual(reload(self.chatmembers[0]).unread_count, 1)
+        self.messages[0].delete()
+        self.assertIsNone(reload(self.chatmembers[0]).last_read_message_id)
+
+    def test_unread_after_join(self):
+        # User #3 rejoins: the messages sent before do not count for him, even when deleted
+        chatmember = reload(self.chatmembers[2])
+        chatmember.is_member = True
+        chatmember.save()
+        self.assertEqual(reload(chatmember).last_read_message_id, self.messages[2].id)
+        MessageFactory(chat_id=self.chats[0], chatmember_id=self.chatmembers[1])
+        self.messages[0].delete()
+        self.assertEqual(reload(chatmember).unread_count, 1)
+
+    def test_mark_read(self):
+        chatmember = reload(self.chatmembers[0])
+        self.assertTrue(chatmember.mark_read(self.messages[1]))
+        self.assertEqual(reload(chatmember).unread_count, 1)
+        self.assertFalse(chatmember.mark_read(self.messages[0]))
+        self.assertTrue(chatmember.mark_read())
+        self.assertEqual(reload(chatmember).unread_count, 0)
+        self.assertEqual(reload(chatmember).last_read_message_id, self.messages[2].id)
+
+#### Endpoints
+    def test_get_unread_constant_queries(self):
+        self.client.force_authenticate(user=self.users[0])
+        with self.assertNumQueries(1):
+            response = self.client.get(self.unread_url)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual({m['chat_id']: m['unread_count'] for m in response.data}, {self.chats[0].id: 3, self.chats[1].id: 0})
+
+    def test_mark_read_ok(self):
+        self.client.force_authenticate(user=self.users[0])
+        response = self.client.post(self.mark_read_url % self.chats[0].id, {'message_id': self.messages[0].id})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data['unread_count'], 2)
+        response = self.client.post(self.mark_read_url % self.chats[0].id)
+        self.assertEqual(response.data['unread_count'], 0)
+
+    def test_mark_read_backwards(self):
+        self.client.force_authenticate(user=self.users[0])
+        self.client.post(self.mark_read_url % self.chats[0].id)
+        response = self.client.post(self.mark_read_url % self.chats[0].id, {'message_id': self.messages[0].id})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_mark_read_invalid_ids(self):
+        self.client.force_authenticate(user=self.users[0])
+        response = self.client.post('/chat/x/mark_read/')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        response = self.client.post(self.mark_read_url % self.chats[0].id, {'message_id': 'x'})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_read_state_private(self):
+        self.client.force_authenticate(user=self.users[0])
+        response = self.client.get('/chatmember/%d/' % self.chatmembers[1].id)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertNotIn('unread_count', response.data)
+        self.assertNotIn('last_read_message', response.data)
+        response = self.client.get('/chatmember/%d/' % self.chatmembers[0].id)
+        self.assertEqual(response.data['unread_count'], 3)
+
+    def test_mark_read_not_member(self):
+        self.client.force_authenticate(user=self.users[2])
+        response = self.client.post(self.mark_read_url % self.chats[0].id)
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_mark_read_message_of_other_chat(self):
+        self.client.force_authenticate(user=self.users[0])
+        response = self.client.post(self.mark_read_url % self.chats[1].id, {'message_id': self.messages[0].id})
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
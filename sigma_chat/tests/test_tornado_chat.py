@@ -0,0 +1,524 @@
+import json
+
+from django.test import SimpleTestCase
+from tornado.concurrent import Future
+from tornado.testing import AsyncHTTPTestCase
+from tornado.web import Application
+
+from sigma_chat.management.commands.bench_chat_fanout import bench_connection
+from tornado_chat import TokenRegistry, ConnectionRegistry, ChatHandler, EncodedEvent, PresenceHandler, OutboundQueue, ChatMetrics, MetricsHandler, HashRing, ReplayRegistry
+
+
+class FakeClock(object):
+    def __init__(self):
+        self.now = 0
+
+    def __call__(self):
+        return self.now
+
+
+class FakeConnection(object):
+    def __init__(self):
+        self.messages = []
+        self.closed = False
+
+    def send_encoded(self, encoded):
+        self.messages.append(json.loads(encoded.payload.decode('utf-8')))
+
+    def close(self, *args, **kwargs):
+        self.closed = True
+
+
+class TokenRegistryTests(SimpleTestCase):
+    def setUp(self):
+        self.clock = FakeClock()
+        self.tokens = TokenRegistry(ttl=10, clock=self.clock)
+
+    def test_add_get_remove(self):
+        self.tokens.add('a', 1, [3, 4])
+        entry = self.tokens.get('a')
+        self.assertEqual((entry.user_id, entry.chats), (1, {3, 4}))
+        self.assertIsNone(self.tokens.get('b'))
+        self.assertEqual(self.tokens.remove('a').user_id, 1)
+        self.assertNotIn('a', self.tokens)
+        self.assertIsNone(self.tokens.remove('a'))
+
+    def test_expiry(self):
+        self.tokens.add('a', 1)
+        self.clock.now = 5
+        self.tokens.add('b', 2)
+        self.clock.now = 10
+        self.assertNotIn('a', self.tokens)
+        self.assertIn('b', self.tokens)
+        self.assertEqual(len(self.tokens), 1)
+
+    def test_readd_refreshes_expiry(self):
+        self.tokens.add('a', 1)
+        self.clock.now = 5
+        self.tokens.add('b', 2)
+        self.tokens.add('a', 1)
+        self.clock.now = 12
+        self.assertEqual(self.tokens.purge(), 0)
+        self.clock.now = 15
+        self.assertEqual(self.tokens.purge(), 2)
+        self.assertEqual(len(self.tokens), 0)
+
+    def test_set_member(self):
+        self.tokens.add('a', 1, [3])
+        self.tokens.add('b', 1, [3, 4])
+        self.tokens.add('c', 2, [3])
+        self.tokens.set_member(1, 3, False)
+        self.tokens.set_member(1, 5, True)
+        self.assertEqual([self.tokens.get(t).chats for t in 'abc'], [{5}, {4, 5}, {3}])
+        self.clock.now = 10
+        self.assertEqual(self.tokens.purge(), 3)
+        self.tokens.set_member(1, 3, True)
+        self.assertEqual(self.tokens._users, {})
+
+    def test_add_purges_expired(self):
+        for i in range(100):
+            self.tokens.add(i, i)
+        self.clock.now = 10
+        self.tokens.add('a', 1)
+        self.assertEqual(len(self.tokens), 1)
+
+
+class ConnectionRegistryTests(SimpleTestCase):
+    def setUp(self):
+        self.registry = ConnectionRegistry()
+        self.conns = [FakeConnection() for i in range(3)]
+
+    def test_several_connections_per_user(self):
+        r, c = self.registry, self.conns
+        self.assertTrue(r.add(1, c[0], [10, 11]))
+        self.assertFalse(r.add(1, c[1], [10, 11]))
+        self.assertTrue(r.add(2, c[2], [11]))
+        self.assertEqual(set(r.chat_connections(10)), {c[0], c[1]})
+        self.assertEqual(set(r.chat_connections(11)), set(c))
+
+        self.assertFalse(r.remove(1, c[0]))
+        self.assertTrue(r.is_online(1))
+        self.assertTrue(r.remove(1, c[1]))
+        self.assertFalse(r.is_online(1))
+        self.assertEqual(list(r.chat_connections(10)), [])
+        self.assertEqual(set(r.chat_connections(11)), {c[2]})
+
+    def test_chats_per_connection(self):
+        r, c = self.registry, self.conns
+        r.add(1, c[0], [10])
+        r.add(1, c[1], [10, 11])
+        self.assertEqual(r.chats(1), {10, 11})
+        self.assertEqual(set(r.chat_connections(10)), {c[0], c[1]})
+        self.assertEqual(set(r.chat_connections(11)), {c[1]})
+
+        r.remove(1, c[1])
+        self.assertEqual(r.chats(1), {10})
+        self.assertEqual(list(r.chat_connections(11)), [])
+        self.assertEqual(r.chat_users(11), set())
+
+    def test_remove_unknown(self):
+        self.assertFalse(self.registry.remove(1, self.conns[0]))
+        self.registry.add(1, self.conns[0])
+        self.assertFalse(self.registry.remove(1, self.conns[1]))
+        self.assertEqual(len(self.registry), 1)
+
+
+class ChatHandlerTests(SimpleTestCase):
+    def setUp(self):
+        self.ch = ChatHandler(presence_window=0)
+        self.ch.add_potential_client({'token': 'a', 'user_id': 1, 'chats': [10]})
+        self.ch.add_potential_client({'token': 'b', 'user_id': 2, 'chats': [10]})
+        self.conns = [FakeConnection() for i in range(3)]
+
+    def connect(self, token, conn):
+        self.ch.add_client_wsconn(self.ch.tokens.get(token), conn)
+
+    def test_presence_messages(self):
+        c = self.conns
+        self.connect('a', c[0])
+        self.connect('b', c[1])
+        self.connect('b', c[2])
+        # Only the first connection of User #2 is announced
+        self.assertEqual(c[0].messages, [{'msgtype': 'presence', 'online': [2], 'offline': []}])
+        self.assertEqual(c[1].messages, [])
+
+        self.ch.remove_client(2, c[1])
+        self.assertEqual(len(c[0].messages), 1)
+        self.ch.remove_client(2, c[2])
+        self.assertEqual(c[0].messages[1], {'msgtype': 'presence', 'online': [], 'offline': [2]})
+
+    def test_legacy_presence_messages(self):
+        self.ch = ChatHandler(presence_window=0, legacy_presence=True)
+        self.ch.add_potential_client({'token': 'a', 'user_id': 1, 'chats': [10]})
+        self.ch.add_potential_client({'token': 'b', 'user_id': 2, 'chats': [10]})
+        c = self.conns
+        self.connect('a', c[0])
+        self.connect('b', c[1])
+        self.ch.remove_client(2, c[1])
+        self.assertEqual(c[0].messages, [
+            {'msgtype': 'presence', 'online': [2], 'offline': []},
+            {'msgtype': 'is_connected', 'username': 2},
+            {'msgtype': 'presence', 'online': [], 'offline': [2]},
+            {'msgtype': 'is_disconnected', 'username': 2},
+        ])
+
+    def test_message_fanout(self):
+        c = self.conns
+        self.connect('a', c[0])
+        self.connect('b', c[1])
+        self.connect('b', c[2])
+        self.ch.add_message({'chat': {'id': 10}, 'text': 'hi'})
+        for conn in c:
+            self.assertEqual(conn.messages[-1], {'chat': {'id': 10}, 'text': 'hi'})
+
+    def test_banned_member(self):
+        c = self.conns
+        self.connect('a', c[0])
+        self.connect('b', c[1])
+        self.ch.handle_event({'type': 'membership', 'user_id': 2, 'chat_id': 10, 'member': False})
+        self.ch.add_message({'id': 1, 'chat': {'id': 10}, 'text': 'hi'})
+        self.assertEqual(c[0].messages[-1]['text'], 'hi')
+        self.assertNotIn('hi', [m.get('text') for m in c[1].messages])
+        self.assertEqual(self.ch.connections.chat_users(10), {1})
+        # Reconnecting with his former token replays nothing of the chat
+        entry = self.ch.tokens.get('b')
+        self.assertEqual(entry.chats, set())
+        self.ch.replay(c[2], entry.chats, 0)
+        self.assertEqual(c[2].messages, [])
+
+    def test_added_member(self):
+        c = self.conns
+        self.ch.add_potential_client({'token': 'c', 'user_id': 3, 'chats': []})
+        self.connect('c', c[0])
+        self.ch.handle_event({'type': 'membership', 'user_id': 3, 'chat_id': 10, 'member': True})
+        self.ch.add_message({'id': 1, 'chat': {'id': 10}, 'text': 'hi'})
+        self.assertEqual(c[0].messages[-1]['text'], 'hi')
+        self.assertEqual(self.ch.tokens.get('c').chats, {10})
+
+    def test_presence_several_chats(self):
+        c = self.conns
+        self.ch.add_potential_client({'token': 'c', 'user_id': 3, 'chats': [10, 11]})
+        self.ch.add_potential_client({'token': 'd', 'user_id': 4, 'chats': [10, 11]})
+        self.connect('c', c[0])
+        self.connect('d', c[1])
+        # User #3 shares two chats with User #4 but is told only once
+        self.assertEqual(c[0].messages, [{'msgtype': 'presence', 'online': [4], 'offline': []}])
+
+    def test_revoke_token(self):
+        c = self.conns
+        self.connect('a', c[0])
+        self.connect('b', c[1])
+        # Only the User the token was given to can revoke it
+        self.ch.remove_potential_client({'token': 'b', 'user_id': 1})
+        self.assertFalse(c[1].closed)
+        self.ch.remove_potential_client({'token': 'b', 'user_id': 2})
+        self.assertTrue(c[1].closed)
+        self.assertIsNone(self.ch.tokens.get('b'))
+        self.assertEqual(c[0].messages[-1]['offline'], [2])
+
+
+class PresenceServiceTests(SimpleTestCase):
+    def setUp(self):
+        # Users #1 to #4 are in chat #10, user #5 is in chat #11
+        self.scheduled = []
+        self.ch = ChatHandler(call_later=lambda delay, callback: self.scheduled.append(callback))
+        self.conns = {}
+        for user_id in range(1, 6):
+            self.ch.add_potential_client({'token': user_id, 'user_id': user_id, 'chats': [10 if user_id < 5 else 11]})
+
+    def connect(self, user_id):
+        self.conns[user_id] = FakeConnection()
+        self.ch.add_client_wsconn(self.ch.tokens.get(user_id), self.conns[user_id])
+
+    def disconnect(self, user_id):
+        self.ch.remove_client(user_id, self.conns[user_id])
+
+    def flush(self):
+        self.assertEqual(len(self.scheduled), 1)
+        self.scheduled.pop()()
+
+    def test_batched_deltas(self):
+        for user_id in range(1, 6):
+            self.connect(user_id)
+        self.flush()
+        self.assertEqual(self.conns[1].messages, [{'msgtype': 'presence', 'online': [2, 3, 4], 'offline': []}])
+        self.assertEqual(self.conns[5].messages, [])
+
+        self.disconnect(2)
+        self.disconnect(3)
+        self.flush()
+        self.assertEqual(self.conns[1].messages[-1], {'msgtype': 'presence', 'online': [], 'offline': [2, 3]})
+        self.assertEqual(len(self.conns[4].messages), 2)
+
+    def test_flapping_not_announced(self):
+        self.connect(1)
+        self.connect(2)
+        self.flush()
+        self.disconnect(2)
+        self.connect(2)
+        self.disconnect(2)
+        self.connect(2)
+        self.flush()
+        self.assertEqual(self.conns[1].messages, [{'msgtype': 'presence', 'online': [2], 'offline': []}])
+
+    def test_online_users(self):
+        for user_id in (1, 2, 5):
+            self.connect(user_id)
+        self.assertEqual(self.ch.presence.online_users([10, 11, 12]), {10: {1, 2}, 11: {5}, 12: set()})
+
+
+class ShardedPresenceTests(SimpleTestCase):
+    class Peers(object):
+        def __init__(self):
+            self.handlers = []
+
+        def publish(self, event):
+            for ch in self.handlers:
+                ch.handle_event(event)
+
+    def setUp(self):
+        # Two workers: users #1 and #2 on worker #1, user #3 on worker #2, all in chat #10
+        self.peers = [self.Peers(), self.Peers()]
+        self.workers = [ChatHandler(presence_window=0, peers=peers, shard=i) for (i, peers) in enumerate(self.peers)]
+        self.peers[0].handlers.append(self.workers[1])
+        self.peers[1].handlers.append(self.workers[0])
+        self.conns = {}
+        for (user_id, worker) in [(1, 0), (2, 0), (3, 1)]:
+            ch = self.workers[worker]
+            ch.add_potential_client({'token': user_id, 'user_id': user_id, 'chats': [10]})
+            self.conns[user_id] = FakeConnection()
+            ch.add_client_wsconn(ch.tokens.get(user_id), self.conns[user_id])
+
+    def test_cross_worker_presence(self):
+        self.assertEqual(self.conns[1].messages, [
+            {'msgtype': 'presence', 'online': [2], 'offline': []},
+            {'msgtype': 'presence', 'online': [3], 'offline': []},
+        ])
+        self.assertEqual(self.conns[3].messages, [])
+        self.workers[0].remove_client(1, self.conns[1])
+        self.assertEqual(self.conns[3].messages, [{'msgtype': 'presence', 'online': [], 'offline': [1]}])
+
+    def test_online_users(self):
+        for ch in self.workers:
+            self.assertEqual(ch.presence.online_users([10]), {10: {1, 2, 3}})
+        self.workers[1].remove_client(3, self.conns[3])
+        self.assertEqual(self.workers[0].presence.online_users([10]), {10: {1, 2}})
+
+    def test_worker_restart(self):
+        # Worker #2 restarts: its users are gone, and it asks worker #1 for its online users
+        self.workers[1] = restarted = ChatHandler(presence_window=0, peers=self.peers[1], shard=1)
+        self.peers[0].handlers = [restarted]
+        self.workers[0].handle_event(restarted.presence.snapshot())
+        self.assertEqual(self.conns[1].messages[-1], {'msgtype': 'presence', 'online': [], 'offline': [3]})
+        self.assertEqual(restarted.presence.online_users([10]), {10: set()})
+        self.workers[0].handle_event({'type': 'presence_sync', 'shard': 1})
+        self.assertEqual(restarted.presence.online_users([10]), {10: {1, 2}})
+
+    def test_hash_ring(self):
+        ring, same_ring, bigger_ring = HashRing(4), HashRing(4), HashRing(5)
+        shards = [ring.shard_for(user_id) for user_id in range(4000)]
+        self.assertEqual(shards, [same_ring.shard_for(user_id) for user_id in range(4000)])
+        for shard in range(4):
+            self.assertTrue(700 < shards.count(shard) < 1300)
+        # Adding a shard only moves users to the new shard
+        moved = [(a, b) for (a, b) in zip(shards, [bigger_ring.shard_for(user_id) for user_id in range(4000)]) if a != b]
+        self.assertTrue(all(b == 4 for (a, b) in moved))
+        self.assertTrue(len(moved) < 1200)
+
+
+class PresenceHandlerTests(AsyncHTTPTestCase):
+    def get_app(self):
+        self.ch = ChatHandler(presence_window=0)
+        self.ch.add_potential_client({'token': 'a', 'user_id': 1, 'chats': [10, 11]})
+        self.ch.add_potential_client({'token': 'b', 'user_id': 2, 'chats': [10, 12]})
+        self.ch.add_client_wsconn(self.ch.tokens.get('a'), FakeConnection())
+        self.ch.add_client_wsconn(self.ch.tokens.get('b'), FakeConnection())
+        return Application([(r"/tornado/presence/(.*)", PresenceHandler, {'chat_handler': self.ch})])
+
+    def test_get(self):
+        response = self.fetch('/tornado/presence/a')
+        self.assertEqual(json.loads(response.body.decode('utf-8')), {'10': [1, 2], '11': [1]})
+        # Only chats of the token bearer
+        response = self.fetch('/tornado/presence/a?chat=10&chat=12')
+        self.assertEqual(json.loads(response.body.decode('utf-8')), {'10': [1, 2]})
+
+    def test_get_unknown_token(self):
+        self.assertEqual(self.fetch('/tornado/presence/c').code, 403)
+
+
+class SlowConnection(object):
+    """Connection whose writes complete only when complete_write() is called."""
+    def __init__(self):
+        self.writes = []
+        self.futures = []
+        self.closed = False
+
+    def write_encoded(self, events):
+        self.writes.append([json.loads(e.payload.decode('utf-8')) for e in events])
+        self.futures.append(Future())
+        return self.futures[-1]
+
+    def complete_write(self):
+        self.futures.pop(0).set_result(None)
+
+    def close(self, *args, **kwargs):
+        self.closed = True
+
+
+class OutboundQueueTests(SimpleTestCase):
+    def setUp(self):
+        self.conn = SlowConnection()
+        self.metrics = ChatMetrics()
+        self.events = [EncodedEvent({'id': i}) for i in range(10)]
+
+    def queue(self, policy):
+        # Room for 3 queued events
+        return OutboundQueue(self.conn, high_water=3 * len(self.events[0].payload), policy=policy, metrics=self.metrics)
+
+    def test_batched_writes(self):
+        q = self.queue('drop')
+        for e in self.events[:4]:
+            q.push(e)
+        self.assertEqual(self.conn.writes, [[{'id': 0}]])
+        self.assertEqual(len(q), 3)
+        self.conn.complete_write()
+        self.assertEqual(self.conn.writes[1], [{'id': 1}, {'id': 2}, {'id': 3}])
+        self.assertEqual(len(q), 0)
+        self.assertEqual(self.metrics.sent, 4)
+
+    def test_policy_drop(self):
+        q = self.queue('drop')
+        for e in self.events[:6]:
+            q.push(e)
+        self.conn.complete_write()
+        self.assertEqual(self.conn.writes[1], [{'id': 1}, {'id': 2}, {'id': 3}])
+        self.assertEqual(self.metrics.dropped, 2)
+
+    def test_policy_coalesce(self):
+        q = self.queue('coalesce')
+        for e in self.events[:6]:
+            q.push(e)
+        self.conn.complete_write()
+        # Events #1 to #5 are replaced with a resync event
+        self.assertEqual(self.conn.writes[1], [{'msgtype': 'resync'}])
+        self.assertEqual((self.metrics.dropped, self.metrics.coalesced), (5, 1))
+
+    def test_policy_disconnect(self):
+        q = self.queue('disconnect')
+        for e in self.events[:6]:
+            q.push(e)
+        self.assertTrue(self.conn.closed)
+        self.conn.complete_write()
+        self.assertEqual(len(self.conn.writes), 1)
+        self.assertEqual((self.metrics.dropped, self.metrics.disconnected), (4, 1))
+
+    def test_failed_write_closes_queue(self):
+        q = self.queue('drop')
+        q.push(self.events[0])
+        q.push(self.events[1])
+        self.conn.futures.pop().set_exception(IOError())
+        q.push(self.events[2])
+        self.assertEqual(len(self.conn.writes), 1)
+
+    def test_unknown_policy(self):
+        with self.assertRaises(ValueError):
+            ChatHandler(slow_consumer_policy='ignore')
+
+
+class MetricsHandlerTests(AsyncHTTPTestCase):
+    def get_app(self):
+        self.ch = ChatHandler(presence_window=0)
+        self.ch.add_potential_client({'token': 'a', 'user_id': 1, 'chats': [10]})
+        self.conn = SlowConnection()
+        self.conn.outbound = self.ch.outbound_queue(self.conn)
+        self.conn.send_encoded = self.conn.outbound.push
+        self.ch.add_client_wsconn(self.ch.tokens.get('a'), self.conn)
+        return Application([(r"/tornado/metrics/", MetricsHandler, {'chat_handler': self.ch})])
+
+    def test_get(self):
+        for i in range(3):
+            self.ch.add_message({'chat': {'id': 10}, 'id': i})
+        metrics = json.loads(self.fetch('/tornado/metrics/').body.decode('utf-8'))
+        self.assertEqual(metrics['connections'], 1)
+        self.assertEqual(metrics['queued_events'], 2)
+        self.assertEqual(metrics['max_queue_depth'], 2)
+        self.assertEqual(metrics['sent'], 1)
+
+
+class MetricsHandlerTokenTests(AsyncHTTPTestCase):
+    def get_app(self):
+        return Application([(r"/tornado/metrics/", MetricsHandler, {'chat_handler': ChatHandler(), 'token': 'secret'})])
+
+    def test_get(self):
+        self.assertEqual(self.fetch('/tornado/metrics/').code, 403)
+        self.assertEqual(self.fetch('/tornado/metrics/', headers={'Authorization': 'Bearer wrong'}).code, 403)
+        self.assertEqual(self.fetch('/tornado/metrics/', headers={'Authorization': 'Bearer secret'}).code, 200)
+
+
+class ReplayTests(SimpleTestCase):
+    def setUp(self):
+        self.ch = ChatHandler(presence_window=0, replay_size=3)
+        self.conn = FakeConnection()
+
+    def message(self, message_id, chat_id):
+        self.ch.add_message({'id': message_id, 'chat': {'id': chat_id}})
+
+    def replayed(self, chats, last_seen):
+        self.conn.messages = []
+        self.ch.replay(self.conn, chats, last_seen)
+        return self.conn.messages
+
+    def test_replay_gap(self):
+        for (message_id, chat_id) in [(5, 10), (6, 11), (7, 10), (8, 10)]:
+            self.message(message_id, chat_id)
+        self.assertEqual([m['id'] for m in self.replayed({10, 11}, 5)], [6, 7, 8])
+        self.assertEqual(self.replayed({10, 11}, 8), [])
+        # The server did not see the messages before #5
+        self.assertEqual(self.replayed({10, 11}, 3), [{'msgtype': 'resync', 'chats': [10, 11]}])
+        self.assertEqual(self.replayed({12}, 4), [])
+
+    def test_replay_evicted(self):
+        for message_id in range(1, 6):
+            self.message(message_id, 10)
+        self.message(6, 11)
+        self.assertEqual(self.ch.replay_buffers._buffers[10].evicted_max_id, 2)
+        self.assertEqual([m['id'] for m in self.replayed({10, 11}, 2)], [3, 4, 5, 6])
+        self.assertEqual(self.replayed({10, 11}, 1), [{'msgtype': 'resync', 'chats': [10]}, {'id': 6, 'chat': {'id': 11}}])
+
+    def test_replay_out_of_order(self):
+        for message_id in [1, 3, 2, 5, 4]:
+            self.message(message_id, 10)
+        self.assertEqual([e[0] for e in self.ch.replay_buffers._buffers[10].events], [3, 4, 5])
+        self.assertEqual(self.ch.replay_buffers._buffers[10].evicted_max_id, 2)
+        self.assertEqual([m['id'] for m in self.replayed({10}, 3)], [4, 5])
+        # Older than the whole buffer
+        self.message(2, 10)
+        self.assertEqual([e[0] for e in self.ch.replay_buffers._buffers[10].events], [3, 4, 5])
+
+    def test_replay_disabled(self):
+        registry = ReplayRegistry(size=0)
+        registry.append(10, 1, self.ch.broadcast([], {}))
+        self.assertEqual(len(registry), 0)
+        self.assertEqual(registry.since({10}, 1), ([], [10]))
+
+
+class EncodedEventTests(SimpleTestCase):
+    def test_frame(self):
+        for (size, header) in [(10, b'\x81\x0c'), (1000, b'\x81\x7e\x03\xea'), (70000, b'\x81\x7f' + (70002).to_bytes(8, 'big'))]:
+            encoded = EncodedEvent('a' * size)
+            self.assertEqual(encoded.payload, ('"%s"' % ('a' * size)).encode('utf-8'))
+            self.assertEqual(encoded.frame, header + encoded.payload)
+
+
+class ClientWSConnectionTests(SimpleTestCase):
+    def test_send_encoded_writes_shared_frame(self):
+        conns = [bench_connection() for i in range(2)]
+        ch = ChatHandler()
+        for (i, conn) in enumerate(conns):
+            ch.connections.add(i, conn, [1])
+        encoded = ch.broadcast(ch.chatmate_cwsconns(1), {'text': 'hi'})
+        for conn in conns:
+            self.assertEqual(conn.ws_connection.stream.bytes_written, len(encoded.frame))
+        # Same bytes as Tornado would have written for the encoded payload
+        conns[0].write_message(encoded.payload)
+        self.assertEqual(conns[0].ws_connection.stream.bytes_written, 2 * len(encoded.frame))
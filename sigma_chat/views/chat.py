@@ -1,5 +1,6 @@
 from django.http import Http404
-from django.db.models import Q
+from django.utils.crypto import get_random_string
+from django.db.models import Q, Max
 
 from rest_framework import viewsets, decorators, status
 from rest_framework.response import Response
@@ -9,8 +10,11 @@ from dry_rest_permissions.generics import DRYPermissionFiltersBase
 from sigma_core.models.user import User
 from sigma_chat.models.chat import Chat
 from sigma_chat.models.chat_member import ChatMember
+from sigma_chat.models.message import Message
 from sigma_chat.serializers.chat import ChatSerializer
 from sigma_chat.serializers.chat_member import ChatMemberSerializer
+from sigma_chat.serializers.message import MessageSerializer
+from sigma_chat.bus import publish_token, revoke_token
 
 
 class ChatFilterBackend(DRYPermissionFiltersBase):
@@ -18,10 +22,11 @@ class ChatFilterBackend(DRYPermissionFiltersBase):
         """
         Limits all list requests w.r.t the Normal Rules of Visibility.
         """
-        user_chats_ids = request.user.user_chatmember.filter(is_member=True).values_list('chat_id', flat=True)
-        return queryset.prefetch_related('chatmember') \
+        # The aggregate runs over the join on the user's own ChatMember (the filter precedes it): GROUP BY chat replaces
+        # DISTINCT and yields his unread count
+        return queryset.select_related('last_message') \
             .filter(chatmember__user=request.user) \
-            .distinct()
+            .annotate(unread_count=Max('chatmember__unread_count'))
 
 
 class ChatViewSet(viewsets.ModelViewSet):
@@ -29,6 +34,8 @@ class ChatViewSet(viewsets.ModelViewSet):
     serializer_class = ChatSerializer
     permission_classes = [IsAuthenticated, ]
     filter_backends = (ChatFilterBackend, )
+    history_page_size = 50
+    history_max_page_size = 200
 
     def update(self, request, pk=None):
         try:
@@ -47,10 +54,139 @@ class ChatViewSet(viewsets.ModelViewSet):
 
         if serializer.is_valid():
             serializer.save()
+            request.user.invalidate_permission_context()
             return Response(serializer.data, status=status.HTTP_201_CREATED)
         else:
             return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
 
+    @decorators.list_route(methods=['post'])
+    def ws_token(self, request):
+        """
+        Authorize a new websocket connection to the chat server for the current user. Connect to /tornado/ws/{token}
+        on chat worker shard (listening on the chat server port + shard). When reconnecting, add ?last_seen={message id}
+        to receive the messages missed meanwhile.
+        The token reaches the chat server asynchronously, through the chat bus: a connection opened right after this
+        request may be refused (closed with code 403) if it arrives first. Clients retry it after a short delay.
+        On logout, revoke the token with POST /chat/revoke_ws_token/.
+        ---
+        omit_serializer: true
+        """
+        token = get_random_string(40)
+        chats = request.user.user_chatmember.filter(is_member=True).values_list('chat_id', flat=True)
+        shard = publish_token(token, request.user.id, chats)
+        return Response({'token': token, 'shard': shard}, status=status.HTTP_201_CREATED)
+
+    @decorators.list_route(methods=['post'])
+    def revoke_ws_token(self, request):
+        """
+        Revoke a websocket token of the current user and close his connections to the chat server, e.g. on logout.
+        ---
+        omit_serializer: true
+        parameters_strategy:
+            form: replace
+        parameters:
+            - name: token
+              type: string
+              required: true
+        """
+        token = request.data.get('token', None)
+        if not token:
+            return Response("Missing token.", status=status.HTTP_400_BAD_REQUEST)
+        revoke_token(token, request.user.id)
+        return Response(status=status.HTTP_204_NO_CONTENT)
+
+    @decorators.list_route(methods=['get'])
+    def unread(self, request):
+        """
+        List the read state of every chat the current user is member of.
+        ---
+        omit_serializer: true
+        """
+        unread = ChatMember.objects.filter(user=request.user, is_member=True) \
+            .values('chat_id', 'unread_count', 'last_read_message_id')
+        return Response([{
+            'chat_id': m['chat_id'],
+            'unread_count': m['unread_count'],
+            'last_read_message_id': m['last_read_message_id'],
+        } for m in unread], status=status.HTTP_200_OK)
+
+    @decorators.detail_route(methods=['post'])
+    def mark_read(self, request, pk=None):
+        """
+        Mark the messages of chat pk as read up to message_id (the newest message by default).
+        ---
+        omit_serializer: true
+        parameters_strategy:
+            form: replace
+        parameters:
+            - name: message_id
+              type: integer
+              required: false
+        """
+        try:
+            chatmember = ChatMember.objects.get(chat=int(pk), user=request.user, is_member=True)
+        except ValueError:
+            return Response("Invalid chat id.", status=status.HTTP_400_BAD_REQUEST)
+        except ChatMember.DoesNotExist:
+            raise Http404("Chat {0} not found".format(pk))
+
+        message = None
+        message_id = request.data.get('message_id', None)
+        if message_id is not None:
+            try:
+                message = Message.objects.get(pk=int(message_id), chat_id=chatmember.chat_id)
+            except (TypeError, ValueError):
+                return Response("Invalid message id.", status=status.HTTP_400_BAD_REQUEST)
+            except Message.DoesNotExist:
+                raise Http404("Message {0} not found in chat {1}".format(message_id, pk))
+        if not chatmember.mark_read(message):
+            return Response("Message already read.", status=status.HTTP_400_BAD_REQUEST)
+        return Response(ChatMemberSerializer(chatmember, context={'request': request}).data, status=status.HTTP_200_OK)
+
+    @decorators.detail_route(methods=['get'])
+    def history(self, request, pk=None):
+        """
+        List messages of chat pk in chronological order: the newest ones, or the ones just before or after a message.
+        ---
+        omit_serializer: true
+        parameters_strategy:
+            query: replace
+        parameters:
+            - name: before
+              type: integer
+              paramType: query
+            - name: after
+              type: integer
+              paramType: query
+            - name: limit
+              type: integer
+              paramType: query
+        """
+        try:
+            chat = Chat.objects.get(pk=pk)
+        except Chat.DoesNotExist:
+            raise Http404("Chat {0} not found".format(pk))
+        if not request.user.is_chat_member(chat):
+            return Response(status=status.HTTP_403_FORBIDDEN)
+
+        try:
+            before = request.query_params.get('before', None)
+            after = request.query_params.get('after', None)
+            before = int(before) if before is not None else None
+            after = int(after) if after is not None else None
+            limit = int(request.query_params.get('limit', self.history_page_size))
+        except ValueError:
+            return Response("before, after and limit must be integers.", status=status.HTTP_400_BAD_REQUEST)
+        if before is not None and after is not None:
+            return Response("Give either before or after.", status=status.HTTP_400_BAD_REQUEST)
+        limit = min(max(limit, 1), self.history_max_page_size)
+
+        try:
+            messages, has_more = Message.objects.history(chat, before=before, after=after, limit=limit)
+        except Message.DoesNotExist:
+            raise Http404("Message {0} not found in chat {1}".format(before or after, pk))
+        return Response({'results': MessageSerializer(messages, many=True).data, 'has_more': has_more}, status=status.HTTP_200_OK)
+
     @decorators.detail_route(methods=['post'])
     def add_member(self, request, pk=None):
         """
@@ -79,7 +215,8 @@ class ChatViewSet(viewsets.ModelViewSet):
 
             c = ChatMember(chat=chat, user=user, is_creator=False, is_admin=False)
             c.save()
-            s = ChatMemberSerializer(c)
+            request.user.invalidate_permission_context()
+            s = ChatMemberSerializer(c, context={'request': request})
             return Response(s.data, status=status.HTTP_200_OK)
 
         except Chat.DoesNotExist:
@@ -147,7 +284,8 @@ class ChatViewSet(viewsets.ModelViewSet):
                 changed = True
             if changed:
                 chatmember.save()
-                s = ChatMemberSerializer(chatmember)
+                request.user.invalidate_permission_context()
+                s = ChatMemberSerializer(chatmember, context={'request': request})
                 return Response(s.data, status=status.HTTP_200_OK)
             return Response("Incorrect role.", status=status.HTTP_400_BAD_REQUEST)
 
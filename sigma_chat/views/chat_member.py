@@ -1,5 +1,5 @@
 from django.http import Http404
-from django.db.models import Prefetch, Q
+from django.db.models import Q
 
 from rest_framework import viewsets, decorators, status, mixins
 from rest_framework.response import Response
@@ -27,17 +27,14 @@ class ChatMemberFilterBackend(BaseFilterBackend):
         """
         user_chat_ids = request.user.user_chatmember.filter(is_member=True).values_list('chat_id', flat=True)
         # I can see a ChatMember if and only I am member of the chat
-        queryset = queryset.prefetch_related(
-            Prefetch('user', queryset=ChatMember.objects.filter(is_member=True))
-        ).filter(Q(user_id=request.user.id) | Q(chat_id__in=user_chat_ids)
-        )
+        queryset = queryset.filter(Q(user_id=request.user.id) | Q(chat_id__in=user_chat_ids))
 
         for (param, q) in self.filter_q.items():
             x = request.query_params.get(param, None)
             if x is not None:
                 queryset = queryset.filter(q(x))
 
-        return queryset.distinct()
+        return queryset
 
 
 class ChatMemberViewSet(viewsets.ModelViewSet):
@@ -67,6 +64,18 @@ class ChatMemberViewSet(viewsets.ModelViewSet):
     def update(self, request, pk=None):
         return Response("You're not authorized to update a new ChatMember this way, please use the website.", status=status.HTTP_403_FORBIDDEN)
 
+    @decorators.detail_route(methods=['get'])
+    def messages(self, request, pk=None):
+        """
+        List the messages sent by the ChatMember pk, newest first.
+        ---
+        response_serializer: MessageSerializer
+        """
+        chatmember = self.get_object()
+        self.pagination_ordering = '-pk'
+        page = self.paginate_queryset(Message.objects.filter(chatmember_id=chatmember))
+        return self.get_paginated_response(MessageSerializer(page, many=True).data)
+
     @decorators.detail_route(methods=['post'])
     def send_message(self, request, pk=None):
         """
@@ -24,15 +24,15 @@ class MessageFilterBackend(DRYPermissionFiltersBase):
         Limits all list requests w.r.t the Normal Rules of Visibility.
         """
         user_chat_ids = request.user.user_chatmember.filter(is_member=True).values_list('chat_id', flat=True)
-        queryset = queryset.prefetch_related('chat_id', 'chatmember_id') \
-            .filter(chat_id__in=user_chat_ids)
+        # Semi-join on the chats of the user: no duplicates, hence no DISTINCT
+        queryset = queryset.filter(chat_id__in=user_chat_ids)
 
         for (param, q) in self.filter_q.items():
             x = request.query_params.get(param, None)
             if x is not None:
                 queryset = queryset.filter(q(x))
 
-        return queryset.distinct()
+        return queryset
 
 
 class MessageViewSet(viewsets.ModelViewSet):
@@ -40,6 +40,7 @@ class MessageViewSet(viewsets.ModelViewSet):
     serializer_class = MessageSerializer
     permission_classes = [IsAuthenticated, ]
     filter_backends = (MessageFilterBackend, )
+    pagination_ordering = '-pk'
 
     def create(self, request):
         return Response("You're not authorized to create a new Message this way, please use the website.", status=status.HTTP_403_FORBIDDEN)
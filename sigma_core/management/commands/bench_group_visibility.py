@@ -0,0 +1,127 @@
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+from django.db.models import Q
+
+from sigma_core.models.user import User
+from sigma_core.models.group import Group, GroupAcknowledgment
+from sigma_core.models.group_member import GroupMember
+from sigma_core.views.group import GroupFilterBackend
+
+
+class Rollback(Exception):
+    pass
+
+
+def legacy_filter_queryset(request, queryset):
+    """
+    GroupFilterBackend.filter_queryset before the semi-join rewrite, kept for comparison.
+    """
+    invited_to_groups_ids = request.user.invited_to_groups.all().values_list('id', flat=True)
+    user_groups_ids = request.user.memberships.filter(is_accepted=True).values_list('group_id', flat=True)
+    return queryset.prefetch_related('memberships', 'group_parents') \
+        .filter(Q(is_private=False) | Q(memberships__user=request.user) | Q(id__in=invited_to_groups_ids) | Q(group_parents__id__in=user_groups_ids)) \
+        .distinct()
+
+
+class Command(BaseCommand):
+    help = "Benchmark GroupFilterBackend (query plan and latency) for growing group sizes. Nothing is kept in the database."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--sizes', default='10,100,1000,5000', help="Comma-separated numbers of members per group")
+        parser.add_argument('--groups', type=int, default=10, help="Number of private groups")
+        parser.add_argument('--repeat', type=int, default=20)
+        parser.add_argument('--legacy', action='store_true', help="Also benchmark the former implementation")
+        parser.add_argument('--depth', type=int, default=20, help="Depth of the hierarchy of acknowledged groups")
+
+    def handle(self, *args, **options):
+        sizes = [int(s) for s in options['sizes'].split(',')]
+        try:
+            with transaction.atomic():
+                self.run(sizes, options)
+                raise Rollback()
+        except Rollback:
+            pass
+
+    def run(self, sizes, options):
+        viewer = User.objects.create(email='bench-viewer@sigma.bench', lastname='Bench', firstname='Viewer')
+        request = type('Request', (), {'user': viewer})
+        groups = [Group.objects.create(name='Bench private %d' % i, is_private=True) for i in range(options['groups'])]
+        Group.objects.bulk_create([Group(name='Bench public %d' % i) for i in range(options['groups'])])
+        # The viewer belongs to the first group, which acknowledges the second one, and is invited to the third one
+        GroupMember.objects.create(user=viewer, group=groups[0], is_accepted=True)
+        GroupAcknowledgment.objects.create(subgroup=groups[1], parent_group=groups[0], validated=True)
+        viewer.invited_to_groups.add(groups[2])
+
+        implementations = [('subqueries', lambda qs: GroupFilterBackend().filter_queryset(request, qs, None))]
+        if options['legacy']:
+            implementations.append(('legacy', lambda qs: legacy_filter_queryset(request, qs)))
+
+        members_count = 0
+        for size in sizes:
+            # Grow every group up to size members (bulk_create: the UserVisibility index is not needed here)
+            User.objects.bulk_create([
+                User(email='bench-%d-%d@sigma.bench' % (size, i), lastname='Bench', firstname='User')
+                for i in range(size - members_count)
+            ])
+            users = User.objects.filter(email__startswith='bench-%d-' % size)
+            GroupMember.objects.bulk_create([GroupMember(user=u, group=g, is_accepted=True) for g in groups for u in users])
+            members_count = size
+
+            for (name, filter_queryset) in implementations:
+                timings = []
+                for _ in range(options['repeat']):
+                    start = time.perf_counter()
+                    visible = len(list(filter_queryset(Group.objects.all())))
+                    timings.append(time.perf_counter() - start)
+                timings.sort()
+                self.stdout.write("%-10s members/group=%-6d visible groups=%-4d median=%.2fms max=%.2fms" % (
+                    name, size, visible, 1000 * timings[len(timings) // 2], 1000 * timings[-1]))
+
+        self.run_hierarchy(groups[0], options)
+
+        for (name, filter_queryset) in implementations:
+            self.stdout.write("\nQuery plan (%s):" % name)
+            for line in self.explain(filter_queryset(Group.objects.all())):
+                self.stdout.write("    %s" % line)
+
+    def run_hierarchy(self, root, options):
+        """
+        Acknowledge a chain of depth groups below root, each with a second leaf subgroup, through the signals which
+        maintain the GroupAncestry closure table, then time the ancestors and descendants lookups at both ends.
+        """
+        start = time.perf_counter()
+        parent, bottom = root, root
+        for i in range(options['depth']):
+            bottom = Group.objects.create(name='Bench level %d' % i, is_private=True)
+            leaf = Group.objects.create(name='Bench leaf %d' % i, is_private=True)
+            GroupAcknowledgment.objects.create(subgroup=bottom, parent_group=parent, validated=True)
+            GroupAcknowledgment.objects.create(subgroup=leaf, parent_group=parent, validated=True)
+            parent = bottom
+        self.stdout.write("\nhierarchy  depth=%-4d groups=%-5d built in %.2fms" % (
+            options['depth'], 2 * options['depth'], 1000 * (time.perf_counter() - start)))
+
+        for (name, queryset) in [('descendants', root.descendants), ('ancestors', bottom.ancestors)]:
+            timings = []
+            for _ in range(options['repeat']):
+                start = time.perf_counter()
+                found = len(list(queryset.all()))
+                timings.append(time.perf_counter() - start)
+            timings.sort()
+            self.stdout.write("%-11s groups=%-5d median=%.2fms max=%.2fms" % (
+                name, found, 1000 * timings[len(timings) // 2], 1000 * timings[-1]))
+
+        # Moving the whole chain below another group refreshes every closure row of the chain
+        top = Group.objects.create(name='Bench top', is_private=True)
+        start = time.perf_counter()
+        GroupAcknowledgment.objects.create(subgroup=root, parent_group=top, validated=True)
+        self.stdout.write("refresh    groups=%-5d in %.2fms" % (
+            root.descendants.count() + 1, 1000 * (time.perf_counter() - start)))
+
+    def explain(self, queryset):
+        sql, params = queryset.query.sql_with_params()
+        prefix = 'EXPLAIN QUERY PLAN ' if connection.vendor == 'sqlite' else 'EXPLAIN '
+        with connection.cursor() as cursor:
+            cursor.execute(prefix + sql, params)
+            return [' | '.join(str(c) for c in row) for row in cursor.fetchall()]
@@ -0,0 +1,51 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.9 on 2026-10-18 19:09
+from __future__ import unicode_literals
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def build_user_visibility(apps, schema_editor):
+    GroupMember = apps.get_model('sigma_core', 'GroupMember')
+    UserVisibility = apps.get_model('sigma_core', 'UserVisibility')
+
+    members_by_group = {}
+    for (group_id, user_id, is_accepted) in GroupMember.objects.values_list('group_id', 'user_id', 'is_accepted'):
+        members_by_group.setdefault(group_id, []).append((user_id, is_accepted))
+
+    shared_groups = {}
+    for members in members_by_group.values():
+        for (user_id, is_accepted) in members:
+            if not is_accepted:
+                continue
+            for (visible_user_id, _) in members:
+                key = (user_id, visible_user_id)
+                shared_groups[key] = shared_groups.get(key, 0) + 1
+
+    UserVisibility.objects.bulk_create([UserVisibility(user_id=u, visible_user_id=v, shared_groups=n) for ((u, v), n) in shared_groups.items()])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('sigma_core', '0028_group_need_validation_to_join'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='UserVisibility',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('shared_groups', models.PositiveIntegerField(default=0)),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='visibilities', to=settings.AUTH_USER_MODEL)),
+                ('visible_user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='visible_by', to=settings.AUTH_USER_MODEL)),
+            ],
+        ),
+        migrations.AlterUniqueTogether(
+            name='uservisibility',
+            unique_together=set([('user', 'visible_user')]),
+        ),
+        migrations.RunPython(build_user_visibility, migrations.RunPython.noop),
+    ]
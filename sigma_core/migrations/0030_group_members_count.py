@@ -0,0 +1,27 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.9 on 2026-10-18 19:13
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+def count_members(apps, schema_editor):
+    Group = apps.get_model('sigma_core', 'Group')
+    for group in Group.objects.annotate(n=models.Count('memberships')).only('id'):
+        Group.objects.filter(pk=group.pk).update(members_count=group.n)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('sigma_core', '0029_user_visibility'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='group',
+            name='members_count',
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+        migrations.RunPython(count_members, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,57 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.9 on 2026-10-18 19:14
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def build_group_ancestry(apps, schema_editor):
+    GroupAcknowledgment = apps.get_model('sigma_core', 'GroupAcknowledgment')
+    GroupAncestry = apps.get_model('sigma_core', 'GroupAncestry')
+
+    parents = {}
+    for (subgroup_id, parent_group_id) in GroupAcknowledgment.objects.filter(validated=True).values_list('subgroup_id', 'parent_group_id'):
+        parents.setdefault(subgroup_id, set()).add(parent_group_id)
+
+    # Breadth-first walk from every group to the roots: shortest depths first, cycles are ignored
+    ancestries = {}
+    for group_id in parents:
+        depth = 0
+        seen = {group_id}
+        frontier = [group_id]
+        while frontier:
+            depth += 1
+            next_frontier = []
+            for g in frontier:
+                for p in parents.get(g, ()):
+                    if p not in seen:
+                        seen.add(p)
+                        ancestries[(p, group_id)] = depth
+                        next_frontier.append(p)
+            frontier = next_frontier
+    GroupAncestry.objects.bulk_create([GroupAncestry(ancestor_id=a, descendant_id=d, depth=depth) for ((a, d), depth) in ancestries.items()])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('sigma_core', '0030_group_members_count'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='GroupAncestry',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('depth', models.PositiveIntegerField()),
+                ('ancestor', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='descendant_links', to='sigma_core.Group')),
+                ('descendant', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='ancestor_links', to='sigma_core.Group')),
+            ],
+        ),
+        migrations.AlterUniqueTogether(
+            name='groupancestry',
+            unique_together=set([('ancestor', 'descendant')]),
+        ),
+        migrations.RunPython(build_group_ancestry, migrations.RunPython.noop),
+    ]
@@ -18,6 +18,8 @@ class Group(models.Model):
     is_protected = models.BooleanField(default=False) # if True, the Group cannot be deleted
     can_anyone_join = models.BooleanField(default=False) #if True, people don't need invitation
     need_validation_to_join = models.BooleanField(default=False)
+    # Denormalized number of memberships (pending ones included), kept up to date by GroupMember signals
+    members_count = models.PositiveIntegerField(default=0, editable=False)
 
     # Related fields:
     #   - invited_users (model User)
@@ -26,6 +28,8 @@ class Group(models.Model):
     #   - fields (model GroupField)
     #   - subgroups (model Group)
     #   - group_parents (model Group)
+    #   - ancestor_links (model GroupAncestry.descendant)
+    #   - descendant_links (model GroupAncestry.ancestor)
     # TODO: Determine whether 'memberships' fields needs to be retrieved every time or not...
 
     @property
@@ -37,8 +41,21 @@ class Group(models.Model):
         return [ga.parent_group for ga in self.group_parents.filter(validated=True).select_related('parent_group')]
 
     @property
-    def members_count(self):
-        return self.memberships.count()
+    def ancestors(self):
+        """
+        All the groups that acknowledge self, directly or not (one query).
+        """
+        return Group.objects.filter(descendant_links__descendant=self)
+
+    @property
+    def descendants(self):
+        """
+        All the groups acknowledged by self, directly or not (one query).
+        """
+        return Group.objects.filter(ancestor_links__ancestor=self)
+
+    def is_descendant_of(self, group):
+        return GroupAncestry.objects.filter(ancestor=group, descendant=self).exists()
 
     #################
     # Model methods #
@@ -74,3 +91,87 @@ class GroupAcknowledgment(models.Model):
             return "Group %s acknowledged by Group %s" % (self.subgroup.__str__(), self.parent_group.__str__())
         else:
             return "Group %s awaiting for acknowledgment by Group %s since %s" % (self.subgroup.__str__(), self.parent_group.__str__(), self.created.strftime("%Y-%m-%d %H:%M"))
+
+
+def compute_group_ancestries(edges, groups_ids):
+    """
+    For each group of groups_ids, compute its ancestors in the graph of validated acknowledgments.
+    edges is an iterable of (subgroup_id, parent_group_id) pairs.
+    Return a dict (ancestor_id, descendant_id) => depth, where depth is the length of the shortest path.
+    """
+    parents = {}
+    for (subgroup_id, parent_group_id) in edges:
+        parents.setdefault(subgroup_id, set()).add(parent_group_id)
+
+    ancestries = {}
+    for group_id in groups_ids:
+        # Breadth-first walk to the roots (shortest depths first, cycles are ignored)
+        depth = 0
+        seen = {group_id}
+        frontier = [group_id]
+        while frontier:
+            depth += 1
+            next_frontier = []
+            for g in frontier:
+                for p in parents.get(g, ()):
+                    if p not in seen:
+                        seen.add(p)
+                        ancestries[(p, group_id)] = depth
+                        next_frontier.append(p)
+            frontier = next_frontier
+    return ancestries
+
+
+class GroupAncestryManager(models.Manager):
+    def refresh_subtree(self, group_id):
+        """
+        Recompute the ancestors of group_id and of all its descendants, after an acknowledgment of group_id changed.
+        Only the acknowledgments below group_id and above its subtree are loaded, one query per level.
+        """
+        acknowledgments = GroupAcknowledgment.objects.filter(validated=True)
+
+        subtree = {group_id}
+        frontier = {group_id}
+        while frontier:
+            children = acknowledgments.filter(parent_group_id__in=frontier).values_list('subgroup_id', flat=True)
+            frontier = set(children) - subtree
+            subtree.update(frontier)
+
+        edges = set()
+        reached = set(subtree)
+        frontier = set(subtree)
+        while frontier:
+            parent_edges = set(acknowledgments.filter(subgroup_id__in=frontier).values_list('subgroup_id', 'parent_group_id'))
+            edges.update(parent_edges)
+            frontier = {parent_group_id for (_, parent_group_id) in parent_edges} - reached
+            reached.update(frontier)
+
+        self.filter(descendant_id__in=subtree).delete()
+        self._bulk_create(compute_group_ancestries(edges, subtree))
+
+    def rebuild(self):
+        edges = list(GroupAcknowledgment.objects.filter(validated=True).values_list('subgroup_id', 'parent_group_id'))
+        self.all().delete()
+        self._bulk_create(compute_group_ancestries(edges, {subgroup_id for (subgroup_id, _) in edges}))
+
+    def _bulk_create(self, ancestries):
+        self.bulk_create([self.model(ancestor_id=a, descendant_id=d, depth=depth) for ((a, d), depth) in ancestries.items()])
+
+
+class GroupAncestry(models.Model):
+    """
+    Closure table of the validated GroupAcknowledgments: ancestor acknowledges descendant, directly (depth=1) or
+    through depth-1 intermediate groups (shortest path).
+    Kept up to date by GroupAcknowledgment signals (see sigma_core.signals).
+    """
+    class Meta:
+        unique_together = (("ancestor", "descendant"),)
+
+    ancestor = models.ForeignKey(Group, related_name='descendant_links')
+    descendant = models.ForeignKey(Group, related_name='ancestor_links')
+    depth = models.PositiveIntegerField()
+
+    objects = GroupAncestryManager()
+
+    def __str__(self): # pragma: no cover
+        return "Group %s acknowledged by Group %s (depth %d)" % (self.descendant.__str__(), self.ancestor.__str__(), self.depth)
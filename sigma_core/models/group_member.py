@@ -31,6 +31,13 @@ class GroupMember(models.Model):
     # Related fields:
     #   - values (model GroupMemberValue)
 
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        # Used by sigma_core.signals to detect acceptance changes
+        instance._loaded_is_accepted = instance.__dict__.get('is_accepted')
+        return instance
+
     def __str__(self):
         return "User \"%s\" in Group \"%s\"" % (self.user.__str__(), self.group.__str__())
 
@@ -103,7 +103,9 @@ class User(AbstractBaseUser):
         """
         Return True iff self has a cluster in common with user.
         """
-        return len(set(self.clusters.all().values_list('id', flat=True)).intersection(user.clusters.all().values_list('id', flat=True))) > 0
+        through = User.clusters.through
+        my_clusters = through.objects.filter(user_id=self.id).values('cluster_id')
+        return through.objects.filter(user_id=user.id, cluster_id__in=my_clusters).exists()
 
     def has_common_group(self, user):
         """
@@ -112,46 +114,67 @@ class User(AbstractBaseUser):
         """
         # We filter on is_accepted : we are really in the same group if you ARE really in the group.
         # But, on the other hand, you can "see" pending request of other members.
-        return len(set(self.memberships.filter(is_accepted=True).values_list('group', flat=True)).intersection(user.memberships.all().values_list('group', flat=True))) > 0
+        # That is exactly the visibility relation materialized by UserVisibility.
+        from sigma_core.models.user_visibility import UserVisibility
+        return UserVisibility.objects.filter(user_id=self.id, visible_user_id=user.id).exists()
+
+    def get_users_with_common_cluster_or_group(self, users_ids):
+        """
+        Return the set of ids, among users_ids, of the users that have a cluster or a group in common with self.
+        Batch version of has_common_cluster/has_common_group, in one query.
+        """
+        from sigma_core.models.user_visibility import UserVisibility
+        through = User.clusters.through
+        my_clusters = through.objects.filter(user_id=self.id).values('cluster_id')
+        return set(User.objects.prefetch_related(None).filter(pk__in=users_ids).filter(
+            Q(pk__in=through.objects.filter(cluster_id__in=my_clusters).values('user_id')) |
+            Q(pk__in=UserVisibility.objects.filter(user_id=self.id).values('visible_user_id'))
+        ).values_list('id', flat=True))
+
+    @property
+    def permission_context(self):
+        """
+        Memberships cache used by the permission helpers below (see sigma_core.permission_context).
+        """
+        from sigma_core.permission_context import PermissionContext
+        if getattr(self, '_permission_context', None) is None:
+            self._permission_context = PermissionContext(self)
+        return self._permission_context
+
+    def invalidate_permission_context(self):
+        """
+        Must be called after modifying memberships of self, so that permission helpers see the change.
+        """
+        if getattr(self, '_permission_context', None) is not None:
+            self._permission_context.invalidate()
 
     def get_group_membership(self, group):
-        from sigma_core.models.group_member import GroupMember
-        from sigma_core.models.group import Group
-        try:
-            return self.memberships.get(group=group)
-        except GroupMember.DoesNotExist:
-            return None
+        return self.permission_context.get_group_membership(group)
 
     def is_group_member(self, g):
-        from sigma_core.models.group_member import GroupMember
         mem = self.get_group_membership(g)
-        return mem is not None and mem.is_accepted()
+        return mem is not None and mem.is_accepted
 
     def can_invite(self, group):
-        from sigma_core.models.group_member import GroupMember
         mem = self.get_group_membership(group)
         return mem is not None and mem.can_invite
 
     def can_accept_join_requests(self, group):
         # Considered that someone who can invite can also accept join requests
-        from sigma_core.models.group_member import GroupMember
         if self.is_sigma_admin():
             return True
         mem = self.get_group_membership(group)
         return mem is not None and mem.can_invite
 
     def can_modify_group_infos(self, group):
-        from sigma_core.models.group_member import GroupMember
         mem = self.get_group_membership(group)
         return mem is not None and mem.can_modify_group_infos
 
     def has_group_admin_perm(self, group):
-        from sigma_core.models.group_member import GroupMember
-        from sigma_core.models.group import Group
         if self.is_sigma_admin():
             return True
         mem = self.get_group_membership(group)
-        return mem is not None and (mem.is_administrator or mem.is_superadministrator)
+        return mem is not None and (mem.is_administrator or mem.is_super_administrator)
 
     def is_invited_to_group_id(self, groupId):
         return self.invited_to_groups.filter(pk=groupId).exists()
@@ -161,10 +184,7 @@ class User(AbstractBaseUser):
         return GroupMember.objects.filter(Q(user=self) & Q(is_accepted=True)).values_list('group', flat=True)
 
     def get_chat_membership(self, chat):
-        try:
-            return self.user_chatmember.get(chat=chat)
-        except ChatMember.DoesNotExist:
-            return None
+        return self.permission_context.get_chat_membership(chat)
 
     def is_chat_member(self, chat):
         mem = self.get_chat_membership(chat)
@@ -0,0 +1,89 @@
+from django.db import models, transaction
+from django.db.models import Count, Q
+
+from sigma_core.models.user import User
+
+
+class UserVisibilityManager(models.Manager):
+    def visible_users_ids(self, user):
+        """
+        Return the ids of the users that user can see w.r.t. the Normal Rules of Visibility.
+        """
+        return self.filter(user=user).values_list('visible_user_id', flat=True)
+
+    def refresh_user(self, user_id):
+        """
+        Recompute every index entry involving user_id (as viewer or as visible user) from the GroupMember table.
+        The rows of the users sharing entries with user_id are locked first (in pk order), so that concurrent refreshes
+        of two users who can see each other do not insert the same pair twice.
+        """
+        with transaction.atomic():
+            partners = set(self.filter(user_id=user_id).values_list('visible_user_id', flat=True))
+            partners.update(self.filter(visible_user_id=user_id).values_list('user_id', flat=True))
+            partners.update(u for pair in self._shared_groups(user_id) for u in pair)
+            partners.add(user_id)
+            list(User.objects.select_for_update().filter(pk__in=partners).order_by('pk').values_list('pk', flat=True))
+
+            # Computed again now that concurrent refreshes are done
+            shared_groups = self._shared_groups(user_id)
+            self.filter(Q(user_id=user_id) | Q(visible_user_id=user_id)).delete()
+            self._bulk_create(shared_groups)
+
+    def _shared_groups(self, user_id):
+        from sigma_core.models.group_member import GroupMember
+        memberships = GroupMember.objects.filter(user_id=user_id)
+        accepted_groups = memberships.filter(is_accepted=True).values('group_id')
+        groups = memberships.values('group_id')
+
+        shared_groups = {}
+        # Groups where user_id is accepted: it can see every member
+        for row in GroupMember.objects.filter(group_id__in=accepted_groups).values('user_id').annotate(n=Count('id')):
+            shared_groups[(user_id, row['user_id'])] = row['n']
+        # Groups user_id belongs to: every accepted member can see it
+        for row in GroupMember.objects.filter(group_id__in=groups, is_accepted=True).values('user_id').annotate(n=Count('id')):
+            shared_groups[(row['user_id'], user_id)] = row['n']
+        return shared_groups
+
+    def rebuild(self):
+        """
+        Recompute the whole index from the GroupMember table.
+        """
+        from sigma_core.models.group_member import GroupMember
+        members_by_group = {}
+        for (group_id, user_id, is_accepted) in GroupMember.objects.values_list('group_id', 'user_id', 'is_accepted'):
+            members_by_group.setdefault(group_id, []).append((user_id, is_accepted))
+
+        shared_groups = {}
+        for members in members_by_group.values():
+            for (user_id, is_accepted) in members:
+                if not is_accepted:
+                    continue
+                for (visible_user_id, _) in members:
+                    key = (user_id, visible_user_id)
+                    shared_groups[key] = shared_groups.get(key, 0) + 1
+
+        self.all().delete()
+        self._bulk_create(shared_groups)
+
+    def _bulk_create(self, shared_groups):
+        self.bulk_create([self.model(user_id=u, visible_user_id=v, shared_groups=n) for ((u, v), n) in shared_groups.items()])
+
+
+class UserVisibility(models.Model):
+    """
+    Materialized index of the Normal Rules of Visibility for users: user can see visible_user iff user is an
+    accepted member of at least one group visible_user belongs to.
+    Kept up to date by GroupMember signals (see sigma_core.signals).
+    """
+    class Meta:
+        unique_together = (("user", "visible_user"),)
+
+    user = models.ForeignKey(User, related_name='visibilities')
+    visible_user = models.ForeignKey(User, related_name='visible_by')
+    # Number of groups justifying that visibility
+    shared_groups = models.PositiveIntegerField(default=0)
+
+    objects = UserVisibilityManager()
+
+    def __str__(self): # pragma: no cover
+        return "User \"%s\" can see User \"%s\"" % (self.user.__str__(), self.visible_user.__str__())
@@ -0,0 +1,59 @@
+from sigma_chat.models.chat_member import ChatMember
+
+
+def _pk(obj):
+    return getattr(obj, 'pk', obj)
+
+
+class PermissionContext(object):
+    """
+    Request-scoped cache of the memberships of an User.
+    Group and chat memberships are each loaded with a single query the first time a permission check needs them,
+    and every subsequent check is answered from memory.
+    Call invalidate() after writing memberships of that User during the same request.
+    """
+    def __init__(self, user):
+        self.user = user
+        self._group_memberships = None
+        self._chat_memberships = None
+
+    @property
+    def group_memberships(self):
+        """
+        Dict group_id => GroupMember for the User.
+        """
+        if self._group_memberships is None:
+            from sigma_core.models.group_member import GroupMember
+            self._group_memberships = {m.group_id: m for m in GroupMember.objects.filter(user_id=self.user.id)}
+        return self._group_memberships
+
+    @property
+    def chat_memberships(self):
+        """
+        Dict chat_id => ChatMember for the User.
+        """
+        if self._chat_memberships is None:
+            self._chat_memberships = {m.chat_id: m for m in ChatMember.objects.filter(user_id=self.user.id)}
+        return self._chat_memberships
+
+    def get_group_membership(self, group):
+        return self.group_memberships.get(_pk(group))
+
+    def get_chat_membership(self, chat):
+        return self.chat_memberships.get(_pk(chat))
+
+    def invalidate(self):
+        self._group_memberships = None
+        self._chat_memberships = None
+
+
+class PermissionContextMiddleware(object):
+    """
+    Drop the PermissionContext of the request's User once the response is built, so that it never outlives the
+    request (the same User instance can be reused, e.g. by force_authenticate in tests).
+    """
+    def process_response(self, request, response):
+        user = getattr(request, 'user', None)
+        if hasattr(user, 'invalidate_permission_context'):
+            user.invalidate_permission_context()
+        return response
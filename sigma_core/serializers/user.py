@@ -25,12 +25,31 @@ class MinimalUserSerializer(serializers.ModelSerializer):
     clusters_ids = serializers.PrimaryKeyRelatedField(queryset=Cluster.objects.all(), many=True, source='clusters')
 
 
+class UserListSerializer(serializers.ListSerializer):
+    """
+    Serialize each User with its child serializer if the requesting user has a cluster or a group in common with it
+    (or is a Sigma admin), and with MinimalUserSerializer otherwise.
+    Common clusters/groups are computed for the whole list in one query.
+    """
+    def to_representation(self, data):
+        users = list(data.all() if hasattr(data, 'all') else data)
+        request_user = self.context['request'].user
+        if request_user.is_sigma_admin():
+            detailed_ids = {u.id for u in users}
+        else:
+            detailed_ids = request_user.get_users_with_common_cluster_or_group([u.id for u in users])
+            detailed_ids.add(request_user.id)
+
+        minimal = MinimalUserSerializer(context=self.context)
+        return [self.child.to_representation(u) if u.id in detailed_ids else minimal.to_representation(u) for u in users]
+
+
 class UserSerializer(serializers.ModelSerializer):
     """
     Serialize an User with related keys.
     """
     class Meta(UserSerializerMeta):
-        pass
+        list_serializer_class = UserListSerializer
 
     photo = ImageSerializer(read_only=True)
     clusters_ids = serializers.PrimaryKeyRelatedField(queryset=Cluster.objects.all(), many=True, source='clusters')
@@ -0,0 +1,53 @@
+import threading
+
+from django.db.models import F
+from django.db.models.functions import Greatest
+from django.db.models.signals import post_save, pre_delete, post_delete
+from django.dispatch import receiver
+
+from sigma_core.models.group import Group, GroupAcknowledgment, GroupAncestry
+from sigma_core.models.group_member import GroupMember
+from sigma_core.models.user_visibility import UserVisibility
+
+
+# Ids of the groups being deleted by the current thread: their memberships are cascade-deleted first
+_deleted_groups = threading.local()
+
+
+def deleted_groups_ids():
+    if not hasattr(_deleted_groups, 'ids'):
+        _deleted_groups.ids = set()
+    return _deleted_groups.ids
+
+
+@receiver(pre_delete, sender=Group)
+def group_deleting(sender, instance, **kwargs):
+    deleted_groups_ids().add(instance.pk)
+
+
+@receiver(post_delete, sender=Group)
+def group_deleted(sender, instance, **kwargs):
+    deleted_groups_ids().discard(instance.pk)
+
+
+@receiver(post_save, sender=GroupMember)
+def group_member_saved(sender, instance, created, **kwargs):
+    if created:
+        Group.objects.filter(pk=instance.group_id).update(members_count=F('members_count') + 1)
+    # Only creations and acceptance changes alter the visibility of users
+    if created or getattr(instance, '_loaded_is_accepted', None) != instance.is_accepted:
+        UserVisibility.objects.refresh_user(instance.user_id)
+    instance._loaded_is_accepted = instance.is_accepted
+
+
+@receiver(post_delete, sender=GroupMember)
+def group_member_deleted(sender, instance, **kwargs):
+    if instance.group_id not in deleted_groups_ids():
+        Group.objects.filter(pk=instance.group_id).update(members_count=Greatest(F('members_count') - 1, 0))
+    UserVisibility.objects.refresh_user(instance.user_id)
+
+
+@receiver(post_save, sender=GroupAcknowledgment)
+@receiver(post_delete, sender=GroupAcknowledgment)
+def group_acknowledgment_changed(sender, instance, **kwargs):
+    GroupAncestry.objects.refresh_subtree(instance.subgroup_id)
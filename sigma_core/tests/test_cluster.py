@@ -46,13 +46,13 @@ class ClusterTests(APITestCase):
         # Client not authenticated but can see clusters list
         response = self.client.get(self.clusters_url)
         self.assertEqual(response.status_code, status.HTTP_200_OK)
-        self.assertEqual(len(response.data), len(self.clusters))
+        self.assertEqual(len(response.data['results']), len(self.clusters))
 
     def test_get_clusters_list_ok(self):
         self.client.force_authenticate(user=self.users[0])
         response = self.client.get(self.clusters_url)
         self.assertEqual(response.status_code, status.HTTP_200_OK)
-        self.assertEqual(len(response.data), len(self.clusters))
+        self.assertEqual(len(response.data['results']), len(self.clusters))
 
 #### Get requests
     def test_get_cluster_unauthed(self):
@@ -86,24 +86,24 @@ class GroupTests(APITestCase):
         self.client.force_authenticate(user=self.users[0])
         response = self.client.get(self.groups_url)
         self.assertEqual(response.status_code, status.HTTP_200_OK)
-        self.assertEqual(len(response.data), 5)
-        self.assertIn(self.groups[0].id, [d['id'] for d in response.data])
-        self.assertNotIn(self.groups[1].id, [d['id'] for d in response.data])
+        self.assertEqual(len(response.data['results']), 5)
+        self.assertIn(self.groups[0].id, [d['id'] for d in response.data['results']])
+        self.assertNotIn(self.groups[1].id, [d['id'] for d in response.data['results']])
 
     def test_get_groups_list_limited_2(self):
         # Client authenticated and can see limited list of groups
         self.client.force_authenticate(user=self.users[1])
         response = self.client.get(self.groups_url)
         self.assertEqual(response.status_code, status.HTTP_200_OK)
-        self.assertEqual(len(response.data), 4)
-        self.assertNotIn(self.groups[4].id, [d['id'] for d in response.data])
+        self.assertEqual(len(response.data['results']), 4)
+        self.assertNotIn(self.groups[4].id, [d['id'] for d in response.data['results']])
 
     def test_get_groups_list_admin(self):
         # Client authenticated and can see limited list of groups
         self.client.force_authenticate(user=self.users[-1])
         response = self.client.get(self.groups_url)
         self.assertEqual(response.status_code, status.HTTP_200_OK)
-        self.assertEqual(len(response.data), 6)
+        self.assertEqual(len(response.data['results']), 6)
 
 #### Get requests
     def test_get_group_unauthed(self):
@@ -227,3 +227,127 @@ class GroupTests(APITestCase):
         self.client.force_authenticate(user=self.users[1])
         response = self.client.put((self.group_url + "invite/") % self.groups[2].id, self.invite_data)
         self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+
+class GroupVisibilityTests(APITestCase):
+    @classmethod
+    def setUpTestData(self):
+        # Summary: 2 users, 6 groups
+        # Group #1 is public, groups #2 to #6 are private
+        # User #1 is accepted in group #2, has a pending request in group #3 and is invited to group #4
+        # Group #5 is acknowledged by group #2, group #6 awaits acknowledgment by group #2
+        super(GroupVisibilityTests, self).setUpTestData()
+        self.users = UserFactory.create_batch(2)
+        self.groups = [GroupFactory(is_private=False)] + GroupFactory.create_batch(5, is_private=True)
+
+        GroupMemberFactory(group=self.groups[1], user=self.users[0], is_accepted=True)
+        GroupMemberFactory(group=self.groups[2], user=self.users[0], is_accepted=False)
+        self.users[0].invited_to_groups.add(self.groups[3])
+        GroupAcknowledgmentFactory(subgroup=self.groups[4], parent_group=self.groups[1], validated=True)
+        GroupAcknowledgmentFactory(subgroup=self.groups[5], parent_group=self.groups[1], validated=False)
+        # Other members must not duplicate rows
+        GroupMemberFactory.create_batch(3, group=self.groups[1], is_accepted=True)
+
+        self.groups_url = '/group/'
+
+    def test_get_list_visibility(self):
+        self.client.force_authenticate(user=self.users[0])
+        response = self.client.get(self.groups_url)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(sorted(g['id'] for g in response.data['results']), [g.id for g in self.groups[:5]])
+
+    def test_get_list_public_only(self):
+        self.client.force_authenticate(user=self.users[1])
+        response = self.client.get(self.groups_url)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual([g['id'] for g in response.data['results']], [self.groups[0].id])
+
+    def test_members_count(self):
+        self.client.force_authenticate(user=self.users[0])
+        response = self.client.get(self.groups_url + "%d/" % self.groups[1].id)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data['members_count'], 4)
+
+        mship = GroupMemberFactory(group=self.groups[1], user=self.users[1])
+        self.assertEqual(reload(self.groups[1]).members_count, 5)
+        mship.delete()
+        self.assertEqual(reload(self.groups[1]).members_count, 4)
+
+    def test_members_count_floor(self):
+        mship = GroupMemberFactory(group=self.groups[1], user=self.users[1])
+        Group.objects.filter(pk=self.groups[1].id).update(members_count=0)
+        mship.delete()
+        self.assertEqual(reload(self.groups[1]).members_count, 0)
+
+    def test_get_list_constant_queries(self):
+        self.client.force_authenticate(user=self.users[0])
+        with self.assertNumQueries(1):
+            response = self.client.get(self.groups_url)
+        GroupFactory.create_batch(20, is_private=False)
+        with self.assertNumQueries(1):
+            response = self.client.get(self.groups_url)
+        self.assertEqual(len(response.data['results']), 25)
+
+
+class GroupAncestryTests(APITestCase):
+    def setUp(self):
+        # Summary: 5 groups, 1 user
+        # Group #2 is acknowledged by group #1, groups #3 and #4 by group #2, group #4 also by group #1
+        # Group #5 awaits acknowledgment by group #4
+        # User #1 is member of group #1, all groups are public except group #3
+        super(GroupAncestryTests, self).setUp()
+        self.groups = GroupFactory.create_batch(5)
+        self.groups[2].is_private = True
+        self.groups[2].save()
+        self.acks = [
+            GroupAcknowledgmentFactory(subgroup=self.groups[1], parent_group=self.groups[0], validated=True),
+            GroupAcknowledgmentFactory(subgroup=self.groups[2], parent_group=self.groups[1], validated=True),
+            GroupAcknowledgmentFactory(subgroup=self.groups[3], parent_group=self.groups[1], validated=True),
+            GroupAcknowledgmentFactory(subgroup=self.groups[3], parent_group=self.groups[0], validated=True),
+            GroupAcknowledgmentFactory(subgroup=self.groups[4], parent_group=self.groups[3], validated=False),
+        ]
+        self.user = UserFactory()
+        GroupMemberFactory(group=self.groups[0], user=self.user, is_accepted=True)
+
+        self.subtree_url = '/group/%d/subtree/'
+        self.ancestors_url = '/group/%d/ancestors/'
+
+    def depths(self, group):
+        return {link.ancestor_id: link.depth for link in group.ancestor_links.all()}
+
+    def test_model_ancestry(self):
+        g = self.groups
+        self.assertEqual(self.depths(g[2]), {g[0].id: 2, g[1].id: 1})
+        self.assertEqual(self.depths(g[3]), {g[0].id: 1, g[1].id: 1})
+        self.assertEqual(self.depths(g[4]), {})
+        with self.assertNumQueries(1):
+            self.assertEqual(set(g[0].descendants), {g[1], g[2], g[3]})
+        with self.assertNumQueries(1):
+            self.assertTrue(g[2].is_descendant_of(g[0]))
+        self.assertFalse(g[0].is_descendant_of(g[2]))
+
+    def test_ancestry_after_changes(self):
+        g = self.groups
+        self.acks[4].validated = True
+        self.acks[4].save()
+        self.assertEqual(self.depths(g[4]), {g[0].id: 2, g[1].id: 2, g[3].id: 1})
+
+        self.acks[0].delete()
+        self.assertEqual(self.depths(g[2]), {g[1].id: 1})
+        self.assertEqual(self.depths(g[4]), {g[0].id: 2, g[1].id: 2, g[3].id: 1})
+
+        g[1].delete()
+        self.assertEqual(self.depths(g[4]), {g[0].id: 2, g[3].id: 1})
+
+    def test_get_subtree(self):
+        self.client.force_authenticate(user=self.user)
+        response = self.client.get(self.subtree_url % self.groups[0].id)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        # Group #3 is private and not visible
+        self.assertEqual({(d['id'], d['depth']) for d in response.data['results']}, {(self.groups[1].id, 1), (self.groups[3].id, 1)})
+
+    def test_get_ancestors(self):
+        self.client.force_authenticate(user=self.user)
+        response = self.client.get(self.ancestors_url % self.groups[3].id)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual({d['id'] for d in response.data['results']}, {self.groups[0].id, self.groups[1].id})
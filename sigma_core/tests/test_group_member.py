@@ -70,7 +70,7 @@ class GroupMemberVisibilityTests(APITestCase):
         response = self.client.get(url)
         self.assertEqual(response.status_code, expectedStatus)
         if expectedStatus == status.HTTP_200_OK:
-            self.assertEqual(len(response.data), expectedLength)
+            self.assertEqual(len(response.data['results']), expectedLength)
         return response
 
     def test_get_mship_unauthed(self):
@@ -0,0 +1,50 @@
+from rest_framework import status
+from rest_framework.test import APITestCase
+
+from sigma_core.tests.factories import UserFactory, GroupFactory, GroupMemberFactory
+from sigma_chat.tests.factories import ChatFactory, ChatMemberFactory
+
+
+class PermissionContextTests(APITestCase):
+    def setUp(self):
+        # Summary: 1 user, 2 groups, 2 chats
+        # User #1 is admin of group #1 and not member of group #2
+        # User #1 is admin of chat #1 and banned from chat #2
+        super(PermissionContextTests, self).setUp()
+        self.user = UserFactory()
+        self.groups = GroupFactory.create_batch(2)
+        self.chats = ChatFactory.create_batch(2)
+        GroupMemberFactory(group=self.groups[0], user=self.user, is_accepted=True, is_administrator=True, can_invite=True)
+        ChatMemberFactory(chat=self.chats[0], user=self.user, is_admin=True)
+        ChatMemberFactory(chat=self.chats[1], user=self.user, is_member=False, is_banned=True)
+
+    def test_memberships_loaded_once(self):
+        u = self.user
+        with self.assertNumQueries(2):
+            self.assertTrue(u.is_group_member(self.groups[0]))
+            self.assertTrue(u.can_invite(self.groups[0]))
+            self.assertTrue(u.has_group_admin_perm(self.groups[0]))
+            self.assertFalse(u.is_group_member(self.groups[1]))
+            self.assertFalse(u.can_modify_group_infos(self.groups[1]))
+            self.assertTrue(u.is_chat_admin(self.chats[0]))
+            self.assertTrue(u.is_chat_member(self.chats[0]))
+            self.assertFalse(u.is_chat_banned(self.chats[0]))
+            self.assertTrue(u.is_chat_banned(self.chats[1]))
+            self.assertFalse(u.is_chat_member(self.chats[1].id))
+
+    def test_invalidate(self):
+        u = self.user
+        self.assertFalse(u.is_group_member(self.groups[1]))
+        GroupMemberFactory(group=self.groups[1], user=u, is_accepted=True)
+        self.assertFalse(u.is_group_member(self.groups[1]))
+        u.invalidate_permission_context()
+        self.assertTrue(u.is_group_member(self.groups[1]))
+
+    def test_context_dropped_after_request(self):
+        u = self.user
+        self.assertFalse(u.is_group_member(self.groups[1]))
+        GroupMemberFactory(group=self.groups[1], user=u, is_accepted=True)
+        self.client.force_authenticate(user=u)
+        response = self.client.get('/chat/')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertTrue(u.is_group_member(self.groups[1]))
@@ -117,42 +117,42 @@ class UserTests(APITestCase):
         self.client.force_authenticate(user=self.users[0])
         response = self.client.get(self.user_url)
         self.assertEqual(response.status_code, status.HTTP_200_OK)
-        self.assertEqual(len(response.data), 6)
+        self.assertEqual(len(response.data['results']), 6)
 
     def test_get_users_list_user4(self):
         # Client authenticated: user in cluster #1, can see users in cluster #1
         self.client.force_authenticate(user=self.users[3])
         response = self.client.get(self.user_url)
         self.assertEqual(response.status_code, status.HTTP_200_OK)
-        self.assertEqual(len(response.data), 5)
+        self.assertEqual(len(response.data['results']), 5)
 
     def test_get_users_list_user5(self):
         # Client authenticated: user in clusters #1 and #2, can see eveybody (except admin user) then
         self.client.force_authenticate(user=self.users[4])
         response = self.client.get(self.user_url)
         self.assertEqual(response.status_code, status.HTTP_200_OK)
-        self.assertEqual(len(response.data), 9)
+        self.assertEqual(len(response.data['results']), 9)
 
     def test_get_users_list_user6(self):
         # Client authenticated: user in cluster #2, pending request to group #2 (cannot see members yet)
         self.client.force_authenticate(user=self.users[5])
         response = self.client.get(self.user_url)
         self.assertEqual(response.status_code, status.HTTP_200_OK)
-        self.assertEqual(len(response.data), 5)
+        self.assertEqual(len(response.data['results']), 5)
 
     def test_get_users_list_user8(self):
         # Client authenticated: user in cluster #2, invited to group #2 (cannot see members yet)
         self.client.force_authenticate(user=self.users[7])
         response = self.client.get(self.user_url)
         self.assertEqual(response.status_code, status.HTTP_200_OK)
-        self.assertEqual(len(response.data), 5)
+        self.assertEqual(len(response.data['results']), 5)
 
     def test_get_users_list_admin_user(self):
         # Client authenticated: Sigma admin, can see everyone
         self.client.force_authenticate(user=self.users[9])
         response = self.client.get(self.user_url)
         self.assertEqual(response.status_code, status.HTTP_200_OK)
-        self.assertEqual(len(response.data), 10)
+        self.assertEqual(len(response.data['results']), 10)
 
 #### Get requests
     def test_get_user_unauthed(self):
@@ -493,3 +493,59 @@ class UserTests(APITestCase):
     #     response = self.client.delete(self.user_url + "%d/" % self.users[3].id)
     #     self.assertEqual(response.status_code, status.HTTP_204_NO_CONTENT)
     #     # Guarantee independance of tests
+
+
+class CommonClusterGroupTests(APITestCase):
+    @classmethod
+    def setUpTestData(self):
+        # Summary: 2 clusters, 1 group, 4 users
+        # Cluster #1: users #1 and #2, Cluster #2: users #3 and #4
+        # Group #1: users #1 and #3 (pending request)
+        super(CommonClusterGroupTests, self).setUpTestData()
+        self.clusters = ClusterFactory.create_batch(2)
+        self.users = UserFactory.create_batch(4)
+        self.group = GroupFactory()
+
+        self.clusters[0].cluster_users.add(self.users[0], self.users[1])
+        self.clusters[1].cluster_users.add(self.users[2], self.users[3])
+        GroupMemberFactory(group=self.group, user=self.users[0], is_accepted=True)
+        GroupMemberFactory(group=self.group, user=self.users[2], is_accepted=False)
+
+        self.user_url = '/user/%d/'
+
+    def test_has_common_cluster(self):
+        with self.assertNumQueries(1):
+            self.assertTrue(self.users[0].has_common_cluster(self.users[1]))
+        self.assertFalse(self.users[0].has_common_cluster(self.users[2]))
+
+    def test_has_common_group(self):
+        with self.assertNumQueries(1):
+            self.assertTrue(self.users[0].has_common_group(self.users[2]))
+        # Non symmetric: user #3 has not been accepted in group #1
+        self.assertFalse(self.users[2].has_common_group(self.users[0]))
+        self.assertFalse(self.users[0].has_common_group(self.users[3]))
+
+    def test_get_users_with_common_cluster_or_group(self):
+        ids = [u.id for u in self.users]
+        with self.assertNumQueries(1):
+            common = self.users[0].get_users_with_common_cluster_or_group(ids)
+        self.assertEqual(common, {self.users[0].id, self.users[1].id, self.users[2].id})
+        self.assertEqual(self.users[3].get_users_with_common_cluster_or_group(ids), {self.users[2].id, self.users[3].id})
+
+    def test_list_serializer_chooses_per_row(self):
+        request = type('Request', (), {'user': self.users[0]})
+        data = UserSerializer(User.objects.filter(pk__in=[self.users[1].id, self.users[3].id]).order_by('pk'), many=True, context={'request': request}).data
+        self.assertIn('email', data[0])
+        self.assertNotIn('email', data[1])
+
+    def test_get_user_minimal(self):
+        self.client.force_authenticate(user=self.users[1])
+        response = self.client.get(self.user_url % self.users[3].id)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data, MinimalUserSerializer(self.users[3]).data)
+
+    def test_get_user_detailed(self):
+        self.client.force_authenticate(user=self.users[0])
+        response = self.client.get(self.user_url % self.users[2].id)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertIn('email', response.data)
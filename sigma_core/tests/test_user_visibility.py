@@ -0,0 +1,81 @@
+from rest_framework import status
+from rest_framework.test import APITestCase
+
+from sigma_core.tests.factories import UserFactory, GroupFactory, GroupMemberFactory
+from sigma_core.models.user_visibility import UserVisibility
+
+
+def visible_ids(user):
+    return set(UserVisibility.objects.visible_users_ids(user))
+
+
+class UserVisibilityTests(APITestCase):
+    def setUp(self):
+        # Summary: 2 groups, 4 users
+        # Group #1: users #1, #2 and #3 (pending request)
+        # Group #2: users #2 and #4
+        super(UserVisibilityTests, self).setUp()
+        self.users = UserFactory.create_batch(4)
+        self.groups = GroupFactory.create_batch(2)
+
+        self.memberships = [
+            GroupMemberFactory(group=self.groups[0], user=self.users[0], is_accepted=True),
+            GroupMemberFactory(group=self.groups[0], user=self.users[1], is_accepted=True),
+            GroupMemberFactory(group=self.groups[0], user=self.users[2], is_accepted=False),
+            GroupMemberFactory(group=self.groups[1], user=self.users[1], is_accepted=True),
+            GroupMemberFactory(group=self.groups[1], user=self.users[3], is_accepted=True),
+        ]
+
+        self.user_url = '/user/'
+
+#### Index maintenance
+    def test_index_after_creation(self):
+        u = self.users
+        self.assertEqual(visible_ids(u[0]), {u[0].id, u[1].id, u[2].id})
+        self.assertEqual(visible_ids(u[1]), {u[0].id, u[1].id, u[2].id, u[3].id})
+        self.assertEqual(visible_ids(u[2]), set())
+        self.assertEqual(visible_ids(u[3]), {u[1].id, u[3].id})
+        self.assertEqual(UserVisibility.objects.get(user=u[1], visible_user=u[1]).shared_groups, 2)
+
+    def test_index_after_acceptance(self):
+        u = self.users
+        self.memberships[2].is_accepted = True
+        self.memberships[2].save()
+        self.assertEqual(visible_ids(u[2]), {u[0].id, u[1].id, u[2].id})
+
+        self.memberships[2].is_accepted = False
+        self.memberships[2].save()
+        self.assertEqual(visible_ids(u[2]), set())
+        self.assertIn(u[2].id, visible_ids(u[0]))
+
+    def test_index_after_membership_deletion(self):
+        u = self.users
+        self.memberships[1].delete()
+        self.assertEqual(visible_ids(u[0]), {u[0].id, u[2].id})
+        self.assertEqual(visible_ids(u[1]), {u[1].id, u[3].id})
+
+    def test_index_after_group_deletion(self):
+        u = self.users
+        self.groups[0].delete()
+        self.assertEqual(visible_ids(u[0]), set())
+        self.assertEqual(visible_ids(u[1]), {u[1].id, u[3].id})
+        self.assertEqual(UserVisibility.objects.get(user=u[1], visible_user=u[1]).shared_groups, 1)
+
+    def test_rebuild(self):
+        expected = set(UserVisibility.objects.values_list('user_id', 'visible_user_id', 'shared_groups'))
+        UserVisibility.objects.all().delete()
+        UserVisibility.objects.rebuild()
+        self.assertEqual(set(UserVisibility.objects.values_list('user_id', 'visible_user_id', 'shared_groups')), expected)
+
+#### List requests
+    def test_get_list_uses_index(self):
+        self.client.force_authenticate(user=self.users[3])
+        response = self.client.get(self.user_url)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual({u['id'] for u in response.data['results']}, {self.users[1].id, self.users[3].id})
+
+    def test_get_list_pending_member(self):
+        self.client.force_authenticate(user=self.users[2])
+        response = self.client.get(self.user_url)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(len(response.data['results']), 0)
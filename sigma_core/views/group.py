@@ -7,7 +7,7 @@ from rest_framework.permissions import IsAuthenticated
 from dry_rest_permissions.generics import DRYPermissionFiltersBase
 
 from sigma_core.models.user import User
-from sigma_core.models.group import Group
+from sigma_core.models.group import Group, GroupAcknowledgment, GroupAncestry
 from sigma_core.models.group_member import GroupMember
 from sigma_core.serializers.group import GroupSerializer
 
@@ -20,11 +20,17 @@ class GroupFilterBackend(DRYPermissionFiltersBase):
         if request.user.is_sigma_admin():
             return queryset
 
-        invited_to_groups_ids = request.user.invited_to_groups.all().values_list('id', flat=True)
-        user_groups_ids = request.user.memberships.filter(is_accepted=True).values_list('group_id', flat=True)
-        return queryset.prefetch_related('memberships', 'group_parents') \
-            .filter(Q(is_private=False) | Q(memberships__user=request.user) | Q(id__in=invited_to_groups_ids) | Q(group_parents__id__in=user_groups_ids)) \
-            .distinct()
+        # Every condition is a semi-join on an indexed column (IN subquery): no join fan-out, hence no DISTINCT
+        my_memberships = GroupMember.objects.filter(user_id=request.user.id)
+        user_groups_ids = my_memberships.filter(is_accepted=True).values('group_id')
+        invited_to_groups_ids = User.invited_to_groups.through.objects.filter(user_id=request.user.id).values('group_id')
+        acknowledged_groups_ids = GroupAcknowledgment.objects.filter(validated=True, parent_group_id__in=user_groups_ids).values('subgroup_id')
+        return queryset.filter(
+            Q(is_private=False) |
+            Q(id__in=my_memberships.values('group_id')) |
+            Q(id__in=invited_to_groups_ids) |
+            Q(id__in=acknowledged_groups_ids)
+        )
 
 
 class GroupViewSet(viewsets.ModelViewSet):
@@ -78,3 +84,31 @@ class GroupViewSet(viewsets.ModelViewSet):
             raise Http404("Group %d not found" % pk)
         except User.DoesNotExist:
             raise Http404("User %d not found" % request.data.get('user_id', None))
+
+    def _ancestry_response(self, links, group_field):
+        # Only list groups visible w.r.t. the Normal Rules of Visibility
+        visible_groups_ids = self.filter_queryset(Group.objects.all()).values('id')
+        links = links.filter(**{group_field + '_id__in': visible_groups_ids}).select_related(group_field)
+        page = self.paginate_queryset(links)
+        data = [dict(GroupSerializer(getattr(link, group_field)).data, depth=link.depth) for link in page]
+        return self.get_paginated_response(data)
+
+    @decorators.detail_route(methods=['get'])
+    def subtree(self, request, pk=None):
+        """
+        List all the groups acknowledged by group pk, directly or not, with their depth below it.
+        ---
+        response_serializer: GroupSerializer
+        """
+        group = self.get_object()
+        return self._ancestry_response(GroupAncestry.objects.filter(ancestor=group), 'descendant')
+
+    @decorators.detail_route(methods=['get'])
+    def ancestors(self, request, pk=None):
+        """
+        List all the groups that acknowledge group pk, directly or not, with their depth above it.
+        ---
+        response_serializer: GroupSerializer
+        """
+        group = self.get_object()
+        return self._ancestry_response(GroupAncestry.objects.filter(descendant=group), 'ancestor')
@@ -83,6 +83,7 @@ class GroupMemberViewSet(viewsets.ModelViewSet):
             return Response('You cannot join this group without an invitation', status=status.HTTP_403_FORBIDDEN)
 
         mem = serializer.save()
+        request.user.invalidate_permission_context()
         return Response(serializer.data, status=status.HTTP_201_CREATED)
 
     def destroy(self, request, pk=None):
@@ -105,6 +106,7 @@ class GroupMemberViewSet(viewsets.ModelViewSet):
                 return Response(status=status.HTTP_403_FORBIDDEN)
 
         modified_mship.delete()
+        request.user.invalidate_permission_context()
         return Response(status=status.HTTP_204_NO_CONTENT)
 
     def can_modify_basic_rights(self, request, modified_mship, my_mship):
@@ -187,6 +189,7 @@ class GroupMemberViewSet(viewsets.ModelViewSet):
 
         my_mship.save()
         modified_mship.save()
+        request.user.invalidate_permission_context()
 
         return Response(GroupMemberSerializer(modified_mship).data, status=status.HTTP_200_OK)
 
@@ -208,6 +211,7 @@ class GroupMemberViewSet(viewsets.ModelViewSet):
 
         gm.is_accepted = True
         gm.save()
+        request.user.invalidate_permission_context()
 
         # TODO: notify user of that change
 
@@ -5,7 +5,7 @@ import operator
 from functools import reduce
 
 from django.core.mail import send_mail
-from django.db.models import Q, Prefetch
+from django.db.models import F, Q, Prefetch
 from django.http import Http404
 from django.views.decorators.csrf import csrf_exempt
 
@@ -15,6 +15,7 @@ from rest_framework.permissions import IsAuthenticated, AllowAny
 
 from sigma_core.models.user import User
 from sigma_core.models.group_member import GroupMember
+from sigma_core.models.user_visibility import UserVisibility
 from sigma_core.serializers.user import UserSerializer, MinimalUserSerializer, MyUserSerializer
 
 
@@ -38,7 +39,8 @@ class UserViewSet(mixins.CreateModelMixin,      # Only Cluster admins can create
                     mixins.DestroyModelMixin,   # Only self or Sigma admin
                     viewsets.GenericViewSet):
     permission_classes = [IsAuthenticated, ]
-    queryset = User.objects.all()
+    # The renditions of the photos are prefetched so that UserSerializer gives their stored URLs
+    queryset = User.objects.select_related('photo').prefetch_related('photo__renditions')
     serializer_class = UserSerializer
 
     def perform_create(self, serializer):
@@ -50,6 +52,9 @@ class UserViewSet(mixins.CreateModelMixin,      # Only Cluster admins can create
         # But how to do it properly ?
         memberships = [GroupMember(group=Group(id=c), user=User(id=serializer.data['id']),) for c in serializer.data['clusters_ids']]
         GroupMember.objects.bulk_create(memberships)
+        # bulk_create does not send signals
+        Group.objects.filter(pk__in=serializer.data['clusters_ids']).update(members_count=F('members_count') + 1)
+        UserVisibility.objects.refresh_user(serializer.data['id'])
 
     def list(self, request, *args, **kwargs):
         """
@@ -57,14 +62,15 @@ class UserViewSet(mixins.CreateModelMixin,      # Only Cluster admins can create
         """
         # Sigma admins can list all the users
         if request.user.is_sigma_admin():
-            return super().list(self, request, args, kwargs)
+            return super().list(request, *args, **kwargs)
 
-        # We get visible users ids w.r.t. the Normal Rules of Visibility, based on their belongings to common clusters/groups (let's anticipate the pagination)
+        # Visible users w.r.t. the Normal Rules of Visibility are read from the UserVisibility index
         # Since clusters are groups, we only check that condition for groups
-        groups_ids = request.user.memberships.filter(is_accepted=True).values_list('group_id', flat=True)
-        qs = User.objects.prefetch_related('memberships').filter(is_active=True, memberships__group__id__in=groups_ids).distinct()
-        s = UserSerializer(qs, many=True, context={'request': request})
-        return Response(s.data, status=status.HTTP_200_OK)
+        qs = User.objects.select_related('photo').prefetch_related('photo__renditions') \
+            .filter(is_active=True, visible_by__user=request.user)
+        page = self.paginate_queryset(qs)
+        s = UserSerializer(page, many=True, context={'request': request})
+        return self.get_paginated_response(s.data)
 
     def retrieve(self, request, pk=None):
         """
@@ -72,13 +78,13 @@ class UserViewSet(mixins.CreateModelMixin,      # Only Cluster admins can create
         """
         # 1. Retrieve user
         try:
-            user = User.objects.all().prefetch_related('clusters').select_related('photo').get(pk=pk)
+            user = User.objects.all().prefetch_related('clusters', 'photo__renditions').select_related('photo').get(pk=pk)
         except User.DoesNotExist:
             return Response(status=status.HTTP_404_NOT_FOUND)
 
         # 2. Check permissions to choose serializer
         # Admin, oneself, common cluster or common group: can see detailed user
-        if request.user.is_sigma_admin() or user.id == request.user.id or request.user.has_common_cluster(user) or request.user.has_common_group(user):
+        if request.user.is_sigma_admin() or user.id == request.user.id or user.id in request.user.get_users_with_common_cluster_or_group([user.id]):
             s = UserSerializer(user, context={'request': request})
         else : # Others can only see minimal information
             s = MinimalUserSerializer(user, context={'request': request})
@@ -114,7 +120,7 @@ class UserViewSet(mixins.CreateModelMixin,      # Only Cluster admins can create
         response_serializer: MyUserSerializer
         """
         user = User.objects.all().select_related('photo').prefetch_related(
-            Prefetch('memberships', queryset=GroupMember.objects.all().select_related('group'))
+            'photo__renditions', Prefetch('memberships', queryset=GroupMember.objects.all().select_related('group'))
         ).get(pk=request.user.id)
         s = MyUserSerializer(user, context={'request': request})
         return Response(s.data, status=status.HTTP_200_OK)
@@ -0,0 +1,24 @@
+from django.core.management.base import BaseCommand
+
+from sigma_files.models import Image
+
+
+class Command(BaseCommand):
+    help = "Read the size, hash, dimensions and format of the Images saved before they were stored in the database."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--all', action='store_true', help="Also read again the Images which already have metadata")
+
+    def handle(self, *args, **options):
+        images = Image.objects.all() if options['all'] else Image.objects.filter(sha256='')
+        done = missing = 0
+        for image in images.order_by('pk').iterator():
+            try:
+                image.read_metadata()
+            except (IOError, OSError) as e:
+                missing += 1
+                self.stderr.write("Image %d: cannot read %s (%s)" % (image.pk, image.file.name, e))
+                continue
+            image.save(update_fields=['height', 'width', 'size', 'format', 'sha256'])
+            done += 1
+        self.stdout.write("%d images updated, %d unreadable" % (done, missing))
@@ -0,0 +1,20 @@
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from sigma_files.models import UploadSession
+
+
+class Command(BaseCommand):
+    help = "Delete the upload sessions, and their partial files, which received nothing for UPLOAD_SESSIONS['EXPIRY'] seconds."
+
+    def handle(self, *args, **options):
+        expired = UploadSession.objects.filter(
+            updated__lt=timezone.now() - timedelta(seconds=settings.UPLOAD_SESSIONS['EXPIRY']))
+        count = 0
+        for session in expired.iterator():
+            session.delete()
+            count += 1
+        self.stdout.write("%d upload sessions deleted" % count)
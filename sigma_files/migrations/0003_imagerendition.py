@@ -0,0 +1,33 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.9 on 2026-10-18 19:44
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+import sigma_files.models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('sigma_files', '0002_image_metadata'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ImageRendition',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('size', models.PositiveSmallIntegerField()),
+                ('format', models.CharField(max_length=8)),
+                ('file', models.ImageField(max_length=255, upload_to=sigma_files.models.rendition_path)),
+                ('width', models.PositiveIntegerField()),
+                ('height', models.PositiveIntegerField()),
+                ('image', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='renditions', to='sigma_files.Image')),
+            ],
+        ),
+        migrations.AlterUniqueTogether(
+            name='imagerendition',
+            unique_together=set([('image', 'size', 'format')]),
+        ),
+    ]
@@ -0,0 +1,37 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.9 on 2026-10-18 20:22
+from __future__ import unicode_literals
+
+from collections import Counter
+
+from django.db import migrations, models
+
+
+def count_references(apps, schema_editor):
+    StoredFile = apps.get_model('sigma_files', 'StoredFile')
+    refcounts = Counter()
+    for (app_label, model_name, field) in [('sigma_files', 'Image', 'file'), ('sigma_files', 'ImageRendition', 'file'),
+                                           ('sigma_chat', 'Message', 'attachment')]:
+        model = apps.get_model(app_label, model_name)
+        refcounts.update(model.objects.exclude(**{field: ''}).values_list(field, flat=True).iterator())
+    StoredFile.objects.bulk_create([StoredFile(name=name, refcount=n) for (name, n) in refcounts.items()], batch_size=500)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('sigma_files', '0004_uploadsession'),
+        ('sigma_chat', '0010_message_attachment_index'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='StoredFile',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=255, unique=True)),
+                ('refcount', models.PositiveIntegerField(default=0)),
+            ],
+        ),
+        migrations.RunPython(count_references, migrations.RunPython.noop),
+    ]
@@ -1,11 +1,18 @@
+import fcntl
+import hashlib
 import os.path
+import uuid
 
-from django.db import models
+from django.conf import settings
+from django.db import models, transaction
+from django.utils import timezone
+from PIL import Image as PIL_Image
 
 from dry_rest_permissions.generics import allow_staff_or_superuser
 
 from sigma_core.models.user import User
 from sigma_core.models.group import Group
+from sigma_files.storage import StoredFilesModel
 
 
 def img_path(instance, filename):
@@ -14,17 +21,65 @@ def img_path(instance, filename):
     return "img/" + get_random_string(length=150, allowed_chars='abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789-_') + extension
 
 
-class Image(models.Model):
+class Image(StoredFilesModel):
     file = models.ImageField(max_length=255, upload_to=img_path)
     owner = models.ForeignKey(User)
     added = models.DateTimeField(auto_now_add=True)
 
+    # Metadata of the file, read once when it is saved so that serializing an Image does not open it.
+    # Not ImageField.height_field/width_field: they are read again from the file on every instance load while unknown.
+    height = models.PositiveIntegerField(null=True, editable=False)
+    width = models.PositiveIntegerField(null=True, editable=False)
+    size = models.PositiveIntegerField(null=True, editable=False)
+    format = models.CharField(max_length=16, blank=True, editable=False)
+    sha256 = models.CharField(max_length=64, blank=True, editable=False, db_index=True)
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        # Used by save() to detect file changes
+        instance._loaded_file = instance.__dict__.get('file')
+        return instance
+
     def __str__(self):
         return self.file.__str__()
 
-    def delete(self, *args, **kwargs):
-        self.file.delete(save=False)
-        return super(Image, self).delete(*args, **kwargs)
+    def read_metadata(self):
+        """Set size, sha256, height, width and format from the file (None/'' when it is not a readable image)."""
+        f = self.file
+        closed = f.closed
+        if closed:
+            f.open('rb')
+        try:
+            sha256 = hashlib.sha256()
+            size = 0
+            for chunk in f.chunks():
+                sha256.update(chunk)
+                size += len(chunk)
+            self.size = size
+            self.sha256 = sha256.hexdigest()
+            # Given to the storage, which receives the field file itself and names new files after their hash (see
+            # sigma_files.storage)
+            f.sha256 = self.sha256
+            f.seek(0)
+            try:
+                img = PIL_Image.open(f)
+                self.width, self.height = img.size
+                self.format = img.format or ''
+            except (IOError, SyntaxError, ValueError):
+                self.width, self.height, self.format = None, None, ''
+            f.seek(0)
+        finally:
+            if closed:
+                f.close()
+
+    def save(self, *args, **kwargs):
+        # Used by sigma_files.signals to generate the renditions of new files
+        self._file_changed = bool(self.file) and self.file.name != getattr(self, '_loaded_file', None)
+        if self.file and (self._file_changed or not self.sha256):
+            self.read_metadata()
+        super().save(*args, **kwargs)
+        self._loaded_file = self.file.name
 
     # Permissions
     @staticmethod
@@ -40,3 +95,145 @@ class Image(models.Model):
 
     def has_object_write_permission(self, request):
         return request.user == self.owner
+
+
+class StoredFileManager(models.Manager):
+    def lock(self, name):
+        """Return the StoredFile of name, created if needed, locked until the end of the current transaction."""
+        return self.select_for_update().get_or_create(name=name)[0]
+
+    def acquire(self, name):
+        with transaction.atomic():
+            self.lock(name)
+            self.filter(name=name).update(refcount=models.F('refcount') + 1)
+
+    def release(self, name, storage):
+        """Remove a reference to name: storage deletes the file once the transaction commits, if it is the last one."""
+        with transaction.atomic():
+            self.lock(name)
+            self.filter(name=name, refcount__gt=0).update(refcount=models.F('refcount') - 1)
+            transaction.on_commit(lambda: storage.delete(name))
+
+
+class StoredFile(models.Model):
+    """
+    A file of ContentAddressedStorage, with the number of rows referencing it (see StoredFilesModel). Identical
+    contents share their file, which is deleted with its last reference.
+    """
+    name = models.CharField(max_length=255, unique=True)
+    refcount = models.PositiveIntegerField(default=0)
+
+    objects = StoredFileManager()
+
+    def __str__(self):
+        return self.name
+
+
+def rendition_path(instance, filename):
+    stem = os.path.splitext(os.path.basename(instance.image.file.name))[0]
+    return "img/renditions/%s_%d.%s" % (stem, instance.size, ImageRendition.EXTENSIONS[instance.format])
+
+
+class ImageRendition(StoredFilesModel):
+    """A resized and re-encoded variant of an Image, fitting in a size x size square (see sigma_files.renditions)."""
+    class Meta:
+        unique_together = (("image", "size", "format"),)
+
+    EXTENSIONS = {'jpeg': 'jpg', 'webp': 'webp'}
+
+    image = models.ForeignKey(Image, related_name='renditions')
+    size = models.PositiveSmallIntegerField()
+    format = models.CharField(max_length=8)
+    file = models.ImageField(max_length=255, upload_to=rendition_path)
+    width = models.PositiveIntegerField()
+    height = models.PositiveIntegerField()
+
+    def __str__(self):
+        return self.file.__str__()
+
+
+class UploadSession(models.Model):
+    """
+    A resumable upload: the client sends the file by chunks, at increasing offsets, which are appended to a partial
+    file as they are received, then finalizes it into an Image or a Message attachment (see UploadSessionViewSet).
+    Options are read from settings.UPLOAD_SESSIONS = {'DIR': path, 'MAX_SIZE': bytes, 'EXPIRY': seconds}.
+    """
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    owner = models.ForeignKey(User, related_name='upload_sessions')
+    filename = models.CharField(max_length=255)
+    size = models.BigIntegerField()
+    sha256 = models.CharField(max_length=64, blank=True)  # checked on completion if given
+    offset = models.BigIntegerField(default=0, editable=False)  # bytes received so far
+    created = models.DateTimeField(auto_now_add=True)
+    updated = models.DateTimeField(auto_now=True)
+
+    chunk_size = 64 * 1024
+
+    @property
+    def path(self):
+        return os.path.join(settings.UPLOAD_SESSIONS['DIR'], str(self.id))
+
+    @property
+    def is_complete(self):
+        return self.offset == self.size
+
+    def append(self, stream, length):
+        """
+        Write length bytes read from stream at the current offset, chunk by chunk, then advance the offset of the
+        session unless another chunk was appended since it was loaded: return False then, with the current offset.
+        If reading stream fails, the bytes received until then are kept and the error is raised.
+        No database transaction is held while the bytes are received: the chunks of a session are written one at a
+        time under a lock of the partial file, and the offset is advanced only if it is still the one written at.
+        """
+        expected = self.offset
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        with os.fdopen(os.open(self.path, os.O_RDWR | os.O_CREAT, 0o600), 'r+b') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)  # released when f is closed
+            if UploadSession.objects.filter(pk=self.pk, offset=expected).exists():
+                # Bytes past the offset were not acknowledged to the client: they are sent again
+                f.seek(expected)
+                f.truncate()
+                try:
+                    while length > 0:
+                        data = stream.read(min(self.chunk_size, length))
+                        if not data:
+                            break
+                        f.write(data)
+                        length -= len(data)
+                        self.offset += len(data)
+                finally:
+                    f.flush()
+                    advanced = UploadSession.objects.filter(pk=self.pk, offset=expected) \
+                        .update(offset=self.offset, updated=timezone.now())
+                    if not advanced:
+                        self.refresh_from_db(fields=['offset'])
+                return bool(advanced)
+        self.refresh_from_db(fields=['offset'])
+        return False
+
+    def file_sha256(self):
+        sha256 = hashlib.sha256()
+        with open(self.path, 'rb') as f:
+            for chunk in iter(lambda: f.read(self.chunk_size), b''):
+                sha256.update(chunk)
+        return sha256.hexdigest()
+
+    def delete(self, *args, **kwargs):
+        if os.path.exists(self.path):
+            os.remove(self.path)
+        return super().delete(*args, **kwargs)
+
+    # Permissions
+    @staticmethod
+    def has_read_permission(request):
+        return True
+
+    def has_object_read_permission(self, request):
+        return request.user == self.owner
+
+    @staticmethod
+    def has_write_permission(request):
+        return True
+
+    def has_object_write_permission(self, request):
+        return request.user == self.owner
@@ -0,0 +1,134 @@
+# -*- coding: utf-8 -*-
+"""
+Resized and re-encoded variants of the uploaded images, for clients which do not need the original.
+
+Every new Image gets its renditions generated by a pool of background threads once it is committed; a missing
+rendition (older image, failed or pending generation) is generated on demand by GET /image/{pk}/rendition/ and kept.
+
+Options are read from settings.IMAGE_RENDITIONS = {'SIZES': [64, 256, 1024], 'FORMATS': ['jpeg', 'webp'],
+'QUALITY': 85, 'WORKERS': 2}.
+"""
+import logging
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.db import IntegrityError, close_old_connections, transaction
+from PIL import Image as PIL_Image
+
+from sigma_files.models import Image, ImageRendition
+
+
+logger = logging.getLogger(__name__)
+
+DEFAULTS = {'SIZES': [64, 256, 1024], 'FORMATS': ['jpeg', 'webp'], 'QUALITY': 85, 'WORKERS': 2}
+
+
+def get_option(name):
+    return getattr(settings, 'IMAGE_RENDITIONS', {}).get(name, DEFAULTS[name])
+
+
+def variants():
+    """The (size, format) pairs to generate for each Image."""
+    return [(size, fmt) for size in get_option('SIZES') for fmt in get_option('FORMATS')]
+
+
+def encode(original, size, fmt):
+    """Return (data, width, height): the PIL image original fitted in a size x size square (never enlarged), in fmt."""
+    img = original.copy()
+    img.thumbnail((size, size), PIL_Image.LANCZOS)
+    if fmt == 'jpeg' and img.mode not in ('RGB', 'L'):
+        # JPEG has no alpha channel: flatten on white
+        background = PIL_Image.new('RGB', img.size, (255, 255, 255))
+        rgba = img.convert('RGBA')
+        background.paste(rgba, mask=rgba.split()[3])
+        img = background
+    out = BytesIO()
+    img.save(out, format=fmt.upper(), quality=get_option('QUALITY'))
+    return out.getvalue(), img.width, img.height
+
+
+def render(image, pairs=None):
+    """
+    Generate the renditions (size, format) of image which do not exist yet, and return them all by (size, format).
+    The original is opened and decoded once. Raise IOError if it is not a readable image.
+    """
+    pairs = variants() if pairs is None else pairs
+    renditions = {(r.size, r.format): r for r in image.renditions.all()}
+    missing = [p for p in pairs if p not in renditions]
+    if not missing:
+        return renditions
+
+    f = image.file
+    f.open('rb')
+    try:
+        original = PIL_Image.open(f)
+        original.load()
+    finally:
+        f.close()
+    for (size, fmt) in missing:
+        data, width, height = encode(original, size, fmt)
+        rendition = ImageRendition(image=image, size=size, format=fmt, width=width, height=height)
+        try:
+            # Stored and referenced in the same transaction (see sigma_files.storage)
+            with transaction.atomic():
+                rendition.file.save('rendition', ContentFile(data))
+        except IntegrityError:
+            # Generated concurrently by another worker or request: keep theirs
+            rendition.file.delete(save=False)
+            rendition = ImageRendition.objects.get(image=image, size=size, format=fmt)
+        renditions[(size, fmt)] = rendition
+    return renditions
+
+
+class RenditionPool(object):
+    """Generate the renditions of Images in a pool of background threads."""
+
+    def __init__(self, workers=2):
+        self.workers = workers
+        self._executor = None
+        self._lock = threading.Lock()
+        self._pid = None
+
+    def _get_executor(self):
+        # Threads do not survive fork() (e.g. preloaded WSGI workers): create a pool per process
+        if self._pid != os.getpid():
+            with self._lock:
+                if self._pid != os.getpid():
+                    self._executor = ThreadPoolExecutor(max_workers=self.workers)
+                    self._pid = os.getpid()
+        return self._executor
+
+    def submit(self, image_id):
+        return self._get_executor().submit(self._render, image_id)
+
+    @staticmethod
+    def _render(image_id):
+        close_old_connections()
+        try:
+            render(Image.objects.get(pk=image_id))
+        except Image.DoesNotExist:
+            pass
+        except Exception:
+            # The renditions will be generated on demand
+            logger.exception("Could not generate the renditions of Image %d", image_id)
+        finally:
+            close_old_connections()
+
+
+_pool = None
+
+
+def get_pool():
+    global _pool
+    if _pool is None:
+        _pool = RenditionPool(workers=get_option('WORKERS'))
+    return _pool
+
+
+def schedule(image_id):
+    """Generate the renditions of Image image_id in the background once the current transaction is committed."""
+    transaction.on_commit(lambda: get_pool().submit(image_id))
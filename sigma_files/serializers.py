@@ -1,7 +1,10 @@
+from django.conf import settings
+from django.core.urlresolvers import reverse
 from rest_framework import serializers
 
 from sigma.utils import CurrentUserCreateOnlyDefault
-from sigma_files.models import Image
+from sigma_files.models import Image, UploadSession
+from sigma_files.renditions import variants
 
 
 class ImageSerializer(serializers.ModelSerializer):
@@ -9,6 +12,33 @@ class ImageSerializer(serializers.ModelSerializer):
         model = Image
 
     file = serializers.ImageField(max_length=255)
-    height = serializers.IntegerField(source='file.height', read_only=True)
-    width = serializers.IntegerField(source='file.width', read_only=True)
     owner = serializers.PrimaryKeyRelatedField(read_only=True, default=CurrentUserCreateOnlyDefault())
+    renditions = serializers.SerializerMethodField()
+
+    def get_renditions(self, obj):
+        """
+        URLs of the renditions of the Image, by size then format. Unless the renditions were prefetched, or while one is
+        missing, the URL is the one of the endpoint generating it on demand, so that serialization makes no query.
+        """
+        request = self.context.get('request', None)
+        generated = {}
+        if 'renditions' in getattr(obj, '_prefetched_objects_cache', {}):
+            generated = {(r.size, r.format): r.file.url for r in obj.renditions.all()}
+        endpoint = reverse('image-rendition', args=[obj.pk])
+        urls = {}
+        for (size, fmt) in variants():
+            url = generated.get((size, fmt), None) or '%s?size=%d&type=%s' % (endpoint, size, fmt)
+            urls.setdefault(str(size), {})[fmt] = request.build_absolute_uri(url) if request is not None else url
+        return urls
+
+
+class UploadSessionSerializer(serializers.ModelSerializer):
+    class Meta:
+        model = UploadSession
+        fields = ('id', 'filename', 'size', 'sha256', 'offset', 'created', 'updated', )
+
+    def validate_size(self, value):
+        max_size = settings.UPLOAD_SESSIONS['MAX_SIZE']
+        if value <= 0 or value > max_size:
+            raise serializers.ValidationError("The size must be between 1 and %d bytes." % max_size)
+        return value
@@ -0,0 +1,27 @@
+from django.apps import apps
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from sigma_files.models import Image, StoredFile
+from sigma_files.renditions import schedule
+from sigma_files.storage import StoredFilesModel
+
+
+@receiver(post_save, sender=Image)
+def image_saved(sender, instance, **kwargs):
+    if getattr(instance, '_file_changed', False):
+        schedule(instance.pk)
+
+
+def stored_files_model_deleted(sender, instance, **kwargs):
+    # Sent within the transaction of the deletion, cascades included
+    for field in sender.stored_file_fields():
+        name = getattr(instance, field.attname).name
+        if name:
+            StoredFile.objects.release(name, field.storage)
+
+
+# Connected to each model rather than to all senders, which would keep Django from fast deleting the other models
+for model in apps.get_models():
+    if issubclass(model, StoredFilesModel):
+        post_delete.connect(stored_files_model_deleted, sender=model)
@@ -0,0 +1,125 @@
+# -*- coding: utf-8 -*-
+import hashlib
+import os
+import tempfile
+
+from django.apps import apps
+from django.core.files.storage import FileSystemStorage
+from django.db import models, transaction
+
+
+class ContentAddressedStorage(FileSystemStorage):
+    """
+    Store each content once, named after its SHA-256: <namespace>/<h[0:2]>/<h[2:4]>/<h><extension>, where namespace
+    is the first directory of the name given by upload_to (img, uploads). Saving a content which is already stored
+    only returns its name, and a stored file is deleted only when no row references it anymore: the rows referencing
+    each file are counted by sigma_files.models.StoredFile, whose row also locks the file while it is saved or deleted.
+    The two levels of 256 subdirectories keep directories small however many files are stored.
+    A content whose digest is already known (e.g. by Image.read_metadata) carries it in its sha256 attribute and is not
+    read again to hash it.
+    """
+    fanout = 2
+
+    def get_available_name(self, name, max_length=None):
+        # The name is chosen by _save from the content: identical names mean identical contents
+        return name
+
+    def hashed_name(self, name, content):
+        digest = getattr(content, 'sha256', None)
+        if not digest:
+            sha256 = hashlib.sha256()
+            for chunk in content.chunks():
+                sha256.update(chunk)
+            digest = sha256.hexdigest()
+        name = name.replace('\\', '/')
+        parts = [name.split('/', 1)[0]] if '/' in name else []
+        parts += [digest[2 * i:2 * i + 2] for i in range(self.fanout)]
+        parts.append(digest + os.path.splitext(name)[1].lower())
+        return '/'.join(parts)
+
+    def _save(self, name, content):
+        name = self.hashed_name(name, content)
+        with transaction.atomic():
+            # Locked until the transaction saving the row which references the file commits (see StoredFilesModel)
+            apps.get_model('sigma_files', 'StoredFile').objects.lock(name)
+            if not self.exists(name):
+                self._write(name, content)
+        return name
+
+    def _write(self, name, content):
+        full_path = self.path(name)
+        directory = os.path.dirname(full_path)
+        if not os.path.exists(directory):
+            try:
+                if self.directory_permissions_mode is not None:
+                    old_umask = os.umask(0)
+                    try:
+                        os.makedirs(directory, self.directory_permissions_mode)
+                    finally:
+                        os.umask(old_umask)
+                else:
+                    os.makedirs(directory)
+            except FileExistsError:
+                pass
+
+        # Written aside then renamed: a concurrent upload of the same content replaces the file with the same bytes
+        fd, tmp_path = tempfile.mkstemp(dir=directory, prefix='.upload-')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                for chunk in content.chunks():
+                    f.write(chunk)
+            os.chmod(tmp_path, self.file_permissions_mode if self.file_permissions_mode is not None else 0o644)
+            os.replace(tmp_path, full_path)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+
+    def delete(self, name):
+        """Delete the file, unless a row still references it."""
+        StoredFile = apps.get_model('sigma_files', 'StoredFile')
+        with transaction.atomic():
+            stored = StoredFile.objects.lock(name)
+            if stored.refcount == 0:
+                super(ContentAddressedStorage, self).delete(name)
+                stored.delete()
+
+
+class StoredFilesModel(models.Model):
+    """
+    Base of the models with FileFields stored by ContentAddressedStorage: the files they reference are counted in
+    sigma_files.models.StoredFile, in the transaction which saves or deletes the row (see sigma_files.signals).
+    """
+    class Meta:
+        abstract = True
+
+    @classmethod
+    def stored_file_fields(cls):
+        return [field for field in cls._meta.concrete_fields
+                if isinstance(field, models.FileField) and isinstance(field.storage, ContentAddressedStorage)]
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        # Used by save() to count the references to the files it replaces
+        instance._loaded_files = {field.attname: instance.__dict__.get(field.attname) or ''
+                                  for field in cls.stored_file_fields() if field.attname in instance.__dict__}
+        return instance
+
+    def save(self, *args, **kwargs):
+        StoredFile = apps.get_model('sigma_files', 'StoredFile')
+        update_fields = kwargs.get('update_fields', None)
+        loaded = getattr(self, '_loaded_files', {})
+        with transaction.atomic():
+            super().save(*args, **kwargs)
+            for field in self.stored_file_fields():
+                if field.attname not in self.__dict__ or (update_fields is not None and field.name not in update_fields):
+                    continue
+                name, previous = getattr(self, field.attname).name or '', loaded.get(field.attname, '')
+                if name != previous:
+                    if name:
+                        StoredFile.objects.acquire(name)
+                    if previous:
+                        StoredFile.objects.release(previous, field.storage)
+                    loaded[field.attname] = name
+        self._loaded_files = loaded
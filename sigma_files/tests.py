@@ -1,18 +1,52 @@
+import hashlib
 import json
+import os
+import shutil
+import tempfile
+from datetime import timedelta
+from io import BytesIO, StringIO
+from unittest import mock
 from PIL import Image as PIL_Image
 
+from django.conf import settings
+from django.core.files.storage import default_storage
 from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management import call_command
+from django.test import override_settings
+from django.utils import timezone
 
 from rest_framework import status
-from rest_framework.test import APITestCase, force_authenticate
+from rest_framework.test import APITestCase, APITransactionTestCase, force_authenticate
 
-from sigma_core.tests.factories import UserFactory
+from sigma_core.tests.factories import UserFactory, AdminUserFactory
+from sigma_chat.tests.factories import ChatFactory, ChatMemberFactory, MessageFactory
 from sigma_core.serializers.user import UserSerializer
-from sigma_files.models import Image
+from sigma_files.models import Image, StoredFile, UploadSession
+from sigma_chat.models.message import Message
 from sigma_files.serializers import ImageSerializer
+from sigma_files.renditions import render
 
 
-class ImageTests(APITestCase):
+class TemporaryMediaMixin(object):
+    """Store the files of the tests of the class in a temporary directory, removed afterwards."""
+    @classmethod
+    def setUpClass(cls):
+        cls.media_root = tempfile.mkdtemp()
+        cls.media_settings = override_settings(
+            MEDIA_ROOT=cls.media_root,
+            UPLOAD_SESSIONS=dict(settings.UPLOAD_SESSIONS, DIR=os.path.join(cls.media_root, 'uploads-partial')),
+        )
+        cls.media_settings.enable()
+        super(TemporaryMediaMixin, cls).setUpClass()
+
+    @classmethod
+    def tearDownClass(cls):
+        super(TemporaryMediaMixin, cls).tearDownClass()
+        cls.media_settings.disable()
+        shutil.rmtree(cls.media_root, ignore_errors=True)
+
+
+class ImageTests(TemporaryMediaMixin, APITestCase):
     @classmethod
     def setUpTestData(self):
         super(ImageTests, self).setUpTestData()
@@ -76,3 +110,421 @@ class ImageTests(APITestCase):
         except Image.DoesNotExist:
             img = None # File has been deleted
         self.assertEqual(img, None)
+
+
+class ImageMetadataTests(TemporaryMediaMixin, APITestCase):
+    def setUp(self):
+        super(ImageMetadataTests, self).setUp()
+        self.user = UserFactory()
+        with open("sigma_files/test_img.png", "rb") as img:
+            self.content = img.read()
+        self.image = Image.objects.create(file=SimpleUploadedFile(name='test.png', content=self.content), owner=self.user)
+
+    def tearDown(self):
+        if default_storage.exists(self.image.file.name):
+            self.image.file.delete(save=False)
+        super(ImageMetadataTests, self).tearDown()
+
+    def assertMetadata(self, image):
+        self.assertEqual((image.width, image.height, image.format), (273, 297, 'PNG'))
+        self.assertEqual(image.size, len(self.content))
+        self.assertEqual(image.sha256, hashlib.sha256(self.content).hexdigest())
+
+    def test_metadata_on_create(self):
+        self.assertMetadata(Image.objects.get(pk=self.image.pk))
+        # The storage names the file after the hash read_metadata computed
+        self.assertIn(self.image.sha256, self.image.file.name)
+
+    def test_hashed_once(self):
+        with mock.patch('hashlib.sha256', wraps=hashlib.sha256) as sha256:
+            image = Image.objects.create(file=SimpleUploadedFile(name='other.png', content=self.content + b'\0'), owner=self.user)
+        self.assertEqual(sha256.call_count, 1)
+        self.assertIn(image.sha256, image.file.name)
+
+        self.client.force_authenticate(user=self.user)
+        with open("sigma_files/test_img.png", "rb") as img, mock.patch('hashlib.sha256', wraps=hashlib.sha256) as sha256:
+            response = self.client.post('/image/', {'file': img}, format='multipart')
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(sha256.call_count, 1)
+
+    def test_metadata_on_upload(self):
+        self.client.force_authenticate(user=self.user)
+        with open("sigma_files/test_img.png", "rb") as img:
+            response = self.client.post('/image/', {'file': img}, format='multipart')
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual((response.data['width'], response.data['height'], response.data['format']), (273, 297, 'PNG'))
+        Image.objects.get(pk=response.data['id']).delete()
+
+    def test_not_an_image(self):
+        image = Image.objects.create(file=SimpleUploadedFile(name='test.jpg', content=b'not an image'), owner=self.user)
+        self.assertEqual((image.width, image.height, image.format, image.size), (None, None, '', 12))
+        image.delete()
+
+    def test_serialize_without_file_io(self):
+        self.user.photo = self.image
+        self.user.save()
+        os.remove(self.image.file.path)
+        data = UserSerializer(self.user).data
+        self.assertEqual((data['photo']['width'], data['photo']['height']), (273, 297))
+
+    def test_backfill(self):
+        Image.objects.filter(pk=self.image.pk).update(height=None, width=None, size=None, format='', sha256='')
+        out = StringIO()
+        call_command('backfill_image_metadata', stdout=out)
+        self.assertIn("1 images updated", out.getvalue())
+        self.assertMetadata(Image.objects.get(pk=self.image.pk))
+
+
+class ImageRenditionTests(TemporaryMediaMixin, APITestCase):
+    def setUp(self):
+        super(ImageRenditionTests, self).setUp()
+        self.user = UserFactory()
+        with open("sigma_files/test_img.png", "rb") as img:
+            self.image = Image.objects.create(file=SimpleUploadedFile(name='test.png', content=img.read()), owner=self.user)
+        self.rendition_url = '/image/%d/rendition/' % self.image.id
+
+    def tearDown(self):
+        if self.image.pk is not None:
+            self.image.delete()
+        super(ImageRenditionTests, self).tearDown()
+
+    def test_render(self):
+        renditions = render(self.image)
+        self.assertEqual(len(renditions), 6)
+        small = renditions[(64, 'webp')]
+        self.assertEqual((small.width, small.height), (59, 64))
+        self.assertEqual(PIL_Image.open(small.file.path).format, 'WEBP')
+        self.assertEqual(PIL_Image.open(renditions[(1024, 'jpeg')].file.path).size, (273, 297))
+        # Existing renditions are kept
+        self.assertEqual(render(self.image)[(64, 'webp')].file.name, small.file.name)
+
+    def test_get_rendition_on_demand(self):
+        self.client.force_authenticate(user=self.user)
+        response = self.client.get(self.rendition_url, {'size': 256}, HTTP_ACCEPT='image/webp,*/*')
+        self.assertEqual(response.status_code, status.HTTP_302_FOUND)
+        rendition = self.image.renditions.get()
+        self.assertEqual((rendition.size, rendition.format), (256, 'webp'))
+        self.assertTrue(response['Location'].endswith(rendition.file.url))
+
+        response = self.client.get(self.rendition_url, {'size': 256, 'type': 'jpeg'})
+        self.assertEqual(response.status_code, status.HTTP_302_FOUND)
+        self.assertEqual(self.image.renditions.count(), 2)
+
+    def test_get_rendition_invalid(self):
+        self.client.force_authenticate(user=self.user)
+        response = self.client.get(self.rendition_url, {'size': 100})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        response = self.client.get(self.rendition_url, {'size': 64, 'type': 'gif'})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_serializer_urls(self):
+        data = ImageSerializer(self.image).data
+        self.assertEqual(data['renditions']['64']['jpeg'], self.rendition_url + '?size=64&type=jpeg')
+        render(self.image, [(64, 'jpeg')])
+        image = Image.objects.prefetch_related('renditions').get(pk=self.image.pk)
+        with self.assertNumQueries(0):
+            data = ImageSerializer(image).data
+        self.assertEqual(data['renditions']['64']['jpeg'], self.image.renditions.get().file.url)
+        self.assertEqual(data['renditions']['64']['webp'], self.rendition_url + '?size=64&type=webp')
+
+    def test_user_list_urls(self):
+        # Every user list gives the stored URLs of the renditions, including the one of Sigma admins
+        render(self.image)
+        self.user.photo = self.image
+        self.user.save()
+        self.client.force_authenticate(user=AdminUserFactory())
+        response = self.client.get('/user/')
+        photo = next(u['photo'] for u in response.data['results'] if u['id'] == self.user.id)
+        self.assertTrue(photo['renditions']['64']['jpeg'].endswith(self.image.renditions.get(size=64, format='jpeg').file.url))
+
+
+
+class ContentAddressedStorageTests(TemporaryMediaMixin, APITestCase):
+    def setUp(self):
+        super(ContentAddressedStorageTests, self).setUp()
+        self.user = UserFactory()
+        with open("sigma_files/test_img.png", "rb") as img:
+            self.content = img.read()
+
+    def create(self, name='test.png', content=None):
+        return Image.objects.create(file=SimpleUploadedFile(name=name, content=content or self.content), owner=self.user)
+
+    def test_name(self):
+        image = self.create(name='Test.PNG')
+        digest = hashlib.sha256(self.content).hexdigest()
+        self.assertEqual(image.file.name, 'img/%s/%s/%s.png' % (digest[:2], digest[2:4], digest))
+        self.assertEqual(image.sha256, digest)
+        image.delete()
+
+    def test_different_contents(self):
+        images = [self.create(), self.create(content=b'other')]
+        self.assertNotEqual(images[0].file.name, images[1].file.name)
+        for image in images:
+            image.delete()
+
+
+class StoredFileTests(TemporaryMediaMixin, APITransactionTestCase):
+    # Files are deleted once the deletions of their last references are committed
+    def setUp(self):
+        super(StoredFileTests, self).setUp()
+        # Committed here: keep the rendition threads from using the test database concurrently
+        patcher = mock.patch('sigma_files.signals.schedule')
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.user = UserFactory()
+        with open("sigma_files/test_img.png", "rb") as img:
+            self.content = img.read()
+
+    def create(self, content=None):
+        return Image.objects.create(file=SimpleUploadedFile(name='test.png', content=content or self.content), owner=self.user)
+
+    def test_deduplication(self):
+        images = [self.create(), self.create()]
+        self.assertEqual(images[0].file.name, images[1].file.name)
+        self.assertEqual(StoredFile.objects.get(name=images[0].file.name).refcount, 2)
+        path = images[0].file.path
+        images[0].delete()
+        self.assertTrue(os.path.exists(path))
+        self.assertEqual(Image.objects.get(pk=images[1].pk).file.read(), self.content)
+        images[1].delete()
+        self.assertFalse(os.path.exists(path))
+        self.assertFalse(StoredFile.objects.filter(name=images[0].file.name).exists())
+
+    def test_replace_file(self):
+        image = self.create()
+        path = image.file.path
+        image.file = SimpleUploadedFile(name='other.png', content=b'other')
+        image.save()
+        self.assertFalse(os.path.exists(path))
+        self.assertEqual(StoredFile.objects.get(name=image.file.name).refcount, 1)
+        image.delete()
+
+    def test_delete_removes_renditions(self):
+        image = self.create()
+        path = render(image)[(64, 'jpeg')].file.path
+        image.delete()
+        self.assertFalse(os.path.exists(path))
+
+    def test_message_attachment(self):
+        image = self.create()
+        chatmember = ChatMemberFactory(user=self.user)
+        message = MessageFactory(chatmember_id=chatmember, chat_id=chatmember.chat,
+                                 attachment=SimpleUploadedFile(name='test.png', content=self.content))
+        self.assertEqual(StoredFile.objects.get(name=image.file.name).refcount, 1)
+        self.assertEqual(StoredFile.objects.get(name=message.attachment.name).refcount, 1)
+        # Deleted with the chat
+        path = message.attachment.path
+        chatmember.chat.delete()
+        self.assertFalse(os.path.exists(path))
+        self.assertTrue(os.path.exists(image.file.path))
+        image.delete()
+
+
+class MediaViewTests(TemporaryMediaMixin, APITestCase):
+    def setUp(self):
+        super(MediaViewTests, self).setUp()
+        self.users = UserFactory.create_batch(2)
+        with open("sigma_files/test_img.png", "rb") as img:
+            self.content = img.read()
+        self.image = Image.objects.create(file=SimpleUploadedFile(name='test.png', content=self.content), owner=self.users[0])
+        self.image_url = '/media/' + self.image.file.name
+
+        chat = ChatFactory()
+        chatmember = ChatMemberFactory(chat=chat, user=self.users[0])
+        self.message = MessageFactory(chat_id=chat, chatmember_id=chatmember,
+                                      attachment=SimpleUploadedFile(name='notes.txt', content=b'0123456789' * 10))
+        self.attachment_url = '/media/' + self.message.attachment.name
+
+    def tearDown(self):
+        self.image.delete()
+        self.message.attachment.delete(save=False)
+        super(MediaViewTests, self).tearDown()
+
+    def test_get_image(self):
+        response = self.client.get(self.image_url)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(b''.join(response.streaming_content), self.content)
+        self.assertEqual(response['Content-Type'], 'image/png')
+        self.assertEqual(response['Accept-Ranges'], 'bytes')
+        self.assertEqual(response['Cache-Control'], 'public')
+
+    def test_html_image(self):
+        image = Image.objects.create(file=SimpleUploadedFile(name='page.html', content=b'<script>alert(1)</script>'), owner=self.users[0])
+        response = self.client.get('/media/' + image.file.name)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response['Content-Type'], 'application/octet-stream')
+        self.assertEqual(response['X-Content-Type-Options'], 'nosniff')
+        image.delete()
+
+    def test_html_attachment(self):
+        chatmember = ChatMemberFactory(user=self.users[0])
+        message = MessageFactory(chat_id=chatmember.chat, chatmember_id=chatmember,
+                                 attachment=SimpleUploadedFile(name='page.html', content=b'<script>alert(1)</script>'))
+        self.client.force_authenticate(user=self.users[0])
+        response = self.client.get('/media/' + message.attachment.name)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response['X-Content-Type-Options'], 'nosniff')
+        self.assertTrue(response['Content-Disposition'].startswith('attachment'))
+
+    def test_conditional(self):
+        etag = self.client.get(self.image_url)['ETag']
+        response = self.client.get(self.image_url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, status.HTTP_304_NOT_MODIFIED)
+        response = self.client.get(self.image_url, HTTP_IF_NONE_MATCH='"other"')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+    def test_range(self):
+        self.client.force_authenticate(user=self.users[0])
+        response = self.client.get(self.attachment_url, HTTP_RANGE='bytes=5-14')
+        self.assertEqual(response.status_code, status.HTTP_206_PARTIAL_CONTENT)
+        self.assertEqual(b''.join(response.streaming_content), b'5678901234')
+        self.assertEqual(response['Content-Range'], 'bytes 5-14/100')
+        self.assertEqual(response['Cache-Control'], 'private')
+
+        response = self.client.get(self.attachment_url, HTTP_RANGE='bytes=-3')
+        self.assertEqual(b''.join(response.streaming_content), b'789')
+        response = self.client.get(self.attachment_url, HTTP_RANGE='bytes=100-')
+        self.assertEqual(response.status_code, status.HTTP_416_REQUESTED_RANGE_NOT_SATISFIABLE)
+        self.assertEqual(response['Content-Range'], 'bytes */100')
+        # The file changed since the client got the beginning of it: send all of it
+        response = self.client.get(self.attachment_url, HTTP_RANGE='bytes=5-14', HTTP_IF_RANGE='"old"')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+    def test_attachment_permissions(self):
+        response = self.client.get(self.attachment_url)
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+        self.client.force_authenticate(user=self.users[1])
+        response = self.client.get(self.attachment_url)
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+        self.client.force_authenticate(user=self.users[0])
+        response = self.client.get(self.attachment_url)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+    def test_not_found(self):
+        self.assertEqual(self.client.get('/media/img/missing.png').status_code, status.HTTP_404_NOT_FOUND)
+        self.assertEqual(self.client.get('/media/../sigma/settings.py').status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_offload(self):
+        with override_settings(MEDIA_SERVE={'MODE': 'x-accel-redirect', 'INTERNAL_URL': '/protected-media/'}):
+            response = self.client.get(self.image_url, HTTP_RANGE='bytes=0-9')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response['X-Accel-Redirect'], '/protected-media/' + self.image.file.name)
+        self.assertEqual(response.content, b'')
+        with override_settings(MEDIA_SERVE={'MODE': 'x-sendfile'}):
+            response = self.client.get(self.image_url)
+        self.assertEqual(response['X-Sendfile'], self.image.file.path)
+
+
+class UploadSessionTests(TemporaryMediaMixin, APITestCase):
+    def setUp(self):
+        super(UploadSessionTests, self).setUp()
+        self.users = UserFactory.create_batch(2)
+        with open("sigma_files/test_img.png", "rb") as img:
+            self.content = img.read()
+        self.chatmember = ChatMemberFactory(user=self.users[0])
+        self.uploads_url = '/upload/'
+        self.client.force_authenticate(user=self.users[0])
+
+    def tearDown(self):
+        for session in UploadSession.objects.all():
+            session.delete()
+        super(UploadSessionTests, self).tearDown()
+
+    def create(self, content=None, sha256=None):
+        content = self.content if content is None else content
+        data = {'filename': 'photo.png', 'size': len(content)}
+        if sha256 is not None:
+            data['sha256'] = sha256
+        response = self.client.post(self.uploads_url, data)
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        return self.uploads_url + '%s/' % response.data['id']
+
+    def put_chunk(self, url, offset, data):
+        return self.client.put(url + 'chunk/?offset=%d' % offset, data, content_type='application/octet-stream')
+
+    def upload(self, url, content, start=0, chunk=1000):
+        for offset in range(start, len(content), chunk):
+            response = self.put_chunk(url, offset, content[offset:offset + chunk])
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+        return response
+
+    def test_resume(self):
+        url = self.create()
+        self.assertEqual(self.put_chunk(url, 0, self.content[:1000]).data['offset'], 1000)
+        # Chunk sent again after a lost response: the client is told where to resume
+        response = self.put_chunk(url, 0, self.content[:1000])
+        self.assertEqual(response.status_code, status.HTTP_409_CONFLICT)
+        self.assertEqual(response.data['offset'], 1000)
+        self.assertEqual(self.client.get(url).data['offset'], 1000)
+        response = self.upload(url, self.content, start=1000)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+    def test_append_concurrent(self):
+        url = self.create()
+        session = UploadSession.objects.get()
+        stale = UploadSession.objects.get()
+        self.assertTrue(session.append(BytesIO(self.content[:1000]), 1000))
+        # Loaded before the first chunk was appended: nothing is written, and the offset to resume from is loaded
+        self.assertFalse(stale.append(BytesIO(b'x' * 1000), 1000))
+        self.assertEqual(stale.offset, 1000)
+        with open(session.path, 'rb') as f:
+            self.assertEqual(f.read(), self.content[:1000])
+
+    def test_chunk_too_long(self):
+        url = self.create(content=b'abc')
+        self.assertEqual(self.put_chunk(url, 0, b'abcd').status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_create_too_large(self):
+        with override_settings(UPLOAD_SESSIONS={'DIR': '/nonexistent', 'MAX_SIZE': 10, 'EXPIRY': 60}):
+            response = self.client.post(self.uploads_url, {'filename': 'a.png', 'size': 11})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_other_user(self):
+        url = self.create()
+        self.client.force_authenticate(user=self.users[1])
+        self.assertEqual(self.client.get(url).status_code, status.HTTP_404_NOT_FOUND)
+        self.assertEqual(self.put_chunk(url, 0, b'a').status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_finalize_image(self):
+        url = self.create(sha256=hashlib.sha256(self.content).hexdigest())
+        self.put_chunk(url, 0, self.content[:10])
+        self.assertEqual(self.client.post(url + 'finalize/', {'target': 'image'}).status_code, status.HTTP_409_CONFLICT)
+        self.upload(url, self.content, start=10)
+        response = self.client.post(url + 'finalize/', {'target': 'image'})
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        image = Image.objects.get(pk=response.data['id'])
+        self.assertEqual((image.owner, image.width, image.sha256), (self.users[0], 273, hashlib.sha256(self.content).hexdigest()))
+        self.assertFalse(UploadSession.objects.exists())
+        image.delete()
+
+    def test_finalize_sha256_mismatch(self):
+        url = self.create(sha256='0' * 64)
+        self.upload(url, self.content)
+        response = self.client.post(url + 'finalize/', {'target': 'image'})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertFalse(UploadSession.objects.exists())
+
+    def test_finalize_message(self):
+        url = self.create(content=b'x' * 5000)
+        self.upload(url, b'x' * 5000)
+        response = self.client.post(url + 'finalize/', {'target': 'message', 'chatmember_id': self.chatmember.id, 'text': 'hi'})
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        message = Message.objects.get(pk=response.data['id'])
+        self.assertEqual(message.attachment.read(), b'x' * 5000)
+        self.assertTrue(message.attachment.name.endswith('.png'))
+        message.attachment.delete(save=False)
+
+    def test_finalize_message_forbidden(self):
+        url = self.create()
+        self.upload(url, self.content)
+        other = ChatMemberFactory(user=self.users[1])
+        response = self.client.post(url + 'finalize/', {'target': 'message', 'chatmember_id': other.id})
+        self.assertEqual(response.status_code, status.HTTP_403_FORBIDDEN)
+        self.assertTrue(UploadSession.objects.exists())
+
+    def test_purge(self):
+        url = self.create()
+        self.put_chunk(url, 0, self.content[:10])
+        UploadSession.objects.update(updated=timezone.now() - timedelta(days=2))
+        call_command('purge_upload_sessions', stdout=StringIO())
+        self.assertFalse(UploadSession.objects.exists())
@@ -1,16 +1,343 @@
-from django.http import Http404
+import mimetypes
+import os
 
-from rest_framework import viewsets, decorators, status, parsers
+from django.conf import settings
+from django.core.exceptions import SuspiciousFileOperation
+from django.core.files import File
+from django.http import FileResponse, Http404, HttpResponse, HttpResponseNotModified, HttpResponseRedirect, StreamingHttpResponse
+from django.http.request import UnreadablePostError
+from django.utils._os import safe_join
+from django.utils.http import http_date, urlquote
+from django.views.static import was_modified_since
+
+from PIL import Image as PIL_Image
+from rest_framework import viewsets, mixins, decorators, status, parsers
+from rest_framework.negotiation import BaseContentNegotiation
 from rest_framework.response import Response
+from rest_framework.views import APIView
 from rest_framework.permissions import IsAuthenticated
 from dry_rest_permissions.generics import DRYPermissions
 
-from sigma_files.models import Image
-from sigma_files.serializers import ImageSerializer
+from sigma_files.models import Image, UploadSession
+from sigma_files.serializers import ImageSerializer, UploadSessionSerializer
+from sigma_files.renditions import get_option, render
 
 
 class ImageViewSet(viewsets.ModelViewSet):
-    queryset = Image.objects.all()
+    queryset = Image.objects.all().prefetch_related('renditions')
     serializer_class = ImageSerializer
     permission_classes = [IsAuthenticated, DRYPermissions, ]
     parser_classes = [parsers.JSONParser, parsers.MultiPartParser, ]
+
+    @decorators.detail_route(methods=['get'])
+    def rendition(self, request, pk=None):
+        """
+        Redirect to the rendition of Image pk fitting in a size x size square, generated if missing. The type is
+        jpeg or webp, by default webp if the client accepts it.
+        ---
+        omit_serializer: true
+        parameters_strategy:
+            query: replace
+        parameters:
+            - name: size
+              type: integer
+              paramType: query
+              required: true
+            - name: type
+              type: string
+              paramType: query
+        """
+        image = self.get_object()
+        try:
+            size = int(request.query_params.get('size', ''))
+        except ValueError:
+            size = None
+        fmt = request.query_params.get('type', None)
+        if fmt is None:
+            fmt = 'webp' if 'image/webp' in request.META.get('HTTP_ACCEPT', '') and 'webp' in get_option('FORMATS') else 'jpeg'
+        if size not in get_option('SIZES') or fmt not in get_option('FORMATS'):
+            return Response("size must be one of %s and type one of %s." % (get_option('SIZES'), get_option('FORMATS')),
+                            status=status.HTTP_400_BAD_REQUEST)
+
+        try:
+            rendition = render(image, [(size, fmt)])[(size, fmt)]
+        except (IOError, SyntaxError, ValueError):
+            raise Http404("Image {0} cannot be decoded".format(pk))
+        return HttpResponseRedirect(request.build_absolute_uri(rendition.file.url))
+
+
+class UploadSessionViewSet(mixins.CreateModelMixin, mixins.RetrieveModelMixin, mixins.DestroyModelMixin, viewsets.GenericViewSet):
+    """
+    Resumable uploads, for large files and unreliable connections:
+        - POST /upload/ {filename, size, sha256 (optional)} creates an upload session;
+        - PUT /upload/{id}/chunk/?offset={offset} appends the raw request body to the file, streamed to disk;
+        - GET /upload/{id}/ gives the offset to resume from after a failure;
+        - POST /upload/{id}/finalize/ turns the complete file into an Image or the attachment of a new Message;
+        - DELETE /upload/{id}/ aborts the upload.
+    """
+    serializer_class = UploadSessionSerializer
+    permission_classes = [IsAuthenticated, DRYPermissions, ]
+
+    def get_queryset(self):
+        return UploadSession.objects.filter(owner=self.request.user)
+
+    def perform_create(self, serializer):
+        serializer.save(owner=self.request.user)
+
+    @decorators.detail_route(methods=['put'])
+    def chunk(self, request, pk=None):
+        """
+        Append the request body (Content-Type: application/octet-stream) to the upload, at offset, which must be the
+        number of bytes already received. Return the session with its new offset, or with 409 Conflict the session
+        with the offset to resume from.
+        ---
+        omit_serializer: true
+        parameters_strategy:
+            query: replace
+        parameters:
+            - name: offset
+              type: integer
+              paramType: query
+              required: true
+        """
+        session = self.get_object()
+        try:
+            offset = int(request.query_params.get('offset', ''))
+            length = int(request.META.get('CONTENT_LENGTH') or 0)
+        except ValueError:
+            return Response("offset must be an integer.", status=status.HTTP_400_BAD_REQUEST)
+
+        if offset != session.offset:
+            return Response(UploadSessionSerializer(session).data, status=status.HTTP_409_CONFLICT)
+        if length <= 0 or offset + length > session.size:
+            return Response("The chunk must be 1 to %d bytes long." % (session.size - offset), status=status.HTTP_400_BAD_REQUEST)
+        try:
+            if not session.append(request.stream, length):
+                # Another chunk was appended meanwhile
+                return Response(UploadSessionSerializer(session).data, status=status.HTTP_409_CONFLICT)
+        except (IOError, UnreadablePostError):
+            # The bytes received are kept: the client resumes from the offset of the session
+            return Response(UploadSessionSerializer(session).data, status=status.HTTP_400_BAD_REQUEST)
+        return Response(UploadSessionSerializer(session).data, status=status.HTTP_200_OK)
+
+    @decorators.detail_route(methods=['post'])
+    def finalize(self, request, pk=None):
+        """
+        Turn the complete upload into an Image (target=image), or into the attachment of a new Message sent by the
+        ChatMember chatmember_id (target=message, with an optional text). The session is then deleted.
+        ---
+        omit_serializer: true
+        parameters_strategy:
+            form: replace
+        parameters:
+            - name: target
+              type: string
+              required: true
+            - name: chatmember_id
+              type: integer
+              required: false
+            - name: text
+              type: string
+              required: false
+        """
+        session = self.get_object()
+        if not session.is_complete:
+            return Response(UploadSessionSerializer(session).data, status=status.HTTP_409_CONFLICT)
+        if session.sha256 and session.file_sha256() != session.sha256:
+            session.delete()
+            return Response("The file does not match its sha256, upload it again.", status=status.HTTP_400_BAD_REQUEST)
+
+        target = request.data.get('target', None)
+        if target == 'image':
+            response = self.finalize_image(request, session)
+        elif target == 'message':
+            response = self.finalize_message(request, session)
+        else:
+            return Response("target must be image or message.", status=status.HTTP_400_BAD_REQUEST)
+        if response.status_code == status.HTTP_201_CREATED:
+            session.delete()
+        return response
+
+    def finalize_image(self, request, session):
+        try:
+            PIL_Image.open(session.path).verify()
+        except (IOError, SyntaxError, ValueError):
+            return Response("The file is not an image.", status=status.HTTP_400_BAD_REQUEST)
+        with open(session.path, 'rb') as f:
+            image = Image.objects.create(file=File(f, name=session.filename), owner=request.user)
+        return Response(ImageSerializer(image, context={'request': request}).data, status=status.HTTP_201_CREATED)
+
+    def finalize_message(self, request, session):
+        from sigma_chat.models.chat_member import ChatMember
+        from sigma_chat.serializers.message import MessageSerializer
+
+        try:
+            chatmember = ChatMember.objects.get(pk=request.data.get('chatmember_id', None))
+        except (ChatMember.DoesNotExist, ValueError):
+            raise Http404("ChatMember {0} not found".format(request.data.get('chatmember_id', None)))
+        if not chatmember.is_member or chatmember.user != request.user:
+            return Response(status=status.HTTP_403_FORBIDDEN)
+
+        with open(session.path, 'rb') as f:
+            message = MessageSerializer(data={
+                'chat_id': chatmember.chat.id,
+                'chatmember_id': chatmember.id,
+                'text': request.data.get('text', ''),
+                'attachment': File(f, name=session.filename),
+            })
+            if not message.is_valid():
+                return Response(message.errors, status=status.HTTP_400_BAD_REQUEST)
+            message.save()
+        return Response(message.data, status=status.HTTP_201_CREATED)
+
+
+class IgnoreClientContentNegotiation(BaseContentNegotiation):
+    """Media responses are files, whatever the Accept header: skip the renderer selection."""
+    def select_parser(self, request, parsers):
+        return parsers[0]
+
+    def select_renderer(self, request, renderers, format_suffix=None):
+        return (renderers[0], renderers[0].media_type)
+
+
+def parse_range(header, size):
+    """
+    Return the (start, end) inclusive byte range of a 'Range: bytes=...' header for a file of size bytes, None to send
+    the whole file (no, malformed or multiple ranges), or False if the range is not satisfiable.
+    """
+    if not header or not header.startswith('bytes=') or ',' in header:
+        return None
+    start, sep, end = header[6:].strip().partition('-')
+    if not sep:
+        return None
+    try:
+        if not start:
+            # Suffix range: the last `end` bytes
+            length = int(end)
+            if length <= 0:
+                return False
+            return max(0, size - length), size - 1
+        start = int(start)
+        end = int(end) if end else size - 1
+    except ValueError:
+        return None
+    if start >= size:
+        return False
+    if start > end:
+        return None
+    return start, min(end, size - 1)
+
+
+def file_range(path, start, length, chunk_size=64 * 1024):
+    with open(path, 'rb') as f:
+        f.seek(start)
+        while length > 0:
+            data = f.read(min(chunk_size, length))
+            if not data:
+                return
+            length -= len(data)
+            yield data
+
+
+class MediaView(APIView):
+    """
+    Serve an uploaded file: GET /media/{path}. Images are public, chat attachments are readable by the members of the
+    chats they were sent to.
+    Django only checks permissions and conditional requests; depending on settings.MEDIA_SERVE['MODE'] the bytes are
+    sent by:
+        - 'django' (default): this view, with support of Range requests;
+        - 'x-accel-redirect': nginx, from the internal location MEDIA_SERVE['INTERNAL_URL'] aliased to MEDIA_ROOT;
+        - 'x-sendfile': Apache mod_xsendfile or lighttpd, from the file path.
+    The front server then handles Range requests and frees the application worker at once.
+    """
+    permission_classes = []
+    content_negotiation_class = IgnoreClientContentNegotiation
+    # Files under img/ are only stored by Image and ImageRendition, which anyone may read (see
+    # Image.has_object_read_permission): they are served without a database lookup. Other namespaces (chat attachments
+    # under uploads/) need a row granting access. Content-addressed storage keeps namespaces apart: an attachment
+    # identical to a public image is still stored, and checked, under uploads/.
+    public_namespaces = ('img', )
+    # Public files are served inline, with one of these types only, so that no upload (an .html or .svg file, or an
+    # image which also parses as HTML) runs as a page of the API origin. Attachments are always downloaded.
+    image_content_types = {'.jpg': 'image/jpeg', '.jpeg': 'image/jpeg', '.png': 'image/png', '.gif': 'image/gif',
+                           '.webp': 'image/webp', '.bmp': 'image/bmp'}
+
+    def has_permission(self, request, path):
+        if path.split('/', 1)[0] in self.public_namespaces:
+            return True
+        from sigma_chat.models.message import Message
+        return request.user.is_authenticated() and Message.objects.attachment_readable_by(path, request.user)
+
+    def get(self, request, path):
+        try:
+            full_path = safe_join(settings.MEDIA_ROOT, path)
+        except SuspiciousFileOperation:
+            raise Http404("File {0} not found".format(path))
+        if not os.path.isfile(full_path):
+            raise Http404("File {0} not found".format(path))
+        if not self.has_permission(request, path):
+            # Do not tell whether the file exists
+            raise Http404("File {0} not found".format(path))
+
+        stat = os.stat(full_path)
+        etag = '"%x-%x"' % (int(stat.st_mtime), stat.st_size)
+        last_modified = http_date(stat.st_mtime)
+        public = path.split('/', 1)[0] in self.public_namespaces
+        if public:
+            content_type = self.image_content_types.get(os.path.splitext(path)[1].lower(), 'application/octet-stream')
+        else:
+            content_type = mimetypes.guess_type(full_path)[0] or 'application/octet-stream'
+
+        if_none_match = request.META.get('HTTP_IF_NONE_MATCH', None)
+        if if_none_match is not None:
+            not_modified = if_none_match.strip() == '*' or etag in [t.strip() for t in if_none_match.split(',')]
+        else:
+            not_modified = not was_modified_since(request.META.get('HTTP_IF_MODIFIED_SINCE'), stat.st_mtime, stat.st_size)
+        if not_modified:
+            response = HttpResponseNotModified()
+        else:
+            response = self.file_response(request, full_path, path, stat.st_size, etag, last_modified, content_type)
+        response['ETag'] = etag
+        response['Last-Modified'] = last_modified
+        response['Cache-Control'] = 'public' if public else 'private'
+        # Browsers must not guess another type from the content
+        response['X-Content-Type-Options'] = 'nosniff'
+        if not public:
+            response['Content-Disposition'] = 'attachment; filename="%s"' % os.path.basename(path)
+        return response
+
+    def file_response(self, request, full_path, path, size, etag, last_modified, content_type):
+        mode = getattr(settings, 'MEDIA_SERVE', {}).get('MODE', 'django')
+        if mode == 'x-accel-redirect':
+            response = HttpResponse(content_type=content_type)
+            response['X-Accel-Redirect'] = urlquote(settings.MEDIA_SERVE.get('INTERNAL_URL', '/protected-media/') + path)
+            return response
+        if mode == 'x-sendfile':
+            response = HttpResponse(content_type=content_type)
+            response['X-Sendfile'] = full_path
+            return response
+
+        response_range = parse_range(request.META.get('HTTP_RANGE', None), size)
+        # If-Range: only send the range if the file has not changed since the client got the beginning of it
+        if_range = request.META.get('HTTP_IF_RANGE', None)
+        if if_range is not None and if_range not in (etag, last_modified):
+            response_range = None
+        if response_range is False:
+            response = HttpResponse(status=status.HTTP_416_REQUESTED_RANGE_NOT_SATISFIABLE)
+            response['Content-Range'] = 'bytes */%d' % size
+            return response
+
+        if response_range is None:
+            response = FileResponse(open(full_path, 'rb'), content_type=content_type) if request.method != 'HEAD' \
+                else HttpResponse(content_type=content_type)
+            response['Content-Length'] = size
+        else:
+            start, end = response_range
+            length = end - start + 1
+            response = StreamingHttpResponse(file_range(full_path, start, length), status=status.HTTP_206_PARTIAL_CONTENT,
+                                             content_type=content_type) if request.method != 'HEAD' \
+                else HttpResponse(status=status.HTTP_206_PARTIAL_CONTENT, content_type=content_type)
+            response['Content-Range'] = 'bytes %d-%d/%d' % (start, end, size)
+            response['Content-Length'] = length
+        response['Accept-Ranges'] = 'bytes'
+        return response
@@ -1,212 +1,911 @@
 #-*- coding = utf-8 -*-
+import tornado.ioloop
+import tornado.process
 import tornado.web
 import json
-from tornado import websocket
+from tornado import gen, websocket
+from tornado.iostream import IOStream, StreamClosedError
+from tornado.netutil import bind_unix_socket
+from tornado.options import define, options, parse_command_line
+from tornado.tcpserver import TCPServer
 
 # General modules.
+import bisect
+import hashlib
+import hmac
 import logging
+import socket
+import struct
+import time
+from collections import OrderedDict, deque
 
 """
     Django send messages to all the others
     A client has a WebSocketConection with this process
-    This connection has to be authorised -> Token/other : how to check that the user is authorised ? ChatHandler has a list of authorized tokens
-    Connections only accept messages from Django
-    
-    Proccess : 
-        - User logs in -> Django send token to MainHandler
-        - User sent message -> Django save it and give it to the MainHandler, which gives it to the appropriated connections -> clients
-        - User logs out -> Django tell MainHandler to remove the token from the list
+    This connection has to be authorised -> Token/other : how to check that the user is authorised ? ChatHandler has a registry of authorized tokens
+    Connections only accept messages from Django, which publishes them on the chat bus (see sigma_chat.bus)
+
+    Proccess :
+        - User logs in -> Django publishes a token event
+        - User sent message -> Django save it and publishes it, the ChatHandler gives it to the appropriated connections -> clients
+        - User joins, leaves or is banned from a chat -> Django publishes a membership event, the ChatHandler updates the
+          chats of his tokens and of his connections
+        - User logs out -> the client revokes its token, Django publishes a revoke_token event
+        - Client reconnects with ?last_seen={message id} -> the ChatHandler replays the messages it missed from its replay
+          buffers, or tells it to resync the chats whose gap is not buffered anymore
 """
-class MainHandler(tornado.web.RequestHandler):
+
+
+class ClientWSConnection(websocket.WebSocketHandler):
 
     def initialize(self, chat_handler):
         """Store a reference to the "external" ChatHandler instance"""
         self.__ch = chat_handler
+        self.user_id = None
+
+    def open(self, token):
+        entry = self.__ch.tokens.get(token)
+        if entry is None:
+            self.close(reason="You are not allowed to establish a connection with this server.", code=403)
+            return
+        self.user_id = entry.user_id
+        self.outbound = self.__ch.outbound_queue(self)
+        last_seen = self.get_query_argument('last_seen', None)
+        if last_seen is not None:
+            try:
+                self.__ch.replay(self, entry.chats, int(last_seen))
+            except ValueError:
+                pass
+        self.__ch.add_client_wsconn(entry, self)
+        logging.info("WebSocket opened. ClientID = %s" % self.user_id)
+
+    def on_message(self, message):
+        logging.warning("Try to send a message the wrong way.")
+
+    def on_close(self):
+        logging.info("WebSocket closed")
+        if self.user_id is not None:
+            self.outbound.close()
+            self.__ch.remove_client(self.user_id, self)
+
+    def send_encoded(self, encoded):
+        """Queue an EncodedEvent for this connection (see OutboundQueue)."""
+        self.outbound.push(encoded)
 
-    def _get_current_user(self, param, callback):
+    def write_encoded(self, events):
         """
-        Check if the message really originates from Django.
+        Write EncodedEvents to the socket and return the Future of the write. Without per-message compression,
+        frames are the same for every recipient and are written as is, in a single write; otherwise fall back to
+        write_message, which compresses each payload.
         """
+        ws = self.ws_connection
+        if ws is None:
+            return None
         try:
-            secret = self.get_query_argument("secret_key")
-            if(secret == ""):
-                #add user to the chat he is member of
-                self._current_user = "Django"
-                print("Right user.")
-                print(self.request)
-                print(self.request.arguments)
-                print(self.get_argument("message", strip=False))
-                param = json.loads(self.get_argument("message", strip=False))
-                print(param)
-                callback(param)
-                print("Callback called.")
-                self.set_status(200, "All right")
-                print("get current user finished")
-                return
+            if getattr(ws, '_compressor', None) is None and not ws.mask_outgoing:
+                if len(events) == 1:
+                    return ws.stream.write(events[0].frame)
+                return ws.stream.write(b''.join([e.frame for e in events]))
+            future = None
+            for e in events:
+                future = self.write_message(e.payload)
+            return future
+        except (StreamClosedError, websocket.WebSocketClosedError):
+            return None
+
+
+class OutboundQueue(object):
+    """
+    Outbound events of a connection. At most one write is in flight on the socket: events pushed meanwhile wait here
+    and are written together once it completes. When the queued payloads exceed high_water bytes, the consumer is too
+    slow and policy applies:
+        - 'drop': the new event is dropped;
+        - 'coalesce': the queued events are dropped and replaced with a single {"msgtype": "resync"} event, telling
+          the client to fetch what it missed from the chat history API;
+        - 'disconnect': the connection is closed, the client will reconnect and resync.
+    """
+    POLICIES = ('drop', 'coalesce', 'disconnect')
+    RESYNC = None  # EncodedEvent, set below
+
+    def __init__(self, conn, high_water=1024 * 1024, policy='coalesce', metrics=None):
+        if policy not in self.POLICIES:
+            raise ValueError("Unknown slow consumer policy: %s" % policy)
+        self.conn = conn
+        self.high_water = high_water
+        self.policy = policy
+        self.metrics = metrics if metrics is not None else ChatMetrics()
+        self._events = deque()
+        self._bytes = 0
+        self._in_flight = False
+        self._closed = False
+
+    def __len__(self):
+        return len(self._events)
+
+    @property
+    def queued_bytes(self):
+        return self._bytes
+
+    def push(self, encoded):
+        if self._closed:
+            return
+        if not self._in_flight:
+            self._write((encoded, ))
+            return
+        if self._bytes + len(encoded.payload) > self.high_water:
+            self._overflow(encoded)
+            return
+        self._events.append(encoded)
+        self._bytes += len(encoded.payload)
+
+    def _overflow(self, encoded):
+        if self.policy == 'drop':
+            self.metrics.dropped += 1
+        elif self.policy == 'coalesce':
+            # The queue may already have been coalesced: its resync event then stays and is not counted as dropped
+            resynced = bool(self._events) and self._events[0] is self.RESYNC
+            self.metrics.dropped += len(self._events) - resynced + 1
+            self.metrics.coalesced += not resynced
+            self._events.clear()
+            self._events.append(self.RESYNC)
+            self._bytes = len(self.RESYNC.payload)
+        else:
+            self.metrics.dropped += len(self._events) + 1
+            self.metrics.disconnected += 1
+            self.close()
+            self.conn.close(code=1008, reason="Too slow.")
+
+    def close(self):
+        self._closed = True
+        self._events.clear()
+        self._bytes = 0
+
+    def _write(self, events):
+        self._in_flight = True
+        self.metrics.sent += len(events)
+        future = self.conn.write_encoded(events)
+        if future is None:
+            self._written()
+        else:
+            future.add_done_callback(self._written)
+
+    def _written(self, future=None):
+        self._in_flight = False
+        if future is not None and future.exception() is not None:
+            self.close()
+            return
+        if self._events and not self._closed:
+            events = list(self._events)
+            self._events.clear()
+            self._bytes = 0
+            self._write(events)
+
+
+class ChatMetrics(object):
+    """Counters of the outbound queues, reported by MetricsHandler."""
+
+    def __init__(self):
+        self.sent = 0          # events written to sockets
+        self.dropped = 0       # events dropped because of slow consumers
+        self.coalesced = 0     # queues replaced with a resync event
+        self.disconnected = 0  # connections closed because of slow consumers
+
+    def snapshot(self, connections):
+        depths = [len(conn.outbound) for conn in connections.all_connections()]
+        queued_bytes = sum(conn.outbound.queued_bytes for conn in connections.all_connections())
+        return {
+            'connections': len(depths),
+            'queued_events': sum(depths),
+            'queued_bytes': queued_bytes,
+            'max_queue_depth': max(depths) if depths else 0,
+            'sent': self.sent,
+            'dropped': self.dropped,
+            'coalesced': self.coalesced,
+            'disconnected': self.disconnected,
+        }
+
+
+class MetricsHandler(tornado.web.RequestHandler):
+    """
+    Outbound queue metrics of the chat server: GET /tornado/metrics/
+    Only served to local clients, or with token to clients sending the header "Authorization: Bearer {token}".
+    """
+    LOCAL_ADDRESSES = ('127.0.0.1', '::1')
+
+    def initialize(self, chat_handler, token=None):
+        self.__ch = chat_handler
+        self.token = token
+
+    def get(self):
+        if self.token:
+            authorization = self.request.headers.get('Authorization', '')
+            if not hmac.compare_digest(authorization.encode('utf-8'), ('Bearer %s' % self.token).encode('utf-8')):
+                raise tornado.web.HTTPError(403)
+        elif self.request.remote_ip not in self.LOCAL_ADDRESSES:
+            raise tornado.web.HTTPError(403)
+        self.write(self.__ch.metrics.snapshot(self.__ch.connections))
+
+
+class PresenceHandler(tornado.web.RequestHandler):
+    """Online users of the chats of the bearer of token: GET /tornado/presence/{token}?chat=1&chat=2"""
+
+    def initialize(self, chat_handler):
+        self.__ch = chat_handler
+
+    def get(self, token):
+        entry = self.__ch.tokens.get(token)
+        if entry is None:
+            raise tornado.web.HTTPError(403)
+        chats = entry.chats
+        requested = self.get_query_arguments('chat')
+        if requested:
+            try:
+                chats = chats.intersection(int(c) for c in requested)
+            except ValueError:
+                raise tornado.web.HTTPError(400)
+        online = self.__ch.presence.online_users(chats)
+        self.write({str(chat_id): sorted(users) for (chat_id, users) in online.items()})
+
+
+class EncodedEvent(object):
+    """An event encoded once for all its recipients: the UTF-8 JSON payload and the websocket text frame carrying it."""
+    __slots__ = ('payload', '_frame')
+
+    def __init__(self, event):
+        self.payload = json.dumps(event, separators=(',', ':')).encode('utf-8')
+        self._frame = None
+
+    @property
+    def frame(self):
+        if self._frame is None:
+            # FIN + text opcode, unmasked (server to client), see RFC 6455 section 5.2
+            l = len(self.payload)
+            if l < 126:
+                header = struct.pack("!BB", 0x81, l)
+            elif l <= 0xFFFF:
+                header = struct.pack("!BBH", 0x81, 126, l)
             else:
-                print("request not from Django")
-                self._current_user = None
-                self.set_status(403, "You are not authorised to access this server.")
-                self.finish()
-        except tornado.web.MissingArgumentError:
-            print("request not from Django")
-            self._current_user = None
-            self.set_status(403, "You are not authorised to access this server.")
-            self.finish()
-
-    def get(self, token=None):
-        """
-            Add a client to the list of authorized ones
-        """
-        if not token:
-            self.set_status(403, "You are not authorised to access this server.")
-        # Get the current user.
-        self._get_current_user(param=token, callback=self.__ch.add_potential_client)
-        print("get finish.")
+                header = struct.pack("!BBQ", 0x81, 127, l)
+            self._frame = header + self.payload
+        return self._frame
+
+
+OutboundQueue.RESYNC = EncodedEvent({"msgtype": "resync"})
 
-    def post(self, message=None):
+
+class ReplayBuffer(object):
+    """
+    The size most recent message events of a chat, as (message_id, EncodedEvent) pairs sorted by id.
+    Messages committed by concurrent transactions may be published out of id order: they are inserted at their place.
+    """
+    __slots__ = ('events', 'evicted_max_id')
+
+    def __init__(self, size):
+        self.events = deque(maxlen=size)
+        self.evicted_max_id = None  # id of the newest message which left the buffer
+
+    def _evict(self, message_id):
+        if self.evicted_max_id is None or message_id > self.evicted_max_id:
+            self.evicted_max_id = message_id
+
+    def append(self, message_id, encoded):
+        events = self.events
+        if not events or message_id > events[-1][0]:
+            if len(events) == events.maxlen:
+                self._evict(events[0][0])
+            events.append((message_id, encoded))
+            return
+        if len(events) == events.maxlen:
+            if message_id < events[0][0]:
+                # Older than the whole buffer: it does not enter it
+                self._evict(message_id)
+                return
+            self._evict(events.popleft()[0])
+        events.insert(bisect.bisect([e[0] for e in events], message_id), (message_id, encoded))
+
+
+class ReplayRegistry(object):
+    """
+    Replay buffers of the chats, so that a reconnecting client only receives the messages it missed.
+    Message ids grow across chats and every message event goes through the registry once the chat server is started:
+    a client which has seen message last_seen missed nothing in chat chat_id if the server saw every message after it
+    (last_seen + 1 >= first_id) and the buffer of chat_id still holds them (last_seen >= evicted_max_id).
+    """
+    def __init__(self, size=100):
+        self.size = size
+        self.first_id = None  # id of the first message event received by the server
+        self._buffers = {}  # chat_id -> ReplayBuffer
+
+    def __len__(self):
+        return sum(len(b.events) for b in self._buffers.values())
+
+    def append(self, chat_id, message_id, encoded):
+        if self.size <= 0 or message_id is None:
+            return
+        if self.first_id is None:
+            self.first_id = message_id
+        buffer = self._buffers.get(chat_id)
+        if buffer is None:
+            buffer = self._buffers[chat_id] = ReplayBuffer(self.size)
+        buffer.append(message_id, encoded)
+
+    def since(self, chats, last_seen):
         """
-            Post a message from Django
+        Return (events, gaps): the EncodedEvents of the messages of chats newer than last_seen, by id, and the chats
+        whose missed messages are not all buffered anymore and have to be fetched from the chat history API.
         """
-        print("Get method called")
-        if not message:
-            self.set_status(400, "Bad Request.")
-            self.finish()
-        print("Get Method successfully called")
-        # Get the current user.
-        self._get_current_user(param=message, callback=self.__ch.add_message)
-        print("post finish.")
-        self.set_status(200, "All right")
-        print("post not finished yet")
-        return
-
-    def delete(self, token=None):
+        if self.first_id is None or last_seen + 1 < self.first_id:
+            return [], sorted(chats)
+        events, gaps = [], []
+        for chat_id in chats:
+            buffer = self._buffers.get(chat_id)
+            if buffer is None:
+                continue
+            if buffer.evicted_max_id is not None and last_seen < buffer.evicted_max_id:
+                gaps.append(chat_id)
+                continue
+            events.extend(e for e in buffer.events if e[0] > last_seen)
+        events.sort(key=lambda e: e[0])
+        return [e[1] for e in events], sorted(gaps)
+
+
+class TokenEntry(object):
+    """
+    Data attached to an authorized token: the User it belongs to and the chats he is member of, kept up to date by the
+    membership events until the token expires.
+    """
+    __slots__ = ('user_id', 'chats', 'expires')
+
+    def __init__(self, user_id, chats, expires):
+        self.user_id = user_id
+        self.chats = chats
+        self.expires = expires
+
+
+class TokenRegistry(object):
+    """
+    Authorized tokens, indexed by token.
+    Entries expire ttl seconds after they were (re)added. Since the ttl is the same for all of them, the OrderedDict is
+    also sorted by expiry date and purging only has to look at its head.
+    """
+
+    def __init__(self, ttl=3600, clock=time.monotonic):
+        self.ttl = ttl
+        self.clock = clock
+        self._entries = OrderedDict()
+        self._users = {}  # user_id => set of tokens
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, token):
+        return self.get(token) is not None
+
+    def add(self, token, user_id, chats=()):
+        self.purge()
+        self.remove(token)
+        entry = TokenEntry(user_id, frozenset(chats), self.clock() + self.ttl)
+        self._entries[token] = entry
+        self._users.setdefault(user_id, set()).add(token)
+        return entry
+
+    def get(self, token):
+        """Return the TokenEntry of token, or None if it is unknown or expired."""
+        entry = self._entries.get(token)
+        if entry is not None and entry.expires <= self.clock():
+            self.remove(token)
+            return None
+        return entry
+
+    def remove(self, token):
+        """Forget token and return its TokenEntry, or None if it was unknown."""
+        entry = self._entries.pop(token, None)
+        if entry is not None:
+            tokens = self._users[entry.user_id]
+            tokens.discard(token)
+            if not tokens:
+                del self._users[entry.user_id]
+        return entry
+
+    def set_member(self, user_id, chat_id, member):
+        """Add chat_id to, or remove it from, the chats of the tokens of user_id."""
+        for token in self._users.get(user_id, ()):
+            entry = self._entries[token]
+            entry.chats = (entry.chats | {chat_id}) if member else (entry.chats - {chat_id})
+
+    def purge(self):
+        """Drop expired tokens and return how many were removed."""
+        now = self.clock()
+        removed = 0
+        while self._entries:
+            token, entry = next(iter(self._entries.items()))
+            if entry.expires > now:
+                break
+            self.remove(token)
+            removed += 1
+        return removed
+
+
+class ConnectionRegistry(object):
+    """
+    Open websocket connections, indexed by User and by chat.
+    An User may have several concurrent connections (one per tab or device); he is online as long as one remains.
+    Each connection subscribes to the chats of its token: the chats of an User are those of all his connections.
+    """
+
+    def __init__(self):
+        self._connections = {}  # user_id => dict connection => frozenset of chat ids
+        self._chats = {}        # user_id => frozenset of chat ids, union of those of his connections
+        self._chatmates = {}    # chat_id => set of online user ids
+
+    def __len__(self):
+        return sum(len(conns) for conns in self._connections.values())
+
+    def add(self, user_id, conn, chats=()):
+        """Register conn for user_id. Return True if it is the first connection of this User."""
+        conns = self._connections.get(user_id)
+        first = conns is None
+        if first:
+            conns = self._connections[user_id] = {}
+        conns[conn] = frozenset(chats)
+        self._update_chats(user_id)
+        return first
+
+    def remove(self, user_id, conn):
+        """Unregister conn. Return True if it was the last connection of this User."""
+        conns = self._connections.get(user_id)
+        if conns is None or conn not in conns:
+            return False
+        del conns[conn]
+        if conns:
+            self._update_chats(user_id)
+            return False
+        self.remove_user(user_id)
+        return True
+
+    def remove_user(self, user_id):
+        """Unregister all the connections of user_id and return them."""
+        conns = self._connections.pop(user_id, {})
+        self._unsubscribe(user_id, self._chats.pop(user_id, ()))
+        return set(conns)
+
+    def set_member(self, user_id, chat_id, member):
+        """Subscribe every connection of user_id to chat_id, or unsubscribe them from it."""
+        conns = self._connections.get(user_id)
+        if conns is None:
+            return
+        for (conn, chats) in conns.items():
+            conns[conn] = (chats | {chat_id}) if member else (chats - {chat_id})
+        self._update_chats(user_id)
+
+    def _update_chats(self, user_id):
+        old = self._chats.get(user_id, frozenset())
+        new = frozenset().union(*self._connections[user_id].values())
+        self._chats[user_id] = new
+        for chat_id in new - old:
+            self._chatmates.setdefault(chat_id, set()).add(user_id)
+        self._unsubscribe(user_id, old - new)
+
+    def _unsubscribe(self, user_id, chats):
+        for chat_id in chats:
+            chatmates = self._chatmates.get(chat_id)
+            if chatmates is not None:
+                chatmates.discard(user_id)
+                if not chatmates:
+                    del self._chatmates[chat_id]
+
+    def is_online(self, user_id):
+        return user_id in self._connections
+
+    def connections(self, user_id):
+        return self._connections.get(user_id, {}).keys()
+
+    def chats(self, user_id):
+        return self._chats.get(user_id, frozenset())
+
+    def all_connections(self):
+        for conns in self._connections.values():
+            for conn in conns:
+                yield conn
+
+    def chat_users(self, chat_id):
+        return self._chatmates.get(chat_id, set())
+
+    def chat_connections(self, chat_id):
+        """Iterate over the connections subscribed to chat_id."""
+        for user_id in self.chat_users(chat_id):
+            for (conn, chats) in self._connections[user_id].items():
+                if chat_id in chats:
+                    yield conn
+
+
+class PresenceService(object):
+    """
+    Online state of the users, announced to their chatmates.
+    An User is online while he has at least one connection. Transitions are not announced immediately: they are
+    collected during window seconds, then each online chatmate receives one message with the net changes that concern
+    him: {"msgtype": "presence", "online": [user_ids], "offline": [user_ids]}. An User whose connection drops and comes
+    back within the window is therefore never announced offline.
+    With legacy, each change is also sent as the {"msgtype": "is_connected" or "is_disconnected", "username": user_id}
+    events of former clients, until they all understand presence messages.
+    With several chat workers, the net transitions of local users are also forwarded to the other workers, which
+    announce them to their own connections (see remote_changes). A worker sends a snapshot of its online users to
+    each worker it (re)connects to, and asks for theirs when it starts, so that presence survives worker restarts.
+    """
+
+    def __init__(self, chat_handler, window=1.0, call_later=None, legacy=False):
+        self.ch = chat_handler
+        self.connections = chat_handler.connections
+        self.window = window
+        self.legacy = legacy
+        self._call_later = call_later
+        self._announced = set()     # user ids last announced online
+        self._pending = {}          # user_id => (chats he was in, transition received from another worker)
+        self._scheduled = False
+        self._remote = {}           # user_id => chats, for users online on other workers
+        self._remote_chatmates = {} # chat_id => set of user ids online on other workers
+        self._remote_shards = {}    # shard => set of user ids online on that worker
+
+    def user_connected(self, user_id):
+        self._pending[user_id] = (None, False)
+        self._schedule()
+
+    def user_disconnected(self, user_id, chats):
+        self._pending[user_id] = (chats, False)
+        self._schedule()
+
+    def remote_changes(self, changes, shard=None, snapshot=False):
         """
-            Remove a client from the list of authorized ones
+        Transitions forwarded by worker shard: list of [user_id, online, chats]. A snapshot lists all the users online
+        on that worker: the others are offline.
         """
-        if not token:
-            self.set_status(403, "You are not authorised to access this server.")
-            self.finish()
-        # Get the current user.
-        self._get_current_user(param=token, callback=self.__ch.remove_potential_client)
-        self.finish()
+        shard_users = self._remote_shards.setdefault(shard, set())
+        if snapshot:
+            online = {user_id for (user_id, _, _) in changes}
+            changes = [[user_id, False, sorted(self._remote.get(user_id, ()))]
+                       for user_id in shard_users if user_id not in online] + list(changes)
+        for (user_id, online, chats) in changes:
+            for chat_id in self._remote.pop(user_id, ()):
+                self._remote_chatmates[chat_id].discard(user_id)
+            if online:
+                self._remote[user_id] = frozenset(chats)
+                for chat_id in chats:
+                    self._remote_chatmates.setdefault(chat_id, set()).add(user_id)
+                shard_users.add(user_id)
+            else:
+                shard_users.discard(user_id)
+            self._pending[user_id] = (frozenset(chats), True)
+        self._schedule()
 
+    def snapshot(self):
+        """The presence event listing the users online on this worker, for the other workers."""
+        users = sorted(user_id for user_id in self._announced if self.connections.is_online(user_id))
+        changes = [[user_id, True, sorted(self.connections.chats(user_id))] for user_id in users]
+        return {'type': 'presence', 'shard': self.ch.shard, 'snapshot': True, 'changes': changes}
+
+    def is_online(self, user_id):
+        return self.connections.is_online(user_id) or user_id in self._remote
+
+    def online_users(self, chats):
+        """Dict chat_id => set of online user ids, for each chat of chats."""
+        return {
+            chat_id: set(self.connections.chat_users(chat_id)) | self._remote_chatmates.get(chat_id, set())
+            for chat_id in chats
+        }
+
+    def _schedule(self):
+        if self.window <= 0:
+            self.flush()
+        elif not self._scheduled:
+            self._scheduled = True
+            call_later = self._call_later or tornado.ioloop.IOLoop.current().call_later
+            call_later(self.window, self.flush)
+
+    def _chatmates(self, user_id, chats):
+        if len(chats) == 1:
+            users = self.connections.chat_users(next(iter(chats)))
+        else:
+            users = set()
+            for chat_id in chats:
+                users.update(self.connections.chat_users(chat_id))
+        return (chatmate_id for chatmate_id in users if chatmate_id != user_id)
+
+    def flush(self):
+        """Announce the transitions collected since the last flush."""
+        self._scheduled = False
+        pending, self._pending = self._pending, {}
+        deltas = {}    # recipient user_id => (online user ids, offline user ids)
+        forwarded = [] # transitions of local users, for the other workers
+        for (user_id, (chats, remote)) in pending.items():
+            online = self.is_online(user_id)
+            if online == (user_id in self._announced):
+                continue
+            if online:
+                self._announced.add(user_id)
+                chats = self._remote[user_id] if remote else self.connections.chats(user_id)
+                i = 0
+            else:
+                self._announced.discard(user_id)
+                i = 1
+            if not remote:
+                forwarded.append([user_id, online, sorted(chats)])
+            for chatmate_id in self._chatmates(user_id, chats):
+                deltas.setdefault(chatmate_id, ([], []))[i].append(user_id)
+
+        if forwarded and self.ch.peers is not None:
+            self.ch.peers.publish({'type': 'presence', 'shard': self.ch.shard, 'changes': forwarded})
+
+        # Most recipients get the same delta: encode each distinct one once
+        encoded_deltas = {}
+        legacy_events = {}
+        for (recipient_id, (online, offline)) in deltas.items():
+            key = (tuple(sorted(online)), tuple(sorted(offline)))
+            encoded = encoded_deltas.get(key)
+            if encoded is None:
+                encoded = encoded_deltas[key] = EncodedEvent({"msgtype": "presence", "online": key[0], "offline": key[1]})
+            for conn in self.connections.connections(recipient_id):
+                conn.send_encoded(encoded)
+            if self.legacy:
+                self._send_legacy(recipient_id, key, legacy_events)
+
+    def _send_legacy(self, recipient_id, delta, encoded_events):
+        """Send a delta (online user ids, offline user ids) as legacy events, each one encoded once in encoded_events."""
+        events = []
+        for (msgtype, user_ids) in (("is_connected", delta[0]), ("is_disconnected", delta[1])):
+            for user_id in user_ids:
+                encoded = encoded_events.get((msgtype, user_id))
+                if encoded is None:
+                    encoded = encoded_events[(msgtype, user_id)] = EncodedEvent({"msgtype": msgtype, "username": user_id})
+                events.append(encoded)
+        for conn in self.connections.connections(recipient_id):
+            for encoded in events:
+                conn.send_encoded(encoded)
 
-class ClientWSConnection(websocket.WebSocketHandler):
- 
-    def initialize(self, chat_handler):
-        """Store a reference to the "external" ChatHandler instance"""
-        self.__ch = chat_handler
- 
-    def open(self, token):
-        for user in self.__ch.authorized_tokens:
-            if user.token == token.token and user.user.id == token.user_id:
-                self.__ch.add_client_wsconn(user, self)
-                print("WebSocket opened. ClientID = %s" % self.__token.user_id)
-                break
-        self.close(reason="You are not allowed to establish a connection with this server.", code=403)
- 
-    def on_message(self, message):
-        print("Try to send a message the wrong way.")
- 
-    def on_close(self):
-        print("WebSocket closed")
-        self.__ch.remove_client(self.__token.user_id)
 
-"""
-    Needs:
-        - authorized_tokens = [{'token': token, 'user': user}]
-        - add_potential_client({'token': token, 'user': user})
-        - add_client_wsconn(user, ClientWSConnection)
-        - remove_client(user_id)
-        - remove_potential_client({'token': token, 'user': user})
-        - add_message(message)
-        - chatemate_cwsconns(user_id)
-        - send_is_connected_msg(user_id)
-        - send_is_disconnected_msg(user_id)
-"""
 class ChatHandler(object):
     """Store data about connections, chats, which users are in which chats, etc."""
- 
-    def __init__(self):
-        self.authorized_tokens = []  # store the list of {'token': token, 'user': user}
-        self.user_connections = {} # dict  to store 'user_id': {'wsconn": wsconn, 'chats': [chat_id1, chat_id2]}
-        self.chatmates = {}  # store a set for each chat, each contains the id of the clients in the room.
- 
+
+    def __init__(self, token_ttl=3600, presence_window=1.0, call_later=None, outbound_high_water=1024 * 1024,
+                 slow_consumer_policy='coalesce', peers=None, replay_size=100, shard=0, legacy_presence=False):
+        if slow_consumer_policy not in OutboundQueue.POLICIES:
+            raise ValueError("Unknown slow consumer policy: %s" % slow_consumer_policy)
+        self.tokens = TokenRegistry(ttl=token_ttl)
+        self.connections = ConnectionRegistry()
+        self.peers = peers  # PeerBus to the other chat workers, if any
+        self.shard = shard
+        self.presence = PresenceService(self, window=presence_window, call_later=call_later, legacy=legacy_presence)
+        self.metrics = ChatMetrics()
+        self.outbound_high_water = outbound_high_water
+        self.slow_consumer_policy = slow_consumer_policy
+        self.replay_buffers = ReplayRegistry(size=replay_size)
+
+    def outbound_queue(self, conn):
+        return OutboundQueue(conn, high_water=self.outbound_high_water, policy=self.slow_consumer_policy, metrics=self.metrics)
+
+    def handle_event(self, event):
+        """Dispatch an event published by Django on the chat bus."""
+        msgtype = event.get('type')
+        if msgtype == 'message':
+            self.add_message(event['message'])
+        elif msgtype == 'token':
+            self.add_potential_client(event)
+        elif msgtype == 'revoke_token':
+            self.remove_potential_client(event)
+        elif msgtype == 'membership':
+            self.update_membership(event)
+        elif msgtype == 'presence':
+            self.presence.remote_changes(event['changes'], event.get('shard'), event.get('snapshot', False))
+        elif msgtype == 'presence_sync':
+            # A worker (re)started: send it the users online here
+            if self.peers is not None:
+                self.peers.publish(self.presence.snapshot())
+        else:
+            logging.warning("Unknown chat bus event: %s" % msgtype)
+
     def add_potential_client(self, token):
-        """Add potential client to chat."""
-        self.authorized_tokens.append(token)
- 
-    def add_client_wsconn(self, user, conn):
+        """Authorize a token: {'token': token, 'user_id': user_id, 'chats': [chat_id1, chat_id2]}."""
+        self.tokens.add(token['token'], token['user_id'], token.get('chats', ()))
+
+    def add_client_wsconn(self, entry, conn):
         """Store the websocket connection corresponding to an authorized client."""
-        self.user_connections[user.id]['wsconn'] = conn
-        self.user_connections[user.id]['chats'] = []
- 
-        # for each chat this user is member of, add the user to the chatmates of the chat
-        for chatmember in user.user_chatmember:
-            self.chatmates[chatmember.chat.id].add(user.id)
-            self.user_connections[user.id]['chats'].append(chatmember.chat.id)
-
-        # send "is_connected" messages
-        self.send_is_connected_msg(user.id)
- 
-    def remove_client(self, user_id):
-        """Remove all client information from the chat handler."""
-        # first, remove the client connection from the corresponding chat in self.chatmates
-        chats = self.user_connections[user_id]
-        self.send_is_disconnected_msg(user_id)
-        for chat_id in chats:
-            self.chatmates[chat_id].discard(user_id)
-        del self.user_connections[user_id]
- 
+        if self.connections.add(entry.user_id, conn, entry.chats):
+            self.presence.user_connected(entry.user_id)
+
+    def remove_client(self, user_id, conn):
+        """Remove a connection of the client from the chat handler."""
+        chats = self.connections.chats(user_id)
+        if self.connections.remove(user_id, conn):
+            self.presence.user_disconnected(user_id, chats)
+
     def remove_potential_client(self, token):
-        """Remove potential client from chat."""
-        del self.authorized_tokens[token]
-        remove_client(token.user.id)
+        """Revoke a token ({'token': token, 'user_id': user_id}) and close the connections of its User."""
+        entry = self.tokens.get(token['token'])
+        if entry is None or token.get('user_id', entry.user_id) != entry.user_id:
+            return
+        self.tokens.remove(token['token'])
+        chats = self.connections.chats(entry.user_id)
+        conns = self.connections.remove_user(entry.user_id)
+        for conn in conns:
+            conn.close()
+        if conns:
+            self.presence.user_disconnected(entry.user_id, chats)
+
+    def update_membership(self, membership):
+        """
+        A User joined or left a chat ({'user_id': user_id, 'chat_id': chat_id, 'member': bool}): his connections
+        receive its messages from now on, or stop receiving them, and so do the connections opened with his tokens,
+        replays included.
+        """
+        self.tokens.set_member(membership['user_id'], membership['chat_id'], membership['member'])
+        self.connections.set_member(membership['user_id'], membership['chat_id'], membership['member'])
+
+    def broadcast(self, conns, event):
+        """Encode event once and send it to every connection of conns."""
+        encoded = EncodedEvent(event)
+        for conn in conns:
+            conn.send_encoded(encoded)
+        return encoded
 
     def add_message(self, message):
-        print('begin of the add_message method')
-        print(message)
-        print(message['chat'])
-        print(message['chat']['id'])
-        rconns = self.chatmate_cwsconns(message['chat']['id'])
-        print(rconns)
-        for conn in rconns:
-            conn.write_message(message)
-            print("Message sent")
-        print("end of the sent messages");
- 
+        chat_id = message['chat']['id']
+        encoded = self.broadcast(self.chatmate_cwsconns(chat_id), message)
+        self.replay_buffers.append(chat_id, message.get('id'), encoded)
+
+    def replay(self, conn, chats, last_seen):
+        """
+        Send to a reconnecting connection the messages of chats it missed since message last_seen. Chats whose gap is
+        not buffered anymore are listed in a {"msgtype": "resync", "chats": [...]} event instead, for the client to
+        fetch them from the chat history API.
+        """
+        events, gaps = self.replay_buffers.since(chats, last_seen)
+        if gaps:
+            conn.send_encoded(EncodedEvent({"msgtype": "resync", "chats": gaps}))
+        for encoded in events:
+            conn.send_encoded(encoded)
+
     def chatmate_cwsconns(self, chat_id):
-        """Return a list with the connections of the users currently connected to the specified chat."""
-        print('begin of the chatmate_cwsconns method.')
-        print(self.chatmates)
-        if chat_id in self.chatmates:
-            print("found")
-            return self.chatmates[chat_id]
-        else:
-            print('not found')
-            return []
- 
-    def send_is_connected_msg(self, user_id):
-        """Send a message of type 'is_connected' to all users connected to the chat where user_id is connected."""
-        r = set()
-        #for every chat the user is part of
-        for chat in self.user_connections[user_id]['chats']:
-            #add the other members of the chat to the list of receivers
-            r.update(self.chatmate_cwsconns(chat))
-        msg = {"msgtype": "is_connected", "username": user_id}
-        pmessage = json.dumps(msg)
-        for conn in r_cwsconns:
-            conn.write_message(pmessage)
- 
-    def send_is_disconnected_msg(self, user_id):
-        """Send a message of type 'is_disconnected' to all users connected to the chat where user_id is disconnected."""
-        r = set()
-        #for every chat the user is part of
-        for chat in self.user_connections[user_id]['chats']:
-            #add the other members of the chat to the list of receivers
-            r.update(self.chatmate_cwsconns(chat))
-        msg = {"msgtype": "is_disconnected", "username": user_id}
-        pmessage = json.dumps(msg)
-        for conn in r_cwsconns:
-            conn.write_message(pmessage)
+        """Return the connections of the users currently connected to the specified chat."""
+        return self.connections.chat_connections(chat_id)
+
+
+class ChatBusServer(TCPServer):
+    """Receive the newline-delimited JSON events that Django publishes through sigma_chat.bus.UnixSocketBus."""
+
+    max_event_size = 1024 * 1024
+
+    def __init__(self, chat_handler, **kwargs):
+        super(ChatBusServer, self).__init__(**kwargs)
+        self.__ch = chat_handler
+
+    def listen_unix(self, path, mode=0o600):
+        self.add_socket(bind_unix_socket(path, mode=mode))
+
+    @gen.coroutine
+    def handle_stream(self, stream, address):
+        try:
+            while True:
+                line = yield stream.read_until(b'\n', max_bytes=self.max_event_size)
+                try:
+                    event = json.loads(line.decode('utf-8'))
+                except ValueError:
+                    logging.warning("Malformed chat bus event dropped.")
+                    continue
+                self.__ch.handle_event(event)
+        except StreamClosedError:
+            pass
+
+
+class HashRing(object):
+    """
+    Consistent hashing of keys (user ids) over shards 0..shards-1. Django and the chat workers build the same ring,
+    so Django knows which worker a user has to connect to.
+    """
+
+    def __init__(self, shards, replicas=100):
+        self.shards = shards
+        points = []
+        for shard in range(shards):
+            for replica in range(replicas):
+                points.append((self._hash('%d-%d' % (shard, replica)), shard))
+        points.sort()
+        self._keys = [p[0] for p in points]
+        self._shards = [p[1] for p in points]
+
+    @staticmethod
+    def _hash(key):
+        return int(hashlib.md5(str(key).encode('utf-8')).hexdigest()[:16], 16)
+
+    def shard_for(self, key):
+        i = bisect.bisect(self._keys, self._hash(key)) % len(self._keys)
+        return self._shards[i]
+
+
+def shard_socket_path(path, shard):
+    """Bus socket of chat worker shard."""
+    return '%s.%d' % (path, shard)
+
+
+class PeerBus(object):
+    """
+    Forward events to the other chat workers, through their ChatBusServer sockets.
+    Events published while a worker is unreachable are lost: every new connection starts with the event returned by
+    hello(), if set, for the worker to catch up.
+    """
+
+    def __init__(self, paths, hello=None):
+        self.paths = paths
+        self.hello = hello
+        self._streams = {}
+
+    def publish(self, event):
+        data = json.dumps(event, separators=(',', ':')).encode('utf-8') + b'\n'
+        for path in self.paths:
+            stream = self._streams.get(path)
+            if stream is None or stream.closed():
+                stream = self._connect(path)
+            try:
+                # Buffered by the stream until it is connected
+                stream.write(data)
+            except StreamClosedError:
+                self._streams.pop(path, None)
+
+    def _connect(self, path):
+        stream = IOStream(socket.socket(socket.AF_UNIX, socket.SOCK_STREAM))
+        self._streams[path] = stream
+
+        def on_close():
+            if self._streams.get(path) is stream:
+                del self._streams[path]
+            logging.warning("Chat worker %s unavailable: %s" % (path, stream.error))
+
+        stream.set_close_callback(on_close)
+        # The failure is handled by on_close: retrieve it so that it is not logged again
+        stream.connect(path).add_done_callback(lambda future: future.exception())
+        if self.hello is not None:
+            stream.write(json.dumps(self.hello(), separators=(',', ':')).encode('utf-8') + b'\n')
+        return stream
+
+
+define('port', default=8888, help="port of the websocket server, worker i of N listens on port + i")
+define('bus_socket', default='/tmp/sigma_chat.sock', help="unix socket Django publishes chat events to, worker i of N uses bus_socket.i")
+define('processes', default=1, help="number of chat worker processes, 0 for one per CPU")
+define('outbound_high_water', default=1024 * 1024, help="bytes queued for a connection before it is a slow consumer")
+define('slow_consumer_policy', default='coalesce', help="drop, coalesce or disconnect")
+define('replay_size', default=100, help="recent messages kept per chat for reconnecting clients, 0 to disable")
+define('metrics_token', default='', help="token required by /tornado/metrics/, which is otherwise only served to localhost")
+define('legacy_presence', default=True, help="also send the is_connected/is_disconnected events of former clients")
+
+
+def main():
+    """
+    Run the chat server on its own, for Django deployments configured with sigma_chat.bus.UnixSocketBus or, with
+    --processes other than 1, sigma_chat.bus.ShardedBus. Users are sharded over the worker processes with HashRing:
+    a worker only holds the connections of its users, receives every message event and forwards presence changes to
+    the other workers.
+    """
+    parse_command_line()
+    processes = options.processes or tornado.process.cpu_count()
+    if processes > 1:
+        shard = tornado.process.fork_processes(processes)
+        bus_socket = shard_socket_path(options.bus_socket, shard)
+        peers = PeerBus([shard_socket_path(options.bus_socket, i) for i in range(processes) if i != shard])
+    else:
+        shard, bus_socket, peers = 0, options.bus_socket, None
+
+    ch = ChatHandler(outbound_high_water=options.outbound_high_water, slow_consumer_policy=options.slow_consumer_policy, peers=peers,
+                     replay_size=options.replay_size, shard=shard, legacy_presence=options.legacy_presence)
+    app = tornado.web.Application([
+        (r"/tornado/ws/(.*)", ClientWSConnection, {'chat_handler': ch}),
+        (r"/tornado/presence/(.*)", PresenceHandler, {'chat_handler': ch}),
+        (r"/tornado/metrics/", MetricsHandler, {'chat_handler': ch, 'token': options.metrics_token}),
+    ])
+    app.listen(options.port + shard)
+    ChatBusServer(ch).listen_unix(bus_socket)
+    if peers is not None:
+        peers.hello = ch.presence.snapshot
+        peers.publish({'type': 'presence_sync', 'shard': shard})
+    tornado.ioloop.IOLoop.current().start()
+
+
+if __name__ == '__main__':
+    main()